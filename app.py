@@ -1,6 +1,11 @@
 import dash
 import dash_bootstrap_components as dbc
 
+from utils import flights
+from utils import metrics
+from utils import refresh
+from utils import serving
+
 # bootstrap theme
 # https://bootswatch.com/lux/
 external_stylesheets = [dbc.themes.LUX]
@@ -10,4 +15,13 @@ app = dash.Dash(__name__,
                 )
 
 server = app.server
-app.config.suppress_callback_exceptions = True
\ No newline at end of file
+app.config.suppress_callback_exceptions = True
+
+# brotli/gzip, ETags and cache headers (see utils/serving.py)
+serving.init_app(app)
+# per-callback latency, sizes and errors on /metrics (see utils/metrics.py)
+metrics.init_app(app)
+# answer superseded callback requests of a browser tab with no update (see utils/flights.py)
+flights.init_app(app)
+# requests keep the dataset versions they started with across reloads (see utils/refresh.py)
+refresh.init_app(app)
@@ -3,19 +3,28 @@ import dash
 import dash_html_components as html
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
-from dash.dependencies import Input, Output
-
-from gapminder import gapminder
+from dash.dependencies import Input
 
 import plotly.express as px
 import pandas as pd
-import numpy as np
+from functools import partial
+
+from utils import figpack
+from utils import frames
+from utils import geometry
+from utils import lod
+from utils import metrics
+from utils import pipeline
+from utils import catalog
+from utils import export
+from utils import templates
+from utils.executor import build_figures
+from utils.figcache import figure_cache
 
-#data for the region plot
-loc_data = px.data.gapminder()
-loc_cols=list(loc_data.columns)
+# gapminder data, indexed on population (shared with the other pages)
+gap_engine = catalog.gapminder()
 #get European data
-eur_data =loc_data[loc_data['continent'] == "Europe"]
+eur_data = gap_engine.select(continent=['Europe'])
 #get unique countries
 country_names = eur_data['country'].unique()
 
@@ -28,7 +37,7 @@ color_discrete_map = {'Albania': '#000000', 'Austria': '#FFFF00', 'Belgium': '#1
     'Netherlands': '#809693', 'Norway': '#FEFFE6', 'Poland': '#1B4400','Portugal': '#4FC601', 
     'Romania': '#3B5DFF', 'Serbia': '#4A3B53', 'Slovak Republic': '#FF2F80', 
     'Slovenia': '#61615A','Spain': '#BA0900', 'Sweden': '#6B7900', 'Switzerland': '#00C2A0',
-    'Turkey': '#FFAA92','United Kingdom': '#FF90C9'}
+    'Turkey': '#FFAA92','United Kingdom': '#FF90C9', lod.OTHER: '#8C8C8C'}
 
 # needed only if running this as a single page app
 from app import app
@@ -89,18 +98,20 @@ layout = html.Div(style={'backgroundColor': colors['background']},children=[
             ],style={'width': '49%', 'float': 'right', 'display': 'inline-block'}),
         ]),
         html.Div([
-            dcc.Graph(
+            figpack.Graph(
                 id='barchart'
             ),
             ],style={'width': '80%', 'margin-left': '10%','display': 'inline-block'}),
         html.Div([
             html.Div([
-                dcc.Graph(
-                        id='geochart'
+                figpack.Graph(
+                        id='geochart',
+                        # map geometry from this server when it has been built
+                        config=geometry.graph_config(app)
                 ),
             ],style={'width': '49%','display': 'inline-block'}),
             html.Div([
-                dcc.Graph(
+                figpack.Graph(
                     id='trendline'
                 ),
             ],style={'width': '49%', 'float': 'right', 'display': 'inline-block'}),
@@ -109,23 +120,82 @@ layout = html.Div(style={'backgroundColor': colors['background']},children=[
 ])
 
 
+def snap_range(selected_count, erangevalue, eyvar):
+    # only the pop values in the data change the result, not every slider step
+    return selected_count, gap_engine.snap(erangevalue), eyvar
+
+
 @app.callback(
-    [Output(component_id='barchart', component_property='figure'),
-    Output(component_id='geochart', component_property='figure'),
-    Output(component_id='trendline', component_property='figure')],
+    [figpack.output('barchart'),
+    figpack.output('geochart'),
+    figpack.output('trendline')],
     [Input(component_id='country_dropdown', component_property='value'),
     Input(component_id='eur_pop_range', component_property='value'),
     Input(component_id='eur_y_dropdown', component_property='value')]
 )
+@frames.streamed('Europe.update_graphs')
+@figure_cache.memoize('Europe.update_graphs', version=lambda: gap_engine.version,
+                      canonical=snap_range)
+@figpack.packed('Europe.update_graphs')
 def update_graphs(selected_count,erangevalue,eyvar):
     if not (selected_count or erangevalue or eyvar):
         return dash.no_update
-    d = eur_data[(eur_data['pop'] >= erangevalue[0]) & (eur_data['pop'] <= erangevalue[1])]
-    data =[]
-    for j in selected_count:
-            data.append(d[d['country'] == j])
-    df = pd.DataFrame(np.concatenate(data), columns=loc_cols)
-    df=df.infer_objects()
+    # the dropdown only offers European countries
+    with metrics.span('filter'):
+        df = filter_countries(selected_count, erangevalue)
+    # the three figures only share df, build them concurrently
+    return build_figures('Europe.update_graphs', [
+        ('bar', bar_figure, (df, eyvar, erangevalue)),
+        ('map', map_figure, (df, eyvar)),
+        ('line', line_figure, (df, eyvar))])
+
+
+@pipeline.stage('Europe.filter', version=lambda: gap_engine.version)
+def filter_countries(selected_count, erangevalue):
+    return gap_engine.select(erangevalue, country=selected_count or [])
+
+
+@pipeline.stage('Europe.bar')
+def bar_figure(df, eyvar, erangevalue):
+    updates = {'yaxis.range': bar_range(eyvar, erangevalue)}
+    # past lod.LOD_BARS countries the top ones plus the mean of the others
+    if not lod.detailed(df, 'country', lod.LOD_BARS):
+        df = lod.top_n(df, 'country', eyvar, lod.LOD_TOP_N, frame='year')
+        return templates.template('Europe.bar.top.' + eyvar, partial(px_bar_figure, eyvar=eyvar),
+                                  lambda: pd.concat([eur_data, eur_data.assign(country=lod.OTHER)]),
+                                  groups=['country'], frame='year').render(df, updates)
+    # plotly express runs once per variable, later calls only swap the data in
+    return templates.template('Europe.bar.' + eyvar, partial(px_bar_figure, eyvar=eyvar),
+                              lambda: eur_data, groups=['country'], frame='year').render(
+        df, updates)
+
+
+@pipeline.stage('Europe.map')
+def map_figure(df, eyvar):
+    # the color range follows the selection, the map is framed on the
+    # selected countries from their stored bounds instead of fitbounds
+    updates = {'coloraxis.cmin': df[eyvar].min(), 'coloraxis.cmax': df[eyvar].max()}
+    updates.update(geometry.view(df['iso_alpha'].unique(), ['Europe']))
+    return templates.template('Europe.map.' + eyvar, partial(px_map_figure, eyvar=eyvar),
+                              lambda: eur_data, frame='year').render(df, updates)
+
+
+@pipeline.stage('Europe.line')
+def line_figure(df, eyvar):
+    return templates.template('Europe.line.' + eyvar, partial(px_line_figure, eyvar=eyvar),
+                              lambda: eur_data, groups=['country']).render(df)
+
+
+def bar_range(eyvar, erangevalue):
+    if eyvar == 'lifeExp':
+        return [0, 85]
+    elif eyvar == 'pop':
+        return [0, erangevalue[1]]
+    else:
+        return [0, 50000]
+
+
+def px_bar_figure(df, eyvar):
     barfig = px.bar(df, y=eyvar, x='country',animation_frame="year",
              # add text labels to bar
              text=eyvar, color='country', 
@@ -143,13 +213,10 @@ def update_graphs(selected_count,erangevalue,eyvar):
         showlegend=False, margin=dict( b=200),xaxis_title="")
     barfig['layout']['updatemenus'][0]['pad']=dict(r= 10, t= 170)
     barfig['layout']['sliders'][0]['pad']=dict(r= 10, t= 170,)
-    if eyvar == 'lifeExp':
-         barfig.update_yaxes(range=[0, 85])
-    elif eyvar == 'pop':
-         barfig.update_yaxes(range=[0, erangevalue[1]])
-    else:
-         barfig.update_yaxes(range=[0, 50000])
+    return barfig
+
 
+def px_map_figure(df, eyvar):
     mapfig= px.choropleth(df,locations="iso_alpha", color=df[eyvar],
             hover_name="country",hover_data=['continent','pop'],animation_frame="year",    
             color_continuous_scale='Turbo',range_color=[df[eyvar].min(), df[eyvar].max()],
@@ -158,7 +225,10 @@ def update_graphs(selected_count,erangevalue,eyvar):
     mapfig.update_layout(plot_bgcolor='rgb(233, 238, 245)',paper_bgcolor='rgb(233, 238, 245)')
     mapfig.update_geos(fitbounds="locations")
     mapfig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+    return mapfig
 
+
+def px_line_figure(df, eyvar):
     linefig = px.line(data_frame=df, 
                 x="year",  y = df[eyvar] , color='country',
                 # different colour for each country
@@ -171,8 +241,17 @@ def update_graphs(selected_count,erangevalue,eyvar):
                      'country':'Country','lifeExp':'Life Expectancy'})
     linefig.update_layout(plot_bgcolor='rgb(233, 238, 245)',
         paper_bgcolor='rgb(233, 238, 245)')
-        
-    return [barfig, mapfig, linefig]
+    return linefig
+
+
+figpack.register(app, ['barchart', 'geochart', 'trendline'])
+
+# the filtered rows as CSV, Arrow or Parquet (utils/export.py)
+export.register('Europe', 'gapminder', {'country_dropdown': 'country'},
+                key_range='eur_pop_range', fixed={'continent': ['Europe']})
+layout.children.append(export.links(app, 'Europe',
+    [Input(component_id='country_dropdown', component_property='value'),
+     Input(component_id='eur_pop_range', component_property='value')]))
 
 
 # needed only if running this as a single page app
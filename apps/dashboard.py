@@ -4,16 +4,31 @@ from dash import dcc
 from dash import html
 from dash.dependencies import Input, Output
 
-from gapminder import gapminder
-
 import plotly.express as px
-import pandas as pd
+import plotly.graph_objects as go
 import numpy as np
-import plotly.express as px
+import os
+from functools import partial
+
+from utils import catalog
+from utils import export
+from utils import metrics
+from utils import prerender
+from utils import templates
+
+# shot data, memory-mapped from a columnar copy of the CSV (see utils/shots.py)
+# the CSV location is set with the SHOTS_CSV environment variable
+shot_engine = catalog.shots()
+columns = shot_engine.columns
+# shot counts per county x passes x distance x angle bin (see utils/cube.py)
+shot_cube = catalog.shot_cube()
 
-df = pd.read_csv('E:\\Data_Visualization\\data_visualisation_ca2_dkit\\cleaned_data.csv')
-columns=list(df.columns)
-county_names = df['county'].unique()
+# above WEBGL_POINTS shots the scatter is drawn with WebGL, above MAX_POINTS
+# it is downsampled on the server; zooming in brings back the raw shots
+WEBGL_POINTS = int(os.environ.get('SHOTS_WEBGL_POINTS', 2000))
+MAX_POINTS = int(os.environ.get('SHOTS_MAX_POINTS', 20000))
+# cells per axis of the grid the downsampling is stratified on
+GRID_SIZE = 64
 
 
 # needed only if running this as part of a multipage app
@@ -29,71 +44,212 @@ color_discrete_map = {'Cavan': '#636EFA', 'Armagh': '#EF553B', 'Down': '#00CC96'
     'Dublin': '#AB63FA', 'Kerry': '#FFA15A'}
 
 
+def county_names():
+    # counties of the current shots; every county keeps its colour whichever
+    # counties are selected, those added by a reload get the next ones
+    names = shot_engine.categories['county']
+    for county in names:
+        if county not in color_discrete_map:
+            color_discrete_map[county] = px.colors.qualitative.Plotly[
+                len(color_discrete_map) % len(px.colors.qualitative.Plotly)]
+    return names
 
-layout = html.Div(style={'backgroundColor': colors['background']},children=[
-    html.H1('Gealic Match Analysis',
-        style={
-            'textAlign': 'center',
-            'color': '#1c1cbd',
-            }
-            ),
+
+# built again when the shots are reloaded (utils/pages.py)
+def layout():
+    return html.Div(style={'backgroundColor': colors['background']},children=[
+        html.H1('Gealic Match Analysis',
+            style={
+                'textAlign': 'center',
+                'color': '#1c1cbd',
+                }
+                ),
+                html.Div([
+                html.Label('Select Counties'),
+                dcc.Dropdown(id='county_drop',
+                            options=[{'label': i, 'value': i}
+                                    for i in county_names()],
+                            value=['Cavan', 'Armagh', 'Down', 'Dublin', 'Kerry'],
+                            multi=True
+                )
+            ],style={'width': '49%', 'display': 'inline-block'}),
             html.Div([
-            html.Label('Select Counties'),
-            dcc.Dropdown(id='county_drop',
-                        options=[{'label': i, 'value': i}
-                                for i in county_names],
-                        value=['Cavan', 'Armagh', 'Down', 'Dublin', 'Kerry'],
-                        multi=True
+            html.Label('Select Build Up Pass Range'),
+            dcc.RangeSlider(id='pass_range',
+                min=0,
+                max=29,
+                value=[0,29],
+                step= 1,
+                marks={
+                    0: '0',
+                    10: '10',
+                    20: '20',
+                    30: '30',
+                },
             )
-        ],style={'width': '49%', 'display': 'inline-block'}),
+    ],style={'width': '49%', 'float': 'right', 'display': 'inline-block'}),
+                    dcc.Graph(
+            id='county_Graph'
+        ),
         html.Div([
-        html.Label('Select Build Up Pass Range'),
-        dcc.RangeSlider(id='pass_range',
-            min=0,
-            max=29,
-            value=[0,29],
-            step= 1,
-            marks={
-                0: '0',
-                10: '10',
-                20: '20',
-                30: '30',
-            },
-        )
-],style={'width': '49%', 'float': 'right', 'display': 'inline-block'}),
-                dcc.Graph(
-        id='county_Graph'
-    ),
-
-])
-@app.callback(
+            html.Div([
+                dcc.Graph(id='shot_density')
+            ],style={'width': '59%', 'display': 'inline-block', 'verticalAlign': 'top'}),
+            html.Div([
+                html.Table(id='county_stats', style={'width': '100%'})
+            ],style={'width': '39%', 'float': 'right', 'display': 'inline-block'}),
+        ]),
+        # the download links, kept in step with the controls (utils/export.py)
+        export_links,
+    ])
+# the default figure comes with the layout (utils/prerender.py)
+@prerender.callback(app,
     Output(component_id='county_Graph', component_property='figure'),
     [Input(component_id='county_drop', component_property='value'),
-     Input(component_id='pass_range', component_property='value')]
+     Input(component_id='pass_range', component_property='value'),
+     Input(component_id='county_Graph', component_property='relayoutData')]
 )
-def update_graph(selected_cont,rangevalue):
+def update_graph(selected_cont,rangevalue,relayout=None):
     if not selected_cont:
         return dash.no_update
-    data =[]
-    d = df[(df['build_up_passes'] >= rangevalue[0]) & (df['distance_from_goal'] <= rangevalue[1])]
-    for j in selected_cont:
-            data.append(d[d['county'] == j])
-   
-    df=df.infer_objects()
+    region = zoom_region(relayout)
+    with metrics.span('filter'):
+        pos = shot_engine.positions(rangevalue, county=selected_cont)
+        for col, bounds in zip(('distance_from_goal', 'angle'), region or ()):
+            if bounds is not None:
+                values = shot_engine.data[col][pos]
+                pos = pos[(values >= bounds[0]) & (values <= bounds[1])]
+        total = len(pos)
+        if total > MAX_POINTS:
+            pos = downsample(pos, MAX_POINTS)
+        df = shot_engine.take(pos)
+    render_mode = 'webgl' if len(df) > WEBGL_POINTS else 'svg'
+    updates = {}
+    for axis, bounds in zip(('xaxis', 'yaxis'), region or ()):
+        if bounds is not None:
+            updates[axis + '.range'] = bounds
+    if len(df) < total:
+        updates['title.text'] = ('Showing %d of %d shots, zoom in for every shot'
+                                 % (len(df), total))
+    # plotly express runs once per render mode, later calls only swap the data in
+    with metrics.span('figure'):
+        return templates.template('dashboard.scatter.' + render_mode,
+                                  partial(scatter_figure, render_mode=render_mode),
+                                  shot_engine.select, groups=['county']).render(df, updates)
+
+
+def scatter_figure(df, render_mode):
+    county_names()
     scat_fig = px.scatter(data_frame=df, x="distance_from_goal", y="angle",
-                size="county", color="county",hover_name="county",
+                color="county",hover_name="county",
+                render_mode=render_mode,
                 # different colour for each country
-                # color_discrete_map=color_discrete_map, //////////// 
+                color_discrete_map=color_discrete_map,
                #add frame by year to create animation grouped by country
             #    animation_frame="shot_id",animation_group="county", /////////////
                #specify formating of markers and axes
             #    log_x = True, size_max=60, range_x=[100,100000], range_y=[28,92],
                 # change labels
-                labels={'pop':'Population','year':'Year','continent':'Continent',
-                        'country':'Country','lifeExp':'Life Expectancy','gdpPercap':"GDP/Capita"})
-    # Change the axis titles and add background colour using rgb syntax
-    scat_fig.update_layout({'xaxis': {'title': {'text': 'log(GDP Per Capita)'}},
-                  'yaxis': {'title': {'text': 'Life Expectancy'}}}, 
-                  plot_bgcolor='rgb(233, 238, 245)',paper_bgcolor='rgb(233, 238, 245)')
-
-    return scat_fig
\ No newline at end of file
+                labels={'county':'County','distance_from_goal':'Distance from Goal',
+                        'angle':'Angle','build_up_passes':'Build Up Passes'})
+    # add background colour using rgb syntax
+    scat_fig.update_layout(plot_bgcolor='rgb(233, 238, 245)',paper_bgcolor='rgb(233, 238, 245)',
+                  # keep the user's zoom when the figure is rebuilt
+                  uirevision='shots')
+    return scat_fig
+
+
+def zoom_region(relayout):
+    # ((x0, x1), (y0, y1)) the user zoomed to, None for the full view; an
+    # axis left out (an x-only or y-only zoom) is None, its full extent
+    if not relayout or relayout.get('xaxis.autorange') or relayout.get('autosize'):
+        return None
+    region = (_axis_range(relayout, 'xaxis'), _axis_range(relayout, 'yaxis'))
+    return None if region == (None, None) else region
+
+
+def _axis_range(relayout, axis):
+    values = relayout.get(axis + '.range') or [relayout.get(axis + '.range[0]'),
+                                                relayout.get(axis + '.range[1]')]
+    if None in values:
+        return None
+    return sorted(map(float, values))
+
+
+def downsample(pos, limit):
+    # density preserving sample of about `limit` shots: every county x grid
+    # cell keeps the same fraction of its shots, and at least one, so sparse
+    # areas and outliers do not disappear
+    x = shot_engine.data['distance_from_goal'][pos]
+    y = shot_engine.data['angle'][pos]
+    county = shot_engine.codes['county'][pos].astype(np.int64)
+    cx = _cell(x)
+    cy = _cell(y)
+    groups = (county * GRID_SIZE + cx) * GRID_SIZE + cy
+    # shuffle first (with a fixed seed, so the same query gives the same
+    # points) so the shots kept in a cell are not biased by row order
+    shuffled = np.random.default_rng(0).permutation(len(pos))
+    order = shuffled[np.argsort(groups[shuffled], kind='stable')]
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    counts = np.diff(np.r_[starts, len(order)])
+    quota = np.maximum(1, np.floor(counts * (limit / len(pos)))).astype(np.int64)
+    rank = np.arange(len(order)) - np.repeat(starts, counts)
+    keep = order[rank < np.repeat(quota, counts)]
+    return pos[np.sort(keep)]
+
+
+def _cell(values):
+    lo, hi = values.min(), values.max()
+    if hi <= lo:
+        return np.zeros(len(values), dtype=np.int64)
+    cells = ((values - lo) * (GRID_SIZE / (hi - lo))).astype(np.int64)
+    return np.minimum(cells, GRID_SIZE - 1)
+
+
+# density view and county stats, answered from the cube without touching
+# the shots, so they cost the same whatever the number of shots
+@prerender.callback(app,
+    [Output(component_id='shot_density', component_property='figure'),
+     Output(component_id='county_stats', component_property='children')],
+    [Input(component_id='county_drop', component_property='value'),
+     Input(component_id='pass_range', component_property='value')]
+)
+def update_density(selected_cont, rangevalue):
+    if not selected_cont:
+        return dash.no_update
+    with metrics.span('filter'):
+        counts = shot_cube.density(selected_cont, rangevalue)
+        stats = shot_cube.stats(selected_cont, rangevalue)
+    with metrics.span('figure'):
+        return density_figure(counts), stats_table(stats)
+
+
+# the filtered shots as CSV, Arrow or Parquet (utils/export.py)
+export.register('dashboard', 'shots', {'county_drop': 'county'}, key_range='pass_range')
+export_links = export.links(app, 'dashboard',
+    [Input(component_id='county_drop', component_property='value'),
+     Input(component_id='pass_range', component_property='value')])
+
+
+def density_figure(counts):
+    x, y = shot_cube.centers()
+    fig = go.Figure(go.Heatmap(x=x.round(2), y=y.round(2), z=counts.T,
+                               colorscale='Viridis', colorbar={'title': {'text': 'Shots'}},
+                               hovertemplate='Distance %{x}<br>Angle %{y}<br>%{z} shots'
+                                             '<extra></extra>'))
+    fig.update_layout(title={'text': 'Shot density'},
+                      xaxis={'title': {'text': 'Distance from Goal'}},
+                      yaxis={'title': {'text': 'Angle'}},
+                      plot_bgcolor='rgb(233, 238, 245)',paper_bgcolor='rgb(233, 238, 245)')
+    return fig
+
+
+def stats_table(stats):
+    header = ['County', 'Shots', 'Avg Distance', 'Avg Angle', 'Avg Build Up Passes']
+    rows = [html.Tr([html.Td(row.county), html.Td(int(row.shots))] +
+                    [html.Td('-' if np.isnan(v) else '%.1f' % v)
+                     for v in (row.mean_distance_from_goal, row.mean_angle,
+                               row.mean_build_up_passes)])
+            for row in stats.itertuples()]
+    return [html.Thead(html.Tr([html.Th(h) for h in header])), html.Tbody(rows)]
@@ -7,6 +7,7 @@ import dash_bootstrap_components as dbc
 #app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
 from app import app
+from utils import serving
 
 # change to app.layout if running as single page app instead
 layout = html.Div([
@@ -53,7 +54,7 @@ layout = html.Div([
 
         ], className="mb-5"),
         dbc.Row([
-            dbc.Col(html.Img(src=app.get_asset_url('hansRoslin.jpeg')), 
+            dbc.Col(html.Img(src=serving.asset_url(app, 'hansRoslin.jpeg')), 
             width={"size": 6, "offset": 4})
         ]),
         html.A("Gaelic games (Irish: Cluichí Gaelacha) are sports played in Ireland under the auspices of the Gaelic Athletic Association (GAA). They include Gaelic football, hurling, Gaelic handball, and rounders. Women's versions of hurling and football are also played: camogie, organised by the Camogie Association of Ireland, and ladies' Gaelic football, organised by the Ladies' Gaelic Football Association.")
@@ -2,22 +2,40 @@
 import dash
 from dash import dcc
 from dash import html
-from dash.dependencies import Input, Output
-
-from gapminder import gapminder
+from dash.dependencies import Input, Output, State, ClientsideFunction
 
 import plotly.express as px
-import pandas as pd
-import numpy as np
+import plotly.io as pio
+import inspect
+import os
+from functools import partial
 
+from utils.arrays import pack_columns
+from utils import figpack
+from utils import frames
+from utils import geometry
+from utils import lod
+from utils import metrics
+from utils import pipeline
+from utils import prerender
+from utils import catalog
+from utils import export
+from utils import templates
+from utils.executor import build_figures
+from utils.figcache import figure_cache
 
 
+# gapminder data, indexed on population (shared with the other pages)
+gap_engine = catalog.gapminder()
 #get unique continents
-cont_names = gapminder['continent'].unique()
-cols=list(gapminder.columns)
-#data for the region plot
-loc_data = px.data.gapminder()
-loc_cols=list(loc_data.columns)
+cont_names = gap_engine.unique('continent')
+
+# opt-in clientside mode: the data is shipped to the browser once and the
+# graphs are filtered and rebuilt there (assets/clientside.js), falling back
+# to the server callbacks when the dataset is too big to ship
+CLIENTSIDE_FILTERING = os.environ.get('CLIENTSIDE_FILTERING', '0') == '1'
+CLIENTSIDE_MAX_ROWS = int(os.environ.get('CLIENTSIDE_MAX_ROWS', 50000))
+clientside = CLIENTSIDE_FILTERING and len(gap_engine) <= CLIENTSIDE_MAX_ROWS
 
 
 
@@ -75,7 +93,7 @@ layout = html.Div(style={'backgroundColor': colors['background']},children=[
                 )
         ],style={'width': '49%', 'float': 'right', 'display': 'inline-block'}),
     ]),
-    dcc.Graph(
+    figpack.Graph(
         id='LifeExpVsGDP'
     ),
     html.Label('Select Variable to display on Graphs'),
@@ -89,12 +107,14 @@ layout = html.Div(style={'backgroundColor': colors['background']},children=[
     ),
     html.Div([
         html.Div([
-            dcc.Graph(
-                id='LifeExp'
+            figpack.Graph(
+                id='LifeExp',
+                # map geometry from this server when it has been built
+                config=geometry.graph_config(app)
             )
         ],style={'width': '49%', 'display': 'inline-block'}),
         html.Div([
-            dcc.Graph(
+            figpack.Graph(
                 id='LifeExpOverTime',
             )
         ],style={'width': '49%', 'float': 'right', 'display': 'inline-block'}),
@@ -102,20 +122,42 @@ layout = html.Div(style={'backgroundColor': colors['background']},children=[
 
 ])
 
-@app.callback(
-    Output(component_id='LifeExpVsGDP', component_property='figure'),
-    [Input(component_id='cont_dropdown', component_property='value'),
+def snap_range(selected_cont, rangevalue, *rest):
+    # only the pop values in the data change the result, not every slider step
+    return (selected_cont, gap_engine.snap(rangevalue)) + rest
+
+
+graph_output = Output(component_id='LifeExpVsGDP', component_property='figure')
+graph_inputs = [Input(component_id='cont_dropdown', component_property='value'),
     Input(component_id='pop_range', component_property='value')]
-)
+
+@frames.streamed('task123.update_graph')
+@figure_cache.memoize('task123.update_graph', version=lambda: gap_engine.version,
+                      canonical=snap_range)
+@figpack.packed('task123.update_graph')
 def update_graph(selected_cont,rangevalue):
     if not selected_cont:
         return dash.no_update
-    data =[]
-    d = gapminder[(gapminder['pop'] >= rangevalue[0]) & (gapminder['pop'] <= rangevalue[1])]
-    for j in selected_cont:
-            data.append(d[d['continent'] == j])
-    df = pd.DataFrame(np.concatenate(data), columns=cols)
-    df=df.infer_objects()
+    with metrics.span('filter'):
+        df = filter_gap(selected_cont, rangevalue)
+    with metrics.span('figure'):
+        return scatter_figure(df)
+
+
+@pipeline.stage('task123.filter', version=lambda: gap_engine.version)
+def filter_gap(selected_cont, rangevalue):
+    # shared by both callbacks, a change of y_dropdown alone reuses it
+    return gap_engine.select(rangevalue, continent=selected_cont or [])
+
+
+@pipeline.stage('task123.scatter')
+def scatter_figure(df):
+    # plotly express runs once, later calls only swap the data in
+    return templates.template('task123.scatter', px_scatter_figure, gap_engine.select,
+                              groups=['continent'], frame='year', size_max=60).render(df)
+
+
+def px_scatter_figure(df):
     scat_fig = px.scatter(data_frame=df, x="gdpPercap", y="lifeExp",
                 size="pop", color="continent",hover_name="country",
                 # different colour for each country
@@ -136,31 +178,63 @@ def update_graph(selected_cont,rangevalue):
 
 
 
-@app.callback(
-    [Output(component_id='LifeExp', component_property='figure'),
-    Output(component_id='LifeExpOverTime', component_property='figure')],
-    [Input(component_id='cont_dropdown', component_property='value'),
+map_outputs = [Output(component_id='LifeExp', component_property='figure'),
+    Output(component_id='LifeExpOverTime', component_property='figure')]
+map_inputs = [Input(component_id='cont_dropdown', component_property='value'),
     Input(component_id='pop_range', component_property='value'),
     Input(component_id='y_dropdown', component_property='value')]
-)
+
+@frames.streamed('task123.update_map')
+@figure_cache.memoize('task123.update_map', version=lambda: gap_engine.version,
+                      canonical=snap_range)
+@figpack.packed('task123.update_map')
 def update_map(selected_cont,rangevalue,yvar):
     if not (selected_cont or rangevalue or yvar):
         return dash.no_update
-    d = loc_data[(loc_data['pop'] >= rangevalue[0]) & (loc_data['pop'] <= rangevalue[1])]
-    data =[]
-    for j in selected_cont:
-            data.append(d[d['continent'] == j])
-    df = pd.DataFrame(np.concatenate(data), columns=loc_cols)
-    df=df.infer_objects()
+    with metrics.span('filter'):
+        df = filter_gap(selected_cont, rangevalue)
+    # the map and the lines only share df, build them concurrently
+    return build_figures('task123.update_map', [
+        ('map', map_figure, (df, yvar)),
+        ('line', line_figure, (df, yvar))])
+
+
+@pipeline.stage('task123.map')
+def map_figure(df, yvar):
+    # the color range follows the selection, a single continent gets its own
+    # (more detailed) map
+    updates = {'coloraxis.cmin': df[yvar].min(), 'coloraxis.cmax': df[yvar].max()}
+    updates.update(geometry.view(df['iso_alpha'].unique(), df['continent'].unique()))
+    return templates.template('task123.map.' + yvar, partial(px_map_figure, yvar=yvar),
+                              gap_engine.select, frame='year').render(df, updates)
+
+
+@pipeline.stage('task123.line')
+def line_figure(df, yvar):
+    # past lod.LOD_LINES countries one median line and band per continent
+    if not lod.detailed(df, 'country', lod.LOD_LINES):
+        return band_figure(df, yvar)
+    # the render mode px would pick by itself, one template each
+    render_mode = 'webgl' if len(df) > 1000 else 'svg'
+    return templates.template('task123.line.%s.%s' % (yvar, render_mode),
+                              partial(px_line_figure, yvar=yvar, render_mode=render_mode),
+                              gap_engine.select, groups=['continent', 'country']).render(df)
+
+
+def px_map_figure(df, yvar):
     map_fig= px.choropleth(df,locations="iso_alpha", color=df[yvar],
             hover_name="country",hover_data=['continent','pop'],animation_frame="year",    
             color_continuous_scale='Turbo',range_color=[df[yvar].min(), df[yvar].max()],
             labels={'pop':'Population','year':'Year','continent':'Continent',
                 'country':'Country','lifeExp':'Life Expectancy'})
     map_fig.update_layout(plot_bgcolor='rgb(233, 238, 245)',paper_bgcolor='rgb(233, 238, 245)')
+    return map_fig
+
 
+def px_line_figure(df, yvar, render_mode='auto'):
     line_fig = px.line(data_frame=df, 
                 x="year",  y = df[yvar] , color='continent',line_group="country", 
+                render_mode=render_mode,
                 hover_data=['pop','year'],
                  # Add bold variable in hover information
                   hover_name='country',color_discrete_map=color_discrete_map,
@@ -169,8 +243,88 @@ def update_map(selected_cont,rangevalue,yvar):
                      'country':'Country','lifeExp':'Life Expectancy'})
     line_fig.update_layout(plot_bgcolor='rgb(233, 238, 245)',
         paper_bgcolor='rgb(233, 238, 245)')
-        
-    return [map_fig, line_fig]
+    return line_fig
+
+
+def band_figure(df, yvar):
+    # median of the countries of each continent per year, with the band
+    # between two percentiles drawn as a filled area around it; a handful of
+    # traces, built as plain dicts without plotly's validation
+    stats = lod.bands(df, 'year', yvar, 'continent')
+    label = {'pop': 'Population', 'lifeExp': 'Life Expectancy'}.get(yvar, yvar)
+    hover = ('<b>%%s</b><br>Year=%%%%{x}<br>median=%%%%{y}<br>%d-%dth percentile='
+             '%%%%{customdata[0]} to %%%%{customdata[1]}<br>%%%%{customdata[2]} countries'
+             '<extra></extra>' % lod.BAND)
+    data = []
+    for cont, rows in stats.groupby('continent', sort=False, observed=True):
+        color = color_discrete_map.get(cont, '#636EFA')
+        x = rows['year'].to_numpy()
+        edge = {'type': 'scatter', 'mode': 'lines', 'x': x, 'line': {'width': 0},
+                'legendgroup': cont, 'showlegend': False, 'hoverinfo': 'skip'}
+        data.append(dict(edge, y=rows['low'].to_numpy()))
+        data.append(dict(edge, y=rows['high'].to_numpy(), fill='tonexty',
+                         fillcolor=lod.rgba(color, 0.2)))
+        data.append({'type': 'scatter', 'mode': 'lines', 'x': x, 'y': rows['median'].to_numpy(),
+                     'name': cont, 'legendgroup': cont, 'line': {'color': color},
+                     'customdata': rows[['low', 'high', 'count']].to_numpy(),
+                     'hovertemplate': hover % cont})
+    return {'data': data, 'layout': {
+        'template': pio.templates[pio.templates.default],
+        'title': {'text': 'Median and %d-%dth percentile per continent, '
+                          'select fewer countries for one line each' % lod.BAND,
+                  'font': {'size': 12}},
+        'xaxis': {'title': {'text': 'Year'}}, 'yaxis': {'title': {'text': label}},
+        'legend': {'title': {'text': 'Continent'}},
+        'plot_bgcolor': 'rgb(233, 238, 245)', 'paper_bgcolor': 'rgb(233, 238, 245)'}}
+
+
+def clientside_data():
+    # gapminder columns as typed arrays plus the parts of the figures that do
+    # not depend on the selection, taken from the server-side figures
+    store = pack_columns(gap_engine.select(columns=['country', 'continent', 'year', 'lifeExp',
+                                                    'pop', 'gdpPercap', 'iso_alpha']),
+                         categorical=('country', 'continent', 'iso_alpha'))
+    full = [list(cont_names), [int(gap_engine.keys[0]), int(gap_engine.keys[-1])]]
+    scat_fig = inspect.unwrap(update_graph)(*full)
+    df = gap_engine.select(full[1], continent=full[0])
+    # the browser draws one line per country whatever the selection (no
+    # level of detail in clientside mode), its layout comes from px
+    map_fig = map_figure(df, 'lifeExp')
+    line_fig = px_line_figure(df, 'lifeExp').to_plotly_json()
+    store['layouts'] = {name: dict(fig['layout']) for name, fig in
+                        [('scatter', scat_fig), ('map', map_fig), ('line', line_fig)]}
+    # the plotly template is the same for all three, ship it once
+    store['template'] = scat_fig['layout']['template']
+    for fig_layout in store['layouts'].values():
+        fig_layout.pop('template', None)
+    store['colors'] = color_discrete_map
+    store['labels'] = {'pop': 'Population', 'lifeExp': 'Life Expectancy'}
+    return store
+
+
+if clientside:
+    layout.children.append(dcc.Store(id='gap_store', data=clientside_data()))
+    app.clientside_callback(ClientsideFunction(namespace='task123', function_name='update_graph'),
+        graph_output, graph_inputs, [State('gap_store', 'data')])
+    app.clientside_callback(ClientsideFunction(namespace='task123', function_name='update_map'),
+        map_outputs, map_inputs, [State('gap_store', 'data')])
+else:
+    # the default figures come with the layout (utils/prerender.py)
+    prerender.callback(app, figpack.output('LifeExpVsGDP'), graph_inputs)(update_graph)
+    prerender.callback(app, [figpack.output('LifeExp'), figpack.output('LifeExpOverTime')],
+        map_inputs)(update_map)
+    figpack.register(app, ['LifeExpVsGDP', 'LifeExp', 'LifeExpOverTime'])
+    # each continent on its own and every y variable, computed in the
+    # background when a worker starts
+    full_range = [int(gap_engine.keys[0]), int(gap_engine.keys[-1])]
+    selections = [list(cont_names)] + [[c] for c in cont_names]
+    prerender.warm(update_graph, [(c, full_range) for c in selections[1:]])
+    prerender.warm(update_map, [(c, full_range, y) for c in selections
+                                for y in ('lifeExp', 'pop', 'gdpPercap')])
+
+# the filtered rows as CSV, Arrow or Parquet (utils/export.py)
+export.register('task123', 'gapminder', {'cont_dropdown': 'continent'}, key_range='pop_range')
+layout.children.append(export.links(app, 'task123', graph_inputs))
 
 # needed only if running this as a single page app
 #if __name__ == '__main__':
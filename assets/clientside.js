@@ -0,0 +1,452 @@
+// clientside callbacks, served automatically by dash from the assets folder
+window.dash_clientside = Object.assign({}, window.dash_clientside);
+
+(function () {
+    // callback requests carry an id of this tab, utils/flights.py drops the
+    // ones a newer request of the same tab and callback has superseded
+    var TAB_ID = Math.random().toString(36).slice(2) + Date.now().toString(36);
+    var fetch = window.fetch;
+    window.fetch = function (input, init) {
+        if (typeof input === 'string' && input.indexOf('_dash-update-component') >= 0) {
+            init = Object.assign({}, init);
+            var headers = new Headers(init.headers || {});
+            headers.set('X-Dash-Tab', TAB_ID);
+            init.headers = headers;
+        }
+        return fetch.call(this, input, init);
+    };
+
+    var TYPED = {
+        i1: Int8Array, u1: Uint8Array, i2: Int16Array, u2: Uint16Array,
+        i4: Int32Array, u4: Uint32Array, f4: Float32Array, f8: Float64Array
+    };
+
+    // base64 typed array {dtype, bdata} -> javascript typed array
+    function decodeArray(obj) {
+        var bin = atob(obj.bdata);
+        var bytes = new Uint8Array(bin.length);
+        for (var i = 0; i < bin.length; i++) {
+            bytes[i] = bin.charCodeAt(i);
+        }
+        return new TYPED[obj.dtype](bytes.buffer);
+    }
+
+    // decoded stores, so the base64 is only unpacked once per page load
+    var decoded = new WeakMap();
+
+    function unpack(store) {
+        if (decoded.has(store)) {
+            return decoded.get(store);
+        }
+        var cols = {};
+        Object.keys(store.columns).forEach(function (name) {
+            cols[name] = decodeArray(store.columns[name]);
+        });
+        var data = {n: store.n, cols: cols, categories: store.categories};
+        decoded.set(store, data);
+        return data;
+    }
+
+    function clone(obj) {
+        return JSON.parse(JSON.stringify(obj));
+    }
+
+    function baseLayout(store, name) {
+        var layout = clone(store.layouts[name]);
+        layout.template = store.template;
+        return layout;
+    }
+
+    // row indices inside the population range whose `col` value is selected,
+    // grouped in the order of the selection and then in row order
+    function filterRows(d, col, selected, range) {
+        var cats = d.categories[col];
+        var rank = new Int32Array(cats.length).fill(-1);
+        selected.forEach(function (name, i) {
+            var code = cats.indexOf(name);
+            if (code >= 0 && rank[code] < 0) {
+                rank[code] = i;
+            }
+        });
+        var buckets = selected.map(function () { return []; });
+        var pop = d.cols.pop, codes = d.cols[col];
+        for (var i = 0; i < d.n; i++) {
+            var r = rank[codes[i]];
+            if (r >= 0 && pop[i] >= range[0] && pop[i] <= range[1]) {
+                buckets[r].push(i);
+            }
+        }
+        return [].concat.apply([], buckets);
+    }
+
+    function uniqueValues(values, rows) {
+        var seen = {}, out = [];
+        rows.forEach(function (i) {
+            var v = values[i];
+            if (!seen.hasOwnProperty(v)) {
+                seen[v] = true;
+                out.push(v);
+            }
+        });
+        return out;
+    }
+
+    function take(values, rows, cats) {
+        return rows.map(function (i) {
+            return cats ? cats[values[i]] : values[i];
+        });
+    }
+
+    function sliderSteps(years, redraw) {
+        return years.map(function (y) {
+            return {
+                args: [[String(y)], {
+                    frame: {duration: 0, redraw: redraw}, mode: 'immediate',
+                    fromcurrent: true, transition: {duration: 0, easing: 'linear'}
+                }],
+                label: String(y),
+                method: 'animate'
+            };
+        });
+    }
+
+    function animated(frames, years, layout, redraw) {
+        layout.sliders[0].steps = sliderSteps(years, redraw);
+        layout.sliders[0].active = 0;
+        return {data: frames.length ? frames[0].data : [], layout: layout, frames: frames};
+    }
+
+    function scatterFigure(store, selected, range) {
+        var d = unpack(store);
+        var c = d.cols, cont = d.categories.continent, country = d.categories.country;
+        var rows = filterRows(d, 'continent', selected, range);
+        var years = uniqueValues(c.year, rows).sort(function (a, b) { return a - b; });
+        var groups = uniqueValues(c.continent, rows);
+        var maxPop = 0;
+        rows.forEach(function (i) { maxPop = Math.max(maxPop, c.pop[i]); });
+        var sizeref = maxPop / (60 * 60);
+        var frames = years.map(function (year) {
+            return {
+                name: String(year),
+                data: groups.map(function (g) {
+                    var sub = rows.filter(function (i) { return c.year[i] === year && c.continent[i] === g; });
+                    var name = cont[g];
+                    return {
+                        type: 'scatter', mode: 'markers', name: name, legendgroup: name,
+                        showlegend: true, orientation: 'v', xaxis: 'x', yaxis: 'y',
+                        x: take(c.gdpPercap, sub), y: take(c.lifeExp, sub),
+                        hovertext: take(c.country, sub, country), ids: take(c.country, sub, country),
+                        marker: {
+                            color: store.colors[name], size: take(c.pop, sub),
+                            sizemode: 'area', sizeref: sizeref, symbol: 'circle'
+                        },
+                        hovertemplate: '<b>%{hovertext}</b><br><br>Continent=' + name +
+                            '<br>Year=' + year + '<br>GDP/Capita=%{x}<br>Life Expectancy=%{y}' +
+                            '<br>Population=%{marker.size}<extra></extra>'
+                    };
+                })
+            };
+        });
+        return animated(frames, years, baseLayout(store, 'scatter'), false);
+    }
+
+    function mapFigure(store, selected, range, yvar) {
+        var d = unpack(store);
+        var c = d.cols, labels = store.labels;
+        var rows = filterRows(d, 'continent', selected, range);
+        var years = uniqueValues(c.year, rows).sort(function (a, b) { return a - b; });
+        var label = labels[yvar] || yvar;
+        var zmin = Infinity, zmax = -Infinity;
+        rows.forEach(function (i) {
+            zmin = Math.min(zmin, c[yvar][i]);
+            zmax = Math.max(zmax, c[yvar][i]);
+        });
+        var frames = years.map(function (year) {
+            var sub = rows.filter(function (i) { return c.year[i] === year; });
+            return {
+                name: String(year),
+                data: [{
+                    type: 'choropleth', geo: 'geo', coloraxis: 'coloraxis', name: '',
+                    locations: take(c.iso_alpha, sub, d.categories.iso_alpha),
+                    z: take(c[yvar], sub),
+                    hovertext: take(c.country, sub, d.categories.country),
+                    customdata: sub.map(function (i) {
+                        return [d.categories.continent[c.continent[i]], c.pop[i]];
+                    }),
+                    hovertemplate: '<b>%{hovertext}</b><br><br>Year=' + year +
+                        '<br>iso_alpha=%{location}<br>Continent=%{customdata[0]}' +
+                        '<br>Population=%{customdata[1]}<br>' + label + '=%{z}<extra></extra>'
+                }]
+            };
+        });
+        var layout = baseLayout(store, 'map');
+        if (rows.length) {
+            layout.coloraxis.cmin = zmin;
+            layout.coloraxis.cmax = zmax;
+        }
+        layout.coloraxis.colorbar.title.text = label;
+        return animated(frames, years, layout, true);
+    }
+
+    function lineFigure(store, selected, range, yvar) {
+        var d = unpack(store);
+        var c = d.cols, labels = store.labels;
+        var rows = filterRows(d, 'continent', selected, range);
+        var label = labels[yvar] || yvar;
+        // one trace per country, the legend shows each continent once
+        var lines = {}, order = [];
+        rows.forEach(function (i) {
+            var key = c.country[i];
+            if (!lines.hasOwnProperty(key)) {
+                lines[key] = [];
+                order.push(key);
+            }
+            lines[key].push(i);
+        });
+        var shown = {};
+        var data = order.map(function (key) {
+            var sub = lines[key];
+            var name = d.categories.continent[c.continent[sub[0]]];
+            var first = !shown[name];
+            shown[name] = true;
+            return {
+                type: 'scatter', mode: 'lines', name: name, legendgroup: name,
+                showlegend: first, orientation: 'v', xaxis: 'x', yaxis: 'y',
+                x: take(c.year, sub), y: take(c[yvar], sub),
+                hovertext: take(c.country, sub, d.categories.country),
+                customdata: sub.map(function (i) { return [c.pop[i]]; }),
+                line: {color: store.colors[name], dash: 'solid'},
+                marker: {symbol: 'circle'},
+                hovertemplate: '<b>%{hovertext}</b><br><br>Continent=' + name + '<br>Country=' +
+                    d.categories.country[key] + '<br>Year=%{x}<br>' + label +
+                    '=%{y}<br>Population=%{customdata[0]}<extra></extra>'
+            };
+        });
+        var layout = baseLayout(store, 'line');
+        layout.yaxis.title.text = label;
+        return {data: data, layout: layout};
+    }
+
+    window.dash_clientside.task123 = {
+        update_graph: function (selected, range, store) {
+            if (!selected || !selected.length) {
+                return window.dash_clientside.no_update;
+            }
+            return scatterFigure(store, selected, range);
+        },
+        update_map: function (selected, range, yvar, store) {
+            if (!(selected || range || yvar)) {
+                return window.dash_clientside.no_update;
+            }
+            selected = selected || [];
+            return [mapFigure(store, selected, range, yvar), lineFigure(store, selected, range, yvar)];
+        }
+    };
+
+    // figures packed by utils/figpack.py: arrays are moved into a shared
+    // table and numeric ones are base64 typed arrays
+    function decodeEntry(entry) {
+        if (entry.values) {
+            return entry.values;
+        }
+        var flat = Array.from(decodeArray(entry));
+        if (entry.decimals) {
+            var scale = Math.pow(10, entry.decimals);
+            flat = flat.map(function (v) { return v / scale; });
+        }
+        if (!entry.shape || entry.shape.length < 2) {
+            return flat;
+        }
+        var width = entry.shape[1], rows = [];
+        for (var r = 0; r < entry.shape[0]; r++) {
+            rows.push(flat.slice(r * width, (r + 1) * width));
+        }
+        return rows;
+    }
+
+    // resolves the table references of packed objects, decoding each array once
+    function resolver(entries) {
+        var arrays = {};
+
+        function walk(obj) {
+            if (Array.isArray(obj)) {
+                return obj.map(walk);
+            }
+            if (obj && typeof obj === 'object') {
+                if (obj.hasOwnProperty('__ref')) {
+                    var i = obj.__ref;
+                    if (!arrays.hasOwnProperty(i)) {
+                        arrays[i] = decodeEntry(entries[i]);
+                    }
+                    return arrays[i];
+                }
+                if (obj.hasOwnProperty('__columns')) {
+                    // rebuild row-wise arrays such as customdata
+                    var cols = obj.__columns.map(walk);
+                    return cols[0].map(function (_, r) {
+                        return cols.map(function (col) { return col[r]; });
+                    });
+                }
+                if (obj.hasOwnProperty('__template')) {
+                    return (window.figpackTemplates || {})[obj.__template];
+                }
+                var out = {};
+                Object.keys(obj).forEach(function (k) {
+                    out[k] = walk(obj[k]);
+                });
+                return out;
+            }
+            return obj;
+        }
+        return walk;
+    }
+
+    function unpackFigure(packed) {
+        var fig = resolver(packed.arrays)(packed.figure);
+        // frame traces only hold what changed since the previous frame
+        var prev = fig.data || [];
+        (fig.frames || []).forEach(function (frame) {
+            if (!frame.data) {
+                return;
+            }
+            frame.data = frame.data.map(function (trace, j) {
+                return trace.__delta ? Object.assign({}, prev[j], trace.__delta) : trace;
+            });
+            prev = frame.data;
+        });
+        return fig;
+    }
+
+    // figures sent with their first frame only (utils/frames.py): the other
+    // frames are fetched from stream.url + index, the next one right away and
+    // then the one the slider or the play button moves to plus the one after
+    var streams = {};
+
+    function frameIndex(gd, name) {
+        var frames = gd._transitionData ? gd._transitionData._frames : [];
+        for (var i = 0; i < frames.length; i++) {
+            if (String(frames[i].name) === String(name)) {
+                return i;
+            }
+        }
+        return -1;
+    }
+
+    function fetchFrame(stream, index) {
+        if (index < 1 || index >= stream.count || stream.asked[index]) {
+            return;
+        }
+        stream.asked[index] = true;
+        fetch(stream.url + index).then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        }).then(function (body) {
+            var gd = stream.gd;
+            if (streams[stream.graph] !== stream || !gd || !gd._transitionData) {
+                return;
+            }
+            Object.keys(body.arrays).forEach(function (i) {
+                stream.arrays[i] = body.arrays[i];
+            });
+            var frame = resolver(stream.arrays)(body.frame);
+            return window.Plotly.addFrames(gd, [frame]).then(function () {
+                var slider = (gd.layout.sliders || [])[0];
+                // the frame was asked for while it was shown empty
+                if (slider && slider.active === index && !gd._transitionData._frameQueue.length) {
+                    window.Plotly.animate(gd, [frame.name], {
+                        mode: 'immediate', frame: {duration: 0, redraw: true},
+                        transition: {duration: 0}
+                    });
+                }
+            });
+        }).catch(function () {
+            stream.asked[index] = false;
+        });
+    }
+
+    function follow(stream, name) {
+        var index = frameIndex(stream.gd, name);
+        fetchFrame(stream, index);
+        fetchFrame(stream, index + 1);
+    }
+
+    function startStream(graph, stream, tries) {
+        var gd = document.querySelector('#' + CSS.escape(graph) + ' .js-plotly-plot');
+        if (streams[graph] !== stream) {
+            return;
+        }
+        if (!gd || !gd.on || frameIndex(gd, stream.first) < 0) {
+            // not drawn yet
+            if (tries > 0) {
+                setTimeout(function () { startStream(graph, stream, tries - 1); }, 50);
+            }
+            return;
+        }
+        stream.gd = gd;
+        if (!gd.__frameStream) {
+            gd.__frameStream = true;
+            gd.on('plotly_sliderchange', function (event) {
+                var s = streams[graph];
+                if (s && s.gd === gd) {
+                    follow(s, event.step.args[0][0]);
+                }
+            });
+            gd.on('plotly_animatingframe', function (event) {
+                var s = streams[graph];
+                if (s && s.gd === gd) {
+                    follow(s, event.name);
+                }
+            });
+        }
+        fetchFrame(stream, 1);
+    }
+
+    window.dash_clientside.figpack = {
+        unpack: function (packed) {
+            if (!packed) {
+                return window.dash_clientside.no_update;
+            }
+            var fig = unpackFigure(packed);
+            if (packed.stream) {
+                // the graph of the store (<graph>_packed) this figure came through
+                var input = window.dash_clientside.callback_context.inputs_list[0];
+                var graph = input.id.replace(/_packed$/, '');
+                var stream = {
+                    graph: graph, url: packed.stream.url, count: packed.stream.count,
+                    first: fig.frames[0].name, arrays: packed.arrays.slice(), asked: {}
+                };
+                streams[graph] = stream;
+                setTimeout(function () { startStream(graph, stream, 100); }, 0);
+            }
+            return fig;
+        }
+    };
+
+    // the download links of a page (utils/export.py) follow its controls:
+    // every value becomes a query parameter named after its control, an
+    // emptied dropdown is sent empty so the export matches no rows either
+    window.dash_clientside.export = {
+        hrefs: function () {
+            var ctx = window.dash_clientside.callback_context;
+            var query = [];
+            ctx.inputs_list.forEach(function (input) {
+                var values = input.value;
+                if (values === null || values === undefined) {
+                    return;
+                }
+                values = Array.isArray(values) ? values : [values];
+                if (!values.length) {
+                    values = [''];
+                }
+                values.forEach(function (value) {
+                    query.push(encodeURIComponent(input.id) + '=' + encodeURIComponent(value));
+                });
+            });
+            return ctx.states_list.map(function (state) {
+                return state.value.split('?')[0] + (query.length ? '?' + query.join('&') : '');
+            });
+        }
+    };
+})();
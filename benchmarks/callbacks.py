@@ -0,0 +1,219 @@
+# benchmark of the page callbacks over a grid of inputs and dataset sizes
+#   python -m benchmarks.callbacks [--scales 1 10 100 1000] [--repeat 3]
+#                                  [--out results.json] [--compare old.json]
+# Each callback is called directly (no HTTP, no figure cache) for every
+# combination of: all or one continent / country / county, the full or a
+# narrow population (or pass) range, and each y variable. Every scale runs in
+# its own process on a synthetic gapminder (GAPMINDER_SCALE) and shots CSV of
+# that size. Times are medians of --repeat calls after a warm-up call:
+#   filter     the selection the callback starts with
+#   figure     the rest of the callback, building the figure(s)
+#   serialize  figpack packing plus the JSON encoding Dash does
+# Peak memory is the tracemalloc peak of one callback plus its serialization
+# in the calling process (figures built in a process pool are not counted,
+# run with FIGURE_EXECUTOR=serial to include them).
+import argparse
+import datetime
+import gzip
+import importlib
+import inspect
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+
+SCALES = [1, 10, 100, 1000]
+# shots in the synthetic dashboard data at scale 1
+SHOTS_ROWS = 5000
+# seconds one scale may take before its remaining cases are skipped
+TIMEOUT = 1800
+
+
+def callbacks():
+    # (name, callback, filter, packed, grid of labelled inputs)
+    importlib.import_module('plotly.io')  # imported before timing starts
+    task123 = importlib.import_module('apps.task123')
+    europe = importlib.import_module('apps.Europe')
+    dashboard = importlib.import_module('apps.dashboard')
+    gap = task123.gap_engine
+    shots = dashboard.shot_engine
+    continents = {'all': list(task123.cont_names), 'one': ['Europe']}
+    countries = {'all': list(europe.country_names), 'one': ['Ireland']}
+    pops = {'full': [int(gap.keys[0]), int(gap.keys[-1])], 'narrow': [1000000, 10000000]}
+    yvars = {y: y for y in ('lifeExp', 'pop', 'gdpPercap')}
+    counties = {'all': list(dashboard.county_names()), 'one': list(dashboard.county_names()[:1])}
+    passes = {'full': [0, 29], 'narrow': [3, 8]}
+    return [
+        ('task123.update_graph', task123.update_graph,
+         lambda conts, pop: gap.select(pop, continent=conts), True,
+         [('continents', continents), ('pop', pops)]),
+        ('task123.update_map', task123.update_map,
+         lambda conts, pop, yvar: gap.select(pop, continent=conts), True,
+         [('continents', continents), ('pop', pops), ('y', yvars)]),
+        ('Europe.update_graphs', europe.update_graphs,
+         lambda count, pop, yvar: gap.select(pop, country=count), True,
+         [('countries', countries), ('pop', pops), ('y', yvars)]),
+        ('dashboard.update_graph', dashboard.update_graph,
+         lambda cnt, rng, relayout: shots.take(shots.positions(rng, county=cnt)), False,
+         [('counties', counties), ('passes', passes), ('zoom', {'none': None})]),
+    ]
+
+
+def serialize(result, packed):
+    import plotly.io as pio
+    from utils import figpack
+    figures = result if isinstance(result, (list, tuple)) else [result]
+    if packed and figpack.FIGURE_PACKING:
+        figures = [figpack.pack(f) for f in figures]
+    return pio.json.to_json_plotly(figures).encode()
+
+
+def run_scale(scale, repeat, out):
+    # child process: one JSON line per case appended to out
+    from utils import pipeline
+    for name, callback, select, packed, grid in callbacks():
+        func = inspect.unwrap(callback)
+        labels = [label for label, _ in grid]
+        for combo in itertools.product(*[list(values.items()) for _, values in grid]):
+            inputs = dict(zip(labels, [key for key, _ in combo]))
+            args = [value for _, value in combo]
+            rows = len(select(*args))
+            serialize(func(*args), packed)
+            times = {'filter': [], 'callback': [], 'serialize': []}
+            for _ in range(repeat):
+                start = time.perf_counter()
+                select(*args)
+                times['filter'].append(time.perf_counter() - start)
+                # every call computes its stages, none is served from their cache
+                pipeline.clear()
+                start = time.perf_counter()
+                result = func(*args)
+                times['callback'].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                body = serialize(result, packed)
+                times['serialize'].append(time.perf_counter() - start)
+            pipeline.clear()
+            tracemalloc.start()
+            serialize(func(*args), packed)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            filter_s = statistics.median(times['filter'])
+            callback_s = statistics.median(times['callback'])
+            serialize_s = statistics.median(times['serialize'])
+            record = {
+                'callback': name, 'scale': scale, 'inputs': inputs, 'rows': rows,
+                'filter_ms': filter_s * 1e3,
+                'figure_ms': max(callback_s - filter_s, 0) * 1e3,
+                'serialize_ms': serialize_s * 1e3,
+                'total_ms': (callback_s + serialize_s) * 1e3,
+                'peak_mb': peak / 1e6,
+                'bytes': len(body),
+                'bytes_gzip': len(gzip.compress(body, 6)),
+            }
+            with open(out, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            print('%-24s x%-5d %-40s %9.1f ms' % (name, scale, _label(inputs), record['total_ms']),
+                  flush=True)
+
+
+def _label(inputs):
+    return ' '.join('%s=%s' % kv for kv in inputs.items())
+
+
+def _key(record):
+    return record['callback'], record['scale'], _label(record['inputs'])
+
+
+def _meta():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                             capture_output=True, text=True).stdout.strip()
+    except OSError:
+        rev = None
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git': rev or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'env': {k: os.environ[k] for k in ('FIGURE_EXECUTOR', 'FIGURE_WORKERS', 'FIGURE_TEMPLATES',
+                                           'FIGURE_PACKING') if k in os.environ},
+    }
+
+
+def compare(old, new):
+    before = {_key(r): r for r in old['results']}
+    print('\n%-24s %-6s %-40s %10s %10s %8s' % ('callback', 'scale', 'inputs', 'old ms',
+                                               'new ms', 'change'))
+    for record in new['results']:
+        prev = before.get(_key(record))
+        if prev is None:
+            continue
+        change = record['total_ms'] / prev['total_ms'] - 1 if prev['total_ms'] else 0.0
+        print('%-24s x%-5d %-40s %10.1f %10.1f %+7.0f%%%s'
+              % (record['callback'], record['scale'], _label(record['inputs']), prev['total_ms'],
+                 record['total_ms'], change * 100, '  <-- slower' if change > 0.1 else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the page callbacks')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    parser.add_argument('--out', help='results file (default benchmarks/results/<date>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--child-out', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child is not None:
+        run_scale(args.child, args.repeat, args.child_out)
+        return
+
+    from utils import synthetic
+    results = []
+    skipped = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in args.scales:
+            csv = os.path.join(tmp, 'shots_%d.csv' % scale)
+            synthetic.shots(SHOTS_ROWS * scale).to_csv(csv, index=False)
+            lines = os.path.join(tmp, 'results_%d.jsonl' % scale)
+            env = dict(os.environ, GAPMINDER_SCALE=str(scale), SHOTS_CSV=csv,
+                       SHOTS_CACHE=os.path.join(tmp, 'shots_%d_columns' % scale),
+                       FIGURE_CACHE='0', CLIENTSIDE_FILTERING='0')
+            env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+            try:
+                subprocess.run([sys.executable, '-m', 'benchmarks.callbacks', '--child', str(scale),
+                                '--child-out', lines, '--repeat', str(args.repeat)],
+                               cwd=ROOT, env=env, timeout=args.timeout, check=True)
+            except subprocess.TimeoutExpired:
+                skipped[scale] = 'timed out after %.0fs' % args.timeout
+            except subprocess.CalledProcessError as e:
+                skipped[scale] = 'failed with exit code %d' % e.returncode
+            if os.path.exists(lines):
+                with open(lines) as f:
+                    results.extend(json.loads(line) for line in f)
+            if scale in skipped:
+                print('scale x%d: %s, remaining cases skipped' % (scale, skipped[scale]))
+    run = {'meta': _meta(), 'skipped': skipped, 'results': results}
+    out = args.out or os.path.join(RESULTS, 'callbacks-%s.json'
+                                   % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(run, f, indent=1)
+    print('results written to %s' % out)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), run)
+
+
+if __name__ == '__main__':
+    main()
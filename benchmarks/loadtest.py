@@ -0,0 +1,474 @@
+# load test of the app under gunicorn, replaying browser callback traffic
+#   python -m benchmarks.loadtest [--workers 1 2 4] [--threads 1 4] [--users 8]
+#                                 [--duration 60] [--scale 10] [--compare old.json]
+# For every workers x threads combination index:server is started under
+# gunicorn (gunicorn.conf.py, so with the datasets preloaded) on a local
+# port, and --users virtual users run browser sessions against it for
+# --duration seconds. A session opens a page the way Dash does (page HTML,
+# _dash-layout, _dash-dependencies, display_page, then every server callback
+# of the new layout), then changes its controls: dropdowns get a new
+# selection and range sliders are dragged, a few requests fired while the
+# previous ones are still running. Which callbacks a change fires is read
+# from _dash-dependencies, as the Dash renderer does. The report gives
+# throughput, p50/p95/p99 latency overall and per callback, errors, and the
+# peak RSS of each gunicorn worker (with its figure pool). The load runs in
+# this process, on a small machine it competes with the workers for CPU.
+import argparse
+import datetime
+import gzip
+import http.client
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import callbacks
+
+ROOT = callbacks.ROOT
+RESULTS = callbacks.RESULTS
+
+PAGES = ['/task123', '/dashboard']
+# seconds a user waits between two changes, on average
+THINK = 1.0
+# changes before the user starts a new session
+ACTIONS = 10
+# requests sent for one slider drag, DRAG_GAP seconds apart
+DRAG_STEPS = 4
+DRAG_GAP = 0.1
+
+
+class Client:
+    # one browser tab: its own connection, cookies and tab id (utils/flights.py)
+
+    def __init__(self, port):
+        self.port = port
+        self.cookie = None
+        self.tab = '%016x' % random.getrandbits(64)
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        headers = {'Accept-Encoding': 'gzip', 'X-Dash-Tab': self.tab}
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=120)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # gunicorn's sync workers close the connection after each answer
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    raise
+        if response.getheader('Connection', '').lower() == 'close':
+            self.conn.close()
+            self.conn = None
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';', 1)[0]
+        if response.getheader('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        return response.status, data
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+class Recorder:
+
+    def __init__(self):
+        self.samples = []
+        self.errors = {}
+        self.start = None
+        self._lock = threading.Lock()
+
+    def add(self, kind, seconds, status, size):
+        with self._lock:
+            if self.start is None:
+                return
+            if status >= 400 or status == 0:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+            else:
+                self.samples.append((kind, seconds, size))
+
+
+class Session:
+    # a user on one page, keeping the values of the page's controls
+
+    def __init__(self, port, page, deps, recorder, rng):
+        self.client = Client(port)
+        self.page = page
+        self.deps = deps
+        self.recorder = recorder
+        self.rng = rng
+        self.values = {}
+        self.controls = {}
+
+    def timed(self, kind, method, path, body=None, client=None):
+        start = time.perf_counter()
+        try:
+            status, data = (client or self.client).request(method, path, body)
+        except (OSError, http.client.HTTPException):
+            status, data = 0, b''
+        self.recorder.add(kind, time.perf_counter() - start, status, len(data))
+        return status, data
+
+    def load(self):
+        self.timed('page', 'GET', self.page)
+        self.timed('layout', 'GET', '/_dash-layout')
+        self.timed('dependencies', 'GET', '/_dash-dependencies')
+        self.values = {('url', 'pathname'): self.page}
+        status, data = self.fire([('url', 'pathname')])
+        if status == 200:
+            content = json.loads(data)['response']['page-content']['children']
+            self.walk(content)
+            self.fire([k for k in self.values if k[0] != 'url'], initial=True)
+
+    def walk(self, component):
+        if isinstance(component, list):
+            for child in component:
+                self.walk(child)
+            return
+        if not isinstance(component, dict) or 'props' not in component:
+            return
+        props = component['props']
+        cid = props.get('id')
+        if isinstance(cid, str):
+            for prop, value in props.items():
+                if prop not in ('children', 'id', 'style'):
+                    self.values[cid, prop] = value
+            if 'options' in props and 'value' in props:
+                self.controls[cid] = ('dropdown', props)
+            elif 'min' in props and 'max' in props and isinstance(props.get('value'), list):
+                self.controls[cid] = ('range', props)
+        self.walk(props.get('children'))
+
+    def fire(self, changed, initial=False, client=None):
+        # every server callback with a changed input, as the renderer does
+        status, data = 0, b''
+        for dep in self.deps:
+            if dep.get('clientside_function'):
+                continue
+            inputs = [(i['id'], i['property']) for i in dep['inputs']]
+            if not set(inputs) & set(changed):
+                continue
+            if initial and not all(i[0] in {k[0] for k in self.values} for i in inputs):
+                continue
+            body = {'output': dep['output'],
+                    'outputs': _outputs(dep['output']),
+                    'inputs': [{'id': i, 'property': p, 'value': self.values.get((i, p))}
+                               for i, p in inputs],
+                    'changedPropIds': ['%s.%s' % k for k in changed if k in inputs]}
+            if dep.get('state'):
+                body['state'] = [{'id': s['id'], 'property': s['property'],
+                                  'value': self.values.get((s['id'], s['property']))}
+                                 for s in dep['state']]
+            status, data = self.timed(_name(dep['output']), 'POST', '/_dash-update-component',
+                                      body, client)
+        return status, data
+
+    def act(self):
+        cid = self.rng.choice(sorted(self.controls))
+        kind, props = self.controls[cid]
+        if kind == 'dropdown':
+            options = [o['value'] if isinstance(o, dict) else o for o in props['options']]
+            if not options:
+                return
+            if props.get('multi'):
+                value = self.rng.sample(options, self.rng.randint(1, len(options)))
+            else:
+                value = self.rng.choice(options)
+            self.values[cid, 'value'] = value
+            self.fire([(cid, 'value')])
+        else:
+            self.drag(cid, props)
+
+    def drag(self, cid, props):
+        # one end of the slider moved in a few steps, each step fired without
+        # waiting for the one before, on its own connection
+        lo, hi = self.values.get((cid, 'value')) or [props['min'], props['max']]
+        end = self.rng.randrange(2)
+        target = self.rng.uniform(props['min'], props['max'])
+        threads = []
+        for step in range(1, DRAG_STEPS + 1):
+            point = [lo, hi]
+            point[end] += (target - point[end]) * step / DRAG_STEPS
+            point = sorted(round(v) for v in point)
+            self.values[cid, 'value'] = point
+            client = Client(self.client.port)
+            client.cookie = self.client.cookie
+            t = threading.Thread(target=self.fire, args=([(cid, 'value')], False, client))
+            t.start()
+            threads.append((t, client))
+            time.sleep(DRAG_GAP)
+        for t, client in threads:
+            t.join()
+            client.close()
+
+
+def _outputs(output):
+    # "..a.b...c.d.." for several outputs, "a.b" for one
+    if output.startswith('..'):
+        return [_output(o) for o in output[2:-2].split('...')]
+    return _output(output)
+
+
+def _output(output):
+    cid, prop = output.rsplit('.', 1)
+    return {'id': cid, 'property': prop}
+
+
+def _name(output):
+    return output.strip('.').split('...')[0]
+
+
+def user(port, deps, recorder, stop, seed, pages, think, actions):
+    rng = random.Random(seed)
+    while not stop.is_set():
+        session = Session(port, rng.choice(pages), deps, recorder, rng)
+        try:
+            session.load()
+            for _ in range(actions):
+                if stop.wait(rng.expovariate(1 / think) if think else 0):
+                    break
+                if session.controls:
+                    session.act()
+        except Exception as e:
+            # counted as an error, the user starts a new session
+            recorder.add('session: %s' % type(e).__name__, 0, 0, 0)
+        finally:
+            session.client.close()
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _children(pid):
+    # processes whose parent is pid, from /proc (Linux only)
+    out = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name in parentheses may contain spaces
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            out.append(int(name))
+    return out
+
+
+def _rss(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def start_server(workers, threads, env, timeout=300):
+    port = _free_port()
+    cmd = [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+           '--workers', str(workers), '--threads', str(threads),
+           '--bind', '127.0.0.1:%d' % port, '--timeout', '300', '--log-level', 'warning',
+           'index:server']
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('gunicorn exited with code %d' % proc.returncode)
+        try:
+            status, data = Client(port).request('GET', '/_dash-dependencies')
+            if status == 200 and len(_children(proc.pid)) >= workers:
+                return proc, port, json.loads(data)
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.5)
+    stop_server(proc)
+    raise RuntimeError('gunicorn not answering after %ds' % timeout)
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def run(workers, threads, args, env):
+    proc, port, deps = start_server(workers, threads, env)
+    recorder = Recorder()
+    stop = threading.Event()
+    peak = {}
+    try:
+        users = [threading.Thread(target=user, daemon=True,
+                                  args=(port, deps, recorder, stop, seed, args.pages,
+                                        args.think, args.actions))
+                 for seed in range(args.users)]
+        for t in users:
+            t.start()
+        # the first sessions warm up the workers and are not counted
+        time.sleep(args.warmup)
+        with recorder._lock:
+            recorder.start = time.perf_counter()
+        end = recorder.start + args.duration
+        while time.perf_counter() < end:
+            for pid in _children(proc.pid):
+                # a worker with its figure pool, if it has one
+                rss = _rss(pid) + sum(_rss(c) for c in _children(pid))
+                peak[pid] = max(peak.get(pid, 0), rss)
+            time.sleep(0.5)
+        with recorder._lock:
+            elapsed = time.perf_counter() - recorder.start
+            samples = list(recorder.samples)
+            errors = dict(recorder.errors)
+        stop.set()
+        for t in users:
+            t.join(120)
+    finally:
+        stop_server(proc)
+    return report(workers, threads, args, samples, errors, elapsed, peak)
+
+
+def report(workers, threads, args, samples, errors, elapsed, peak):
+    posts = [s for s in samples if s[0] not in ('page', 'layout', 'dependencies')]
+    out = {'workers': workers, 'threads': threads, 'users': args.users,
+           'seconds': elapsed, 'requests': len(samples), 'callbacks': len(posts),
+           'errors': sum(errors.values()), 'errors_by_kind': errors,
+           'throughput': len(samples) / elapsed if elapsed else 0.0,
+           'callbacks_per_s': len(posts) / elapsed if elapsed else 0.0,
+           'latency_ms': _percentiles([s[1] for s in posts]),
+           'worker_rss_mb': sorted(round(v / 2 ** 20, 1) for v in peak.values()),
+           'by_callback': {}}
+    for kind, group in itertools.groupby(sorted(samples), key=lambda s: s[0]):
+        group = list(group)
+        out['by_callback'][kind] = dict(_percentiles([s[1] for s in group]),
+                                        requests=len(group),
+                                        bytes=statistics.mean(s[2] for s in group))
+    return out
+
+
+def _percentiles(seconds):
+    if not seconds:
+        return {'p50': None, 'p95': None, 'p99': None}
+    values = sorted(seconds)
+
+    def pick(q):
+        return values[min(int(q * len(values)), len(values) - 1)] * 1e3
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99)}
+
+
+def _ms(value):
+    return '%9.1f' % value if value is not None else '%9s' % '-'
+
+
+def show(result):
+    lat = result['latency_ms']
+    print('\nworkers=%d threads=%d users=%d: %.1f req/s, %.1f callbacks/s, %d errors'
+          % (result['workers'], result['threads'], result['users'], result['throughput'],
+             result['callbacks_per_s'], result['errors']))
+    print('  callback latency p50 %s  p95 %s  p99 %s ms' % (_ms(lat['p50']), _ms(lat['p95']),
+                                                           _ms(lat['p99'])))
+    print('  worker RSS (MB): %s' % ', '.join('%.0f' % v for v in result['worker_rss_mb']))
+    print('  %-28s %8s %9s %9s %9s %10s' % ('request', 'count', 'p50 ms', 'p95 ms', 'p99 ms',
+                                            'bytes'))
+    for kind, s in sorted(result['by_callback'].items()):
+        print('  %-28s %8d %s %s %s %10.0f' % (kind[:28], s['requests'], _ms(s['p50']),
+                                               _ms(s['p95']), _ms(s['p99']), s['bytes']))
+
+
+def compare(old, new):
+    before = {(r['workers'], r['threads'], r['users']): r for r in old['results']}
+    print('\n%-22s %12s %12s %12s %12s' % ('workers/threads/users', 'old req/s', 'new req/s',
+                                           'old p95 ms', 'new p95 ms'))
+    for r in new['results']:
+        key = (r['workers'], r['threads'], r['users'])
+        prev = before.get(key)
+        if prev is None:
+            continue
+        slower = (r['throughput'] < prev['throughput'] * 0.9 or
+                  (r['latency_ms']['p95'] or 0) > (prev['latency_ms']['p95'] or 0) * 1.1)
+        print('%-22s %12.1f %12.1f %s    %s%s' % ('%d/%d/%d' % key, prev['throughput'],
+                                                 r['throughput'], _ms(prev['latency_ms']['p95']),
+                                                 _ms(r['latency_ms']['p95']),
+                                                 '  <-- slower' if slower else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test the app under gunicorn')
+    parser.add_argument('--workers', type=int, nargs='+', default=[2])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1])
+    parser.add_argument('--users', type=int, default=8, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds measured per run')
+    parser.add_argument('--warmup', type=float, default=10, help='seconds before measuring')
+    parser.add_argument('--pages', nargs='+', default=PAGES)
+    parser.add_argument('--think', type=float, default=THINK,
+                        help='mean seconds between two changes of a user')
+    parser.add_argument('--actions', type=int, default=ACTIONS,
+                        help='changes before a user opens a new session')
+    parser.add_argument('--scale', type=int,
+                        help='serve synthetic data this many times larger (see utils/synthetic.py)')
+    parser.add_argument('--out', help='results file (default benchmarks/results/<date>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.scale:
+            from utils import synthetic
+            csv = os.path.join(tmp, 'shots.csv')
+            synthetic.shots(callbacks.SHOTS_ROWS * args.scale).to_csv(csv, index=False)
+            env.update(GAPMINDER_SCALE=str(args.scale), SHOTS_CSV=csv,
+                       SHOTS_CACHE=os.path.join(tmp, 'shots_columns'))
+        for n, (workers, threads) in enumerate(itertools.product(args.workers, args.threads)):
+            # every run starts from empty shared caches
+            folder = os.path.join(tmp, 'run%d' % n)
+            env.update(FIGURE_CACHE_DIR=os.path.join(folder, 'figure_cache'),
+                       METRICS_DIR=os.path.join(folder, 'metrics'),
+                       FLIGHT_DIR=os.path.join(folder, 'flights'))
+            result = run(workers, threads, args, env)
+            show(result)
+            results.append(result)
+    meta = callbacks._meta()
+    meta['args'] = {k: v for k, v in vars(args).items() if k not in ('out', 'compare')}
+    out = args.out or os.path.join(RESULTS, 'loadtest-%s.json'
+                                   % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print('results written to %s' % out)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), {'results': results})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+# gunicorn settings, read automatically when gunicorn starts in this folder
+
+# import the app in the master before forking, together with the datasets
+# loaded in on_starting the workers then share its memory copy-on-write
+preload_app = True
+
+
+def on_starting(server):
+    from utils import catalog
+    catalog.load_all()
+    server.log.info('datasets loaded before fork: %s', catalog.memory_usage())
+
+
+def post_worker_init(worker):
+    # default page figures and common selections computed in the background
+    # (see utils/prerender.py), one worker fills the shared figure cache
+    from index import pages
+    from utils import prerender
+    from utils import refresh
+    prerender.start(pages)
+    # reload the datasets when their files change
+    refresh.start()
@@ -1,3 +1,5 @@
+import os
+
 from dash import dcc
 from dash import html
 from app import server
@@ -7,8 +9,31 @@ import dash_bootstrap_components as dbc
 # must add this line in order for the app to be deployed successfully on Heroku
 # from app import server
 from app import app
-# import all pages in the app
-from apps import dashboard, task123, Europe, home
+from utils import export
+from utils import figpack
+from utils import frames
+from utils import prerender
+from utils import profiling
+from utils import refresh
+from utils import serving
+from utils.pages import PageRegistry
+
+# pages are imported (and their data loaded) on first use, see utils/pages.py
+pages = PageRegistry(app, default='/home')
+pages.add('/home', 'apps.home')
+pages.add('/dashboard', 'apps.dashboard')
+pages.add('/task123', 'apps.task123')
+# pages.add('/Europe', 'apps.Europe')
+figpack.init_app(app)
+# FRAME_STREAMING=1 sends animated figures one frame at a time (see utils/frames.py)
+frames.init_app(app)
+# /export/<page>.csv|arrow|parquet streams the rows behind a page's controls
+export.init_app(app, pages)
+# PROFILING=1 profiles callback requests on demand (see utils/profiling.py)
+profiling.init_app(app)
+# PRELOAD_PAGES=1 imports every page in a background thread at startup
+if os.environ.get('PRELOAD_PAGES', '0') == '1':
+    pages.preload()
 
 # building the navigation bar
 # https://github.com/facultyai/dash-bootstrap-components/blob/master/examples/advanced-component-usage/Navbars.py
@@ -31,7 +56,7 @@ navbar = dbc.Navbar(
                 # Use row and col to control vertical alignment of logo / brand
                 dbc.Row(
                     [
-                        dbc.Col(html.Img(src="/assets/dkit_logo.png", height="60px")),
+                        dbc.Col(html.Img(src=serving.asset_url(app, 'dkit_logo.png'), height="60px")),
                         dbc.Col(dbc.NavbarBrand("Gealic Analysis Dashboard", className="ml-2")),
                     ],
                     align="center",
@@ -77,14 +102,10 @@ app.layout = html.Div([
 @app.callback(Output('page-content', 'children'),
               [Input('url', 'pathname')])
 def display_page(pathname):
-    if pathname == '/task123':
-        return task123.layout
-    elif pathname == '/dashboard':
-        return dashboard.layout
-    # elif pathname == '/Europe':
-    #     return Europe.layout
-    else:
-        return home.layout
+    return pages.layout(pathname)
 
 if __name__ == '__main__':
+    # gunicorn does this in post_worker_init (gunicorn.conf.py)
+    prerender.start(pages)
+    refresh.start()
     app.run_server(port = 8000, debug=True)
\ No newline at end of file
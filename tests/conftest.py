@@ -0,0 +1,14 @@
+# the app's caches and shared state go to a fresh directory per test run,
+# set before any module reads its environment variables
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp = tempfile.mkdtemp(prefix='dash-tests-')
+for name in ('FIGURE_CACHE_DIR', 'FLIGHT_DIR', 'METRICS_DIR', 'PROFILE_DIR'):
+    os.environ.setdefault(name, os.path.join(_tmp, name.lower()))
+os.environ.setdefault('WARM_CACHE', '0')
+os.environ.setdefault('REFRESH_INTERVAL', '0')
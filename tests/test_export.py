@@ -0,0 +1,101 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import index
+from utils import catalog, export
+
+CONTINENTS = ['Asia', 'Europe']
+POP = [1e6, 5e7]
+
+
+@pytest.fixture(scope='module')
+def client():
+    return index.server.test_client()
+
+
+@pytest.fixture(scope='module')
+def expected():
+    return catalog.get('gapminder').select(POP, continent=CONTINENTS)
+
+
+def query(fmt):
+    return ('/export/task123.%s?cont_dropdown=Asia&cont_dropdown=Europe'
+            '&pop_range=%d&pop_range=%d' % (fmt, POP[0], POP[1]))
+
+
+def same_rows(got, expected):
+    key = ['country', 'year']
+    got = got.sort_values(key).reset_index(drop=True)
+    expected = expected.sort_values(key).reset_index(drop=True)
+    assert list(got.columns) == list(expected.columns)
+    assert len(got) == len(expected)
+    for col in expected.columns:
+        if expected[col].dtype.kind == 'f':
+            np.testing.assert_allclose(got[col].astype(float), expected[col], rtol=1e-6)
+        else:
+            assert list(got[col].astype(str)) == list(expected[col].astype(str)), col
+
+
+def test_csv_matches_the_page_filter(client, expected):
+    r = client.get(query('csv'))
+    assert r.status_code == 200
+    assert r.mimetype == 'text/csv'
+    assert r.headers['Content-Disposition'] == 'attachment; filename="task123.csv"'
+    same_rows(pd.read_csv(io.BytesIO(r.data)), expected)
+
+
+def test_csv_blocks_share_one_header():
+    engine = catalog.get('gapminder')
+    data = b''.join(export._csv(engine, engine.blocks(size=100)))
+    assert data.count(b'country,continent') == 1
+    assert len(pd.read_csv(io.BytesIO(data))) == len(engine)
+
+
+def test_empty_selection_matches_nothing(client):
+    r = client.get('/export/task123.csv?cont_dropdown=')
+    assert r.status_code == 200
+    assert pd.read_csv(io.BytesIO(r.data)).empty
+
+
+def test_bad_requests(client):
+    assert client.get('/export/task123.csv?pop_range=1').status_code == 400
+    assert client.get('/export/task123.csv?pop_range=a&pop_range=2').status_code == 400
+    assert client.get('/export/nope.csv').status_code == 404
+    assert client.get('/export/task123.xls').status_code == 404
+
+
+def test_arrow_and_parquet_need_pyarrow(client):
+    if export.pa is not None:
+        pytest.skip('pyarrow is installed')
+    assert export.formats() == ['csv']
+    assert client.get(query('arrow')).status_code == 501
+    assert client.get(query('parquet')).status_code == 501
+
+
+def test_arrow_stream(client, expected):
+    pa = pytest.importorskip('pyarrow')
+    r = client.get(query('arrow'))
+    assert r.status_code == 200
+    table = pa.ipc.open_stream(io.BytesIO(r.data)).read_all()
+    same_rows(table.to_pandas(), expected)
+
+
+def test_parquet(client, expected):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    r = client.get(query('parquet'))
+    assert r.status_code == 200
+    same_rows(pq.read_table(io.BytesIO(r.data)).to_pandas(), expected)
+
+
+def test_arrow_blocks(expected):
+    pa = pytest.importorskip('pyarrow')
+    engine = catalog.get('gapminder')
+    data = b''.join(export._arrow(engine, engine.blocks(POP, size=50, continent=CONTINENTS)))
+    reader = pa.ipc.open_stream(io.BytesIO(data))
+    batches = list(reader)
+    assert len(batches) > 1
+    same_rows(pa.Table.from_batches(batches).to_pandas(), expected)
@@ -0,0 +1,39 @@
+from utils.figcache import FigureCache, normalize
+
+
+def test_normalize_keeps_selection_order():
+    assert normalize(['Europe', 'Asia']) == ['Europe', 'Asia']
+    assert normalize(('Asia', 'Asia')) == ['Asia', 'Asia']
+
+
+def test_normalize_whole_floats():
+    assert normalize([1.0, 2.5, [3.0, 'a']]) == [1, 2.5, [3, 'a']]
+    assert normalize(4.0) == 4 and isinstance(normalize(4.0), int)
+    assert normalize(True) is True
+
+
+def test_keys(tmp_path):
+    cache = FigureCache(path=str(tmp_path), enabled=True)
+    key = cache.key('page.update', 'v1', (['Asia', 'Europe'], [1, 2]))
+    assert key == cache.key('page.update', 'v1', (['Asia', 'Europe'], [1.0, 2.0]))
+    for other in [cache.key('page.update', 'v1', (['Europe', 'Asia'], [1, 2])),
+                  cache.key('page.update', 'v2', (['Asia', 'Europe'], [1, 2])),
+                  cache.key('page.other', 'v1', (['Asia', 'Europe'], [1, 2])),
+                  cache.key('page.update', 'v1', (['Asia', 'Europe'], [1, 3]))]:
+        assert other != key
+
+
+def test_memoize(tmp_path):
+    cache = FigureCache(path=str(tmp_path), enabled=True)
+    calls = []
+
+    @cache.memoize('f', version='v1', canonical=lambda sel, n: (sel, round(n)))
+    def f(sel, n):
+        calls.append((sel, n))
+        return {'sel': sel, 'n': n}
+
+    assert f(['b', 'a'], 1.2) == {'sel': ['b', 'a'], 'n': 1}
+    assert f(['b', 'a'], 0.9) == {'sel': ['b', 'a'], 'n': 1}
+    assert f(['a', 'b'], 1) == {'sel': ['a', 'b'], 'n': 1}
+    assert len(calls) == 2
+    assert f.cache_key(['b', 'a'], 1.4) == f.cache_key(['b', 'a'], 1)
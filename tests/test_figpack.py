@@ -0,0 +1,91 @@
+# packed figures unpacked by the browser code (assets/clientside.js, run
+# with node) give back the figure plotly would have sent
+import json
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import plotly.express as px
+import plotly.io as pio
+from plotly.utils import PlotlyJSONEncoder
+import pytest
+
+from conftest import ROOT
+from utils import catalog, figpack
+
+NODE = shutil.which('node')
+UNPACK = '''
+global.window = {atob: atob};
+require(%s);
+let input = '';
+process.stdin.on('data', chunk => input += chunk);
+process.stdin.on('end', () => {
+    const fig = window.dash_clientside.figpack.unpack(JSON.parse(input));
+    process.stdout.write(JSON.stringify(fig));
+});
+''' % json.dumps(os.path.join(ROOT, 'assets', 'clientside.js'))
+
+
+def unpack(packed):
+    # encoded as Dash encodes callback outputs
+    out = subprocess.run([NODE, '-e', UNPACK], input=json.dumps(packed, cls=PlotlyJSONEncoder), capture_output=True,
+                         text=True, check=True)
+    return json.loads(out.stdout)
+
+
+def plain(fig):
+    # the figure as plotly sends it, without the template (sent by name)
+    fig = json.loads(pio.to_json(fig))
+    fig['layout'].pop('template', None)
+    return fig
+
+
+def assert_same(got, expected, path='fig'):
+    if isinstance(expected, dict):
+        assert isinstance(got, dict) and set(got) == set(expected), path
+        for k in expected:
+            assert_same(got[k], expected[k], '%s.%s' % (path, k))
+    elif isinstance(expected, list):
+        assert isinstance(got, list) and len(got) == len(expected), path
+        for i, (g, e) in enumerate(zip(got, expected)):
+            assert_same(g, e, '%s[%d]' % (path, i))
+    elif isinstance(expected, float):
+        assert got == pytest.approx(expected, rel=1e-6), path
+    else:
+        assert got == expected, path
+
+
+@pytest.fixture(scope='module')
+def gapminder():
+    engine = catalog.get('gapminder')
+    return engine.select([1e6, 2e8], continent=['Asia', 'Europe', 'Africa'])
+
+
+pytestmark = pytest.mark.skipif(NODE is None, reason='node is not installed')
+
+
+def test_animated_scatter(gapminder):
+    fig = px.scatter(gapminder, x='gdpPercap', y='lifeExp', size='pop', color='continent',
+                     hover_name='country', hover_data=['continent', 'pop'],
+                     animation_frame='year', log_x=True, size_max=60)
+    packed = figpack.pack(fig)
+    # frames after the first only carry what changed
+    assert any('__delta' in t for f in packed['figure']['frames'][1:] for t in f['data'])
+    assert_same(unpack(packed), plain(fig))
+
+
+def test_choropleth_and_lines(gapminder):
+    for fig in (px.choropleth(gapminder, locations='iso_alpha', color='lifeExp',
+                              animation_frame='year', hover_name='country'),
+                px.line(gapminder, x='year', y='pop', color='continent', line_group='country')):
+        assert_same(unpack(figpack.pack(fig)), plain(fig))
+
+
+def test_numbers_keep_their_values():
+    values = np.array([0.1, 2.25, -3.5, 1e-7, 123456.789, 7.0, 8.5, 9.125])
+    fig = {'data': [{'type': 'scatter', 'x': list(range(8)), 'y': values,
+                     'customdata': [['a', 1], ['b', 2]] * 4}], 'layout': {}}
+    got = unpack(figpack.pack(fig))
+    assert got['data'][0]['y'] == values.tolist()
+    assert got['data'][0]['customdata'] == [['a', 1], ['b', 2]] * 4
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.query import QueryEngine
+
+CONTINENTS = ['Asia', 'Europe', 'Africa', 'Americas', 'Oceania']
+
+
+@pytest.fixture(scope='module')
+def frame():
+    rng = np.random.default_rng(1)
+    n = 5000
+    df = pd.DataFrame({
+        'continent': rng.choice(CONTINENTS, n),
+        'country': rng.choice(['c%d' % i for i in range(60)], n),
+        'pop': rng.integers(0, 1000, n),
+        'value': rng.normal(size=n),
+    })
+    df.loc[::97, 'country'] = None
+    return df
+
+
+@pytest.fixture(scope='module')
+def engine(frame):
+    return QueryEngine(frame, 'pop', categorical=('continent', 'country'))
+
+
+def reference(frame, key_range=None, **selections):
+    # pandas filtering, rows grouped in the order of the first selection's
+    # values, then in their original order
+    mask = pd.Series(True, index=frame.index)
+    if key_range is not None:
+        mask &= frame['pop'].between(*key_range)
+    for col, wanted in selections.items():
+        mask &= frame[col].isin([wanted] if isinstance(wanted, str) else wanted)
+    out = frame[mask]
+    if selections:
+        col, wanted = next(iter(selections.items()))
+        wanted = [wanted] if isinstance(wanted, str) else list(dict.fromkeys(wanted))
+        rank = out[col].map({v: i for i, v in enumerate(wanted)})
+        out = out.assign(_rank=rank).sort_values('_rank', kind='stable').drop(columns='_rank')
+    return out.reset_index(drop=True)
+
+
+CASES = [
+    ({}),
+    ({'key_range': [100, 400]}),
+    ({'key_range': [400, 100]}),
+    ({'key_range': [-10, 5000], 'continent': ['Europe', 'Asia']}),
+    ({'continent': ['Oceania', 'Asia', 'Oceania']}),
+    ({'continent': 'Africa', 'country': ['c1', 'c2', 'c30', 'nowhere']}),
+    ({'key_range': [250, 260], 'continent': []}),
+    ({'continent': ['nowhere']}),
+]
+
+
+@pytest.mark.parametrize('query', CASES)
+def test_select_matches_pandas(frame, engine, query):
+    got = engine.select(**query)
+    expected = reference(frame, **query)
+    pd.testing.assert_frame_equal(got, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('query', CASES)
+@pytest.mark.parametrize('size', [1, 37, 4096, 100000])
+def test_blocks_cover_the_selection(engine, query, size):
+    blocks = list(engine.blocks(size=size, **query))
+    assert all(len(pos) for pos in blocks)
+    got = np.concatenate(blocks) if blocks else np.empty(0, dtype=np.intp)
+    # key order, the same rows as positions()
+    assert (np.diff(got) > 0).all()
+    assert np.array_equal(got, np.sort(engine.positions(**query)))
+
+
+def test_blocks_rows_equal_select(engine):
+    query = {'key_range': [100, 700], 'continent': ['Asia', 'Americas']}
+    rows = pd.concat([engine.take(pos) for pos in engine.blocks(size=250, **query)])
+    key = ['pop', 'country', 'value']
+    pd.testing.assert_frame_equal(
+        rows.sort_values(key).reset_index(drop=True),
+        engine.select(**query).sort_values(key).reset_index(drop=True))
+
+
+def test_snap_keeps_the_rows(engine):
+    snapped = engine.snap([100.5, 399.5])
+    assert np.array_equal(engine.positions(snapped), engine.positions([100.5, 399.5]))
+    assert snapped[0] >= 100.5 and snapped[1] <= 399.5
+
+
+def test_unique_in_order_of_first_appearance(frame, engine):
+    assert list(engine.unique('continent')) == list(pd.unique(frame['continent']))
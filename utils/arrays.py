@@ -0,0 +1,63 @@
+# helpers for shipping numpy columns to the browser as base64 typed arrays
+# the {'dtype': 'f8', 'bdata': '...'} layout follows plotly's typed array spec
+# and is decoded by assets/clientside.js
+import base64
+
+import numpy as np
+
+# numpy dtype -> typed array code understood by the javascript side
+TYPED_ARRAYS = {
+    'int8': 'i1', 'uint8': 'u1', 'int16': 'i2', 'uint16': 'u2',
+    'int32': 'i4', 'uint32': 'u4', 'float32': 'f4', 'float64': 'f8',
+}
+
+_INT_TYPES = (np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32)
+
+
+def compact(arr):
+    # smallest dtype that holds the values of arr without losing precision
+    arr = np.asarray(arr)
+    if arr.dtype.kind in 'biu':
+        if len(arr) == 0:
+            return arr.astype(np.int32)
+        lo, hi = arr.min(), arr.max()
+        for t in _INT_TYPES:
+            info = np.iinfo(t)
+            if info.min <= lo and hi <= info.max:
+                return arr.astype(t, copy=False)
+        # javascript has no 64 bit typed array that plotly understands
+        return arr.astype(np.float64)
+    if arr.dtype.kind == 'f':
+        small = arr.astype(np.float32)
+        if np.array_equal(small.astype(arr.dtype), arr, equal_nan=True):
+            return small
+        return arr.astype(np.float64, copy=False)
+    raise TypeError('cannot compact array of dtype %s' % arr.dtype)
+
+
+def encode(arr):
+    arr = np.ascontiguousarray(arr)
+    code = TYPED_ARRAYS[arr.dtype.name]
+    # typed arrays in the browser are little endian
+    data = arr.astype(arr.dtype.newbyteorder('<'), copy=False).tobytes()
+    return {'dtype': code, 'bdata': base64.b64encode(data).decode('ascii')}
+
+
+def decode(obj):
+    dtype = {v: k for k, v in TYPED_ARRAYS.items()}[obj['dtype']]
+    return np.frombuffer(base64.b64decode(obj['bdata']), dtype=np.dtype(dtype).newbyteorder('<'))
+
+
+def pack_columns(frame, categorical=()):
+    # the whole frame as compact typed arrays, string columns as codes plus
+    # their list of categories
+    columns = {}
+    categories = {}
+    for col in frame.columns:
+        if col in categorical:
+            codes, cats = frame[col].factorize()
+            columns[col] = encode(compact(codes))
+            categories[col] = list(cats)
+        else:
+            columns[col] = encode(compact(frame[col].to_numpy()))
+    return {'n': len(frame), 'columns': columns, 'categories': categories}
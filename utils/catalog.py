@@ -0,0 +1,210 @@
+# the datasets used by the pages, each loaded once per process
+# datasets are kept as read-only QueryEngines over compact columns: string
+# columns as categorical codes, years as int32 and measurements as float32.
+# With gunicorn's preload (see gunicorn.conf.py) they are loaded in the
+# master before the workers fork, so every worker shares the same pages.
+# Pages hold Dataset handles rather than the engines: reload() swaps a new
+# version of a dataset in, and each request reads the versions pinned when
+# it started (see utils/refresh.py).
+import contextvars
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from utils.arrays import compact
+from utils.query import QueryEngine
+
+log = logging.getLogger(__name__)
+
+# GAPMINDER_SCALE=n serves a synthetic gapminder n times the size (see
+# utils/synthetic.py), to benchmark or load test the pages at that scale
+GAPMINDER_SCALE = int(os.environ.get('GAPMINDER_SCALE', 1))
+
+_engines = {}
+# reentrant, the shot cube is built from the shots loaded under it
+_lock = threading.RLock()
+# stamp of the source file each loaded dataset was read from
+_sources = {}
+# (version appended to, positions of the appended rows) of the last load
+_appends = {}
+# datasets pinned for the current request
+_pinned = contextvars.ContextVar('datasets', default=None)
+
+
+class Dataset:
+    # stands for the current version of a dataset, see current()
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(current(self._name), attr)
+
+    def __len__(self):
+        return len(current(self._name))
+
+
+def _load_gapminder(previous=None):
+    from utils import synthetic
+    df = synthetic.gapminder(GAPMINDER_SCALE)
+    # sorted on pop once here, so the query engine does not keep its own copy
+    order = np.argsort(df['pop'].to_numpy(), kind='stable')
+    df = df.iloc[order]
+    categorical = ('country', 'continent', 'iso_alpha')
+    columns = {}
+    categories = {}
+    for col in df.columns:
+        if col in categorical:
+            codes, cats = df[col].factorize()
+            columns[col] = compact(codes)
+            categories[col] = list(cats)
+        elif col == 'year':
+            columns[col] = df[col].to_numpy().astype(np.int32)
+        elif df[col].dtype.kind == 'f':
+            columns[col] = df[col].to_numpy().astype(np.float32)
+        else:
+            columns[col] = compact(df[col].to_numpy())
+    return QueryEngine.from_arrays(columns, 'pop', categories=categories, rows=order)
+
+
+def _load_shots(previous=None):
+    from utils import shots
+    table = shots.load()
+    _appends['shots'] = (table.base, table.added)
+    return QueryEngine.from_arrays(table.columns, shots.SORT_KEY,
+                                   categories=table.categories, version=table.version)
+
+
+def _load_shot_cube(previous=None):
+    from utils import cube
+    engine = get('shots')
+    base, added = _appends.get('shots', (None, None))
+    if previous is not None and added is not None and base == previous.version:
+        # only the shots appended since count again
+        return previous.extended(engine, added)
+    return cube.ShotCube(engine)
+
+
+def _shots_source():
+    from utils import shots
+    return _stamp(shots.SHOTS_CSV)
+
+
+# loader(previous version or None) of each dataset
+LOADERS = {
+    'gapminder': _load_gapminder,
+    'shots': _load_shots,
+    'shot_cube': _load_shot_cube,
+}
+# stamp of the file a dataset is read from, for the ones that have one
+SOURCES = {
+    'shots': _shots_source,
+}
+# datasets built from another one, reloaded after it
+DERIVED = {
+    'shot_cube': 'shots',
+}
+
+
+def _stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def _source(name):
+    return SOURCES[name]() if name in SOURCES else None
+
+
+def get(name):
+    engine = _engines.get(name)
+    if engine is None:
+        with _lock:
+            engine = _engines.get(name)
+            if engine is None:
+                start = time.perf_counter()
+                _sources[name] = _source(name)
+                engine = LOADERS[name]()
+                _engines[name] = engine
+                log.info('loaded dataset %s (%d rows, %.1f kB) in %.3fs', name, len(engine),
+                         memory_usage(name) / 1e3, time.perf_counter() - start)
+    return engine
+
+
+def current(name):
+    # the version of name pinned by the current request, else the latest
+    pinned = _pinned.get()
+    if pinned is not None and name in pinned:
+        return pinned[name]
+    return get(name)
+
+
+def pin():
+    # current() keeps answering with the datasets loaded now until unpin()
+    return _pinned.set(dict(_engines))
+
+
+def unpin(token):
+    _pinned.reset(token)
+
+
+def reload(name):
+    # loads name, then the datasets derived from it, again and swaps each
+    # new version in; the previous one is handed to the loader
+    with _lock:
+        previous = _engines.get(name)
+        start = time.perf_counter()
+        _sources[name] = _source(name)
+        engine = LOADERS[name](previous)
+        _engines[name] = engine
+        log.info('reloaded dataset %s (%d rows, version %s -> %s) in %.3fs', name, len(engine),
+                 getattr(previous, 'version', None), engine.version, time.perf_counter() - start)
+        reloaded = [name]
+        for derived, base in DERIVED.items():
+            if base == name and derived in _engines:
+                reloaded += reload(derived)
+    return reloaded
+
+
+def changed():
+    # loaded datasets whose source file changed since they were read
+    return [name for name in SOURCES if name in _engines and _source(name) != _sources.get(name)]
+
+
+def gapminder():
+    return Dataset('gapminder')
+
+
+def shots():
+    return Dataset('shots')
+
+
+def shot_cube():
+    return Dataset('shot_cube')
+
+
+def load_all():
+    for name in LOADERS:
+        get(name)
+
+
+def versions():
+    # name -> version of every loaded dataset
+    return {name: engine.version for name, engine in list(_engines.items())}
+
+
+def memory_usage(name=None):
+    # bytes held by the arrays of one dataset, or of every loaded one
+    if name is None:
+        return {n: memory_usage(n) for n in list(_engines)}
+    engine = _engines[name]
+    if hasattr(engine, 'nbytes'):
+        return engine.nbytes
+    arrays = list(engine.data.values()) + list(engine.codes.values()) + [engine.rows]
+    return sum(a.nbytes for a in arrays) + sum(
+        sum(len(str(c)) for c in cats) for cats in engine.categories.values())
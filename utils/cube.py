@@ -0,0 +1,193 @@
+# histogram cube of the shots for the dashboard's density view and stats
+# Shots are counted once per county x build-up passes x distance bin x angle
+# bin, and the counts are summed cumulatively along the passes, so the
+# shots of a pass range are cum[hi + 1] - cum[lo] for every county and
+# bin: a query costs a subtraction over CUBE_BINS x CUBE_BINS cells per
+# selected county whatever the number of shots. Sums of distance, angle and
+# passes per county x passes are kept the same way for the summary stats.
+# Passes are whole numbers (bucket = pass count); distance and angle are
+# binned evenly between their smallest and largest values in the data.
+# When shots are appended to the data, extended() adds just their counts.
+import copy
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger(__name__)
+
+# bins per axis of the distance x angle grid
+CUBE_BINS = int(os.environ.get('CUBE_BINS', 32))
+
+PASSES = 'build_up_passes'
+X = 'distance_from_goal'
+Y = 'angle'
+# per county x passes sums kept for the stats, besides the shot counts
+SUMS = (X, Y, PASSES)
+
+
+class ShotCube:
+
+    def __init__(self, engine, bins=CUBE_BINS):
+        start = time.perf_counter()
+        self.version = engine.version
+        self.counties = np.asarray(engine.categories.get('county', []), dtype=object)
+        self.bins = bins
+        county, passes, x, y = _rows(engine)
+        self.pass_min = int(np.floor(passes.min())) if len(passes) else 0
+        self.pass_max = int(np.floor(passes.max())) if len(passes) else 0
+        self.x_edges = _edges(x, bins)
+        self.y_edges = _edges(y, bins)
+        self.cum, self.shots, self.sums = self._count(county, passes, x, y)
+        log.info('built the shot cube (%d counties x %d pass buckets x %d x %d bins, %.1f kB) '
+                 'in %.3fs', len(self.counties), self.cum.shape[1] - 1, bins, bins,
+                 self.nbytes / 1e3, time.perf_counter() - start)
+
+    def _count(self, county, passes, x, y):
+        # cumulative counts and sums of these shots, a plane of zeros first:
+        # cum[:, i] holds the shots with fewer than pass_min + i passes
+        bins = self.bins
+        n_county = len(self.counties)
+        n_pass = self.pass_max - self.pass_min + 1
+        p = np.floor(passes).astype(np.int64) - self.pass_min
+        cell = ((county * n_pass + p) * bins + _bin(x, self.x_edges)) * bins + _bin(y, self.y_edges)
+        counts = np.bincount(cell, minlength=n_county * n_pass * bins * bins)
+        counts = counts.reshape(n_county, n_pass, bins, bins)
+        cum = _cumulative(counts, np.int32 if len(p) < 2 ** 31 else np.int64)
+        group = county * n_pass + p
+        sums = {col: _cumulative(np.bincount(group, weights=v, minlength=n_county * n_pass)
+                                 .reshape(n_county, n_pass), np.float64)
+                for col, v in ((X, x), (Y, y), (PASSES, passes.astype(np.float64)))}
+        shots = _cumulative(np.bincount(group, minlength=n_county * n_pass)
+                            .reshape(n_county, n_pass), np.int64)
+        return cum, shots, sums
+
+    def extended(self, engine, added):
+        # the cube of engine, which is this cube's shots plus the ones at
+        # positions `added`: only those are counted, unless they bring a new
+        # county or fall outside the bins, which needs a full build
+        county, passes, x, y = _rows(engine, added)
+        if (list(engine.categories.get('county', [])) != list(self.counties)
+                or not _inside(np.floor(passes), self.pass_min, self.pass_max)
+                or not _inside(x, self.x_edges[0], self.x_edges[-1])
+                or not _inside(y, self.y_edges[0], self.y_edges[-1])):
+            return ShotCube(engine, self.bins)
+        start = time.perf_counter()
+        cube = copy.copy(self)
+        cube.version = engine.version
+        cum, shots, sums = self._count(county, passes, x, y)
+        cube.cum = self.cum + cum
+        cube.shots = self.shots + shots
+        cube.sums = {col: self.sums[col] + sums[col] for col in self.sums}
+        log.info('added %d shots to the shot cube in %.3fs', len(added),
+                 time.perf_counter() - start)
+        return cube
+
+    def __len__(self):
+        return int(self.shots[:, -1].sum())
+
+    @property
+    def nbytes(self):
+        return self.cum.nbytes + self.shots.nbytes + sum(s.nbytes for s in self.sums.values())
+
+    def _slices(self, counties, pass_range):
+        # county codes and the [lo, hi) plane indices of a selection
+        codes = pd.Index(self.counties).get_indexer(list(counties or []))
+        codes = np.unique(codes[codes >= 0])
+        n_pass = self.cum.shape[1] - 1
+        if pass_range is None:
+            return codes, 0, n_pass
+        lo = int(np.clip(np.ceil(pass_range[0]) - self.pass_min, 0, n_pass))
+        hi = int(np.clip(np.floor(pass_range[1]) - self.pass_min + 1, lo, n_pass))
+        return codes, lo, hi
+
+    def density(self, counties, pass_range=None):
+        # shots per distance x angle bin, indexed [distance, angle]
+        codes, lo, hi = self._slices(counties, pass_range)
+        planes = self.cum[codes]
+        return (planes[:, hi] - planes[:, lo]).sum(axis=0)
+
+    def stats(self, counties, pass_range=None):
+        # one row per selected county: shots and mean distance, angle, passes
+        codes, lo, hi = self._slices(counties, pass_range)
+        shots = self.shots[codes, hi] - self.shots[codes, lo]
+        out = {'county': self.counties[codes], 'shots': shots}
+        with np.errstate(invalid='ignore', divide='ignore'):
+            for col in SUMS:
+                out['mean_' + col] = (self.sums[col][codes, hi] - self.sums[col][codes, lo]) / shots
+        return pd.DataFrame(out)
+
+    def centers(self):
+        # middle of every distance and angle bin
+        return ((self.x_edges[1:] + self.x_edges[:-1]) / 2,
+                (self.y_edges[1:] + self.y_edges[:-1]) / 2)
+
+
+def _rows(engine, pos=None):
+    # county codes, passes, distance and angle of the shots (at positions
+    # pos) the cube counts: those with a county and no missing value
+    def column(values):
+        return values if pos is None else values[pos]
+    passes = column(engine.data[PASSES])
+    county = (column(engine.codes['county']).astype(np.int64) if 'county' in engine.codes
+              else np.full(len(passes), -1))
+    x = column(engine.data[X]).astype(np.float64)
+    y = column(engine.data[Y]).astype(np.float64)
+    ok = np.isfinite(passes) & np.isfinite(x) & np.isfinite(y) & (county >= 0)
+    return county[ok], passes[ok], x[ok], y[ok]
+
+
+def _inside(values, lo, hi):
+    return not len(values) or (values.min() >= lo and values.max() <= hi)
+
+
+def _edges(values, bins):
+    lo, hi = (float(values.min()), float(values.max())) if len(values) else (0.0, 1.0)
+    if hi <= lo:
+        hi = lo + 1.0
+    return np.linspace(lo, hi, bins + 1)
+
+
+def _bin(values, edges):
+    # bin index of every value, the largest value falls in the last bin
+    bins = len(edges) - 1
+    cells = ((values - edges[0]) * (bins / (edges[-1] - edges[0]))).astype(np.int64)
+    return np.clip(cells, 0, bins - 1)
+
+
+def _cumulative(counts, dtype):
+    # cumulative sum along axis 1 with a leading plane of zeros
+    shape = list(counts.shape)
+    shape[1] += 1
+    out = np.zeros(shape, dtype=dtype)
+    np.cumsum(counts, axis=1, out=out[:, 1:])
+    return out
+
+
+if __name__ == '__main__':
+    # cube queries against filtering the rows, at growing numbers of shots:
+    #   python -m utils.cube
+    from utils import synthetic
+    from utils.query import QueryEngine
+    counties = synthetic.COUNTIES[:5]
+    print('%10s %10s %12s %12s' % ('shots', 'build s', 'scan ms', 'cube ms'))
+    for n in (10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7):
+        df = synthetic.shots(n).drop(columns=['result'])
+        engine = QueryEngine(df, PASSES, categorical=('county',))
+        t = time.perf_counter()
+        cube = ShotCube(engine)
+        build = time.perf_counter() - t
+        t = time.perf_counter()
+        for _ in range(10):
+            pos = engine.positions([3, 17], county=counties)
+            np.histogram2d(engine.data[X][pos], engine.data[Y][pos],
+                           bins=[cube.x_edges, cube.y_edges])
+        scan = (time.perf_counter() - t) / 10
+        t = time.perf_counter()
+        for _ in range(100):
+            cube.density(counties, [3, 17])
+            cube.stats(counties, [3, 17])
+        query = (time.perf_counter() - t) / 100
+        print('%10d %10.3f %12.2f %12.3f' % (n, build, scan * 1e3, query * 1e3))
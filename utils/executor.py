@@ -0,0 +1,141 @@
+# builds the independent figures of a multi-output callback concurrently
+# FIGURE_EXECUTOR picks 'serial' (the default), a thread pool, or a process
+# pool, which gets past the GIL at the cost of pickling the data and the
+# figures across. With the figure templates (utils/templates.py) a figure
+# takes a few ms to build, less than that pickling, so serial is fastest:
+#   update_map serial 18 ms, thread 20 ms, process 52 ms
+#   Europe     serial  9 ms, thread 11 ms, process 30 ms
+# The process pool is started from a forkserver (spawn where there is none),
+# never forked from a worker whose other threads may hold a lock.
+# Figures not finished within FIGURE_TIMEOUT seconds, or lost to a broken
+# pool, are built again serially in the calling thread, as are all figures
+# of a thread that called serial(True) (the profiler's, utils/profiling.py).
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from utils import metrics
+from utils import pipeline
+
+log = logging.getLogger(__name__)
+
+FIGURE_EXECUTOR = os.environ.get('FIGURE_EXECUTOR', 'serial')
+FIGURE_WORKERS = int(os.environ.get('FIGURE_WORKERS', 3))
+FIGURE_TIMEOUT = float(os.environ.get('FIGURE_TIMEOUT', 10))
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+_local = threading.local()
+# name -> figure -> {'calls', 'total', 'max'} in seconds
+_timings = {}
+
+
+def _get_pool():
+    global _pool, _pool_pid
+    # a pool is never shared across a fork, each gunicorn worker makes its own
+    if _pool is None or _pool_pid != os.getpid():
+        with _lock:
+            if _pool is None or _pool_pid != os.getpid():
+                if FIGURE_EXECUTOR == 'process':
+                    ctx = multiprocessing.get_context(
+                        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                        else 'spawn')
+                    _pool = concurrent.futures.ProcessPoolExecutor(FIGURE_WORKERS, mp_context=ctx)
+                else:
+                    _pool = concurrent.futures.ThreadPoolExecutor(
+                        FIGURE_WORKERS, thread_name_prefix='figure')
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def pool():
+    # the figure pool of this worker, None with FIGURE_EXECUTOR=serial
+    return None if FIGURE_EXECUTOR == 'serial' else _get_pool()
+
+
+def serial(on=True):
+    # build the figures the calling thread asks for in that thread, whatever
+    # FIGURE_EXECUTOR is, until serial(False)
+    _local.serial = on
+
+
+def _timed(func, args):
+    start = time.perf_counter()
+    fig = func(*args)
+    if FIGURE_EXECUTOR == 'process' and hasattr(fig, 'to_plotly_json'):
+        # plain dicts pickle much faster than graph objects
+        fig = fig.to_plotly_json()
+    return fig, time.perf_counter() - start
+
+
+def build_figures(name, builders, timeout=None):
+    # builders is a list of (label, func, args); returns the figures in order
+    timeout = FIGURE_TIMEOUT if timeout is None else timeout
+    results = [None] * len(builders)
+    pending = list(range(len(builders)))
+    # stages (utils/pipeline.py) answer from their cache here, only the
+    # figures they do not have are built
+    builders = list(builders)
+    stages = {}
+    for i, (label, func, args) in enumerate(builders):
+        if isinstance(func, pipeline.Stage):
+            key, fig = func.lookup(*args)
+            if fig is not pipeline.MISSING:
+                results[i] = (fig, None)
+                pending.remove(i)
+            else:
+                stages[i] = (func, key)
+                builders[i] = (label, func.compute, args)
+    if (FIGURE_EXECUTOR != 'serial' and len(pending) > 1
+            and not getattr(_local, 'serial', False)):
+        try:
+            pool = _get_pool()
+            futures = {pool.submit(_timed, builders[i][1], builders[i][2]): i for i in pending}
+            done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+            for future in not_done:
+                future.cancel()
+            for future in done:
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                    pending.remove(i)
+                except Exception:
+                    log.warning('%s: building %s in the pool failed', name, builders[i][0],
+                                exc_info=True)
+            if not_done:
+                log.warning('%s: %d figure(s) not ready after %.1fs, building serially',
+                            name, len(not_done), timeout)
+        except RuntimeError:
+            # a broken pool or one that is shutting down
+            log.warning('%s: figure pool unavailable, building serially', name, exc_info=True)
+    for i in pending:
+        _, func, args = builders[i]
+        results[i] = _timed(func, args)
+    for i, (stage, key) in stages.items():
+        stage.store(key, results[i][0])
+    figures = []
+    with _lock:
+        stats = _timings.setdefault(name, {})
+        for (label, _, _), (fig, seconds) in zip(builders, results):
+            figures.append(fig)
+            if seconds is None:
+                continue
+            s = stats.setdefault(label, {'calls': 0, 'total': 0.0, 'max': 0.0})
+            s['calls'] += 1
+            s['total'] += seconds
+            s['max'] = max(s['max'], seconds)
+            metrics.record('figure.' + label, seconds)
+    log.debug('%s: %s', name, ', '.join('%s %s' % (label, 'cached' if seconds is None else
+                                                   '%.3fs' % seconds)
+                                        for (label, _, _), (_, seconds) in zip(builders, results)))
+    return figures
+
+
+def timings():
+    with _lock:
+        return {name: {label: dict(s) for label, s in stats.items()}
+                for name, stats in _timings.items()}
@@ -0,0 +1,276 @@
+# download of the rows behind a page's controls, written while it is sent
+# /export/<page>.<format> takes the values of the page's filter controls as
+# query parameters named after them, e.g. for the Global page
+#   /export/task123.csv?cont_dropdown=Asia&cont_dropdown=Europe
+#                      &pop_range=60011&pop_range=100000000
+# A control left out does not filter, one given empty (cont_dropdown=)
+# matches nothing, as on the page. The matching rows are read from the
+# in-memory dataset EXPORT_CHUNK_ROWS sorted rows at a time
+# (QueryEngine.blocks) and each block is encoded and sent before the next
+# one is read, so a download holds one block whatever its size. Rows come
+# in the order of the dataset's key column (pop, build-up passes). CSV is
+# always available, Arrow IPC streams and Parquet need pyarrow. A download
+# reads the dataset version its request started with to the end, even when
+# a new one is swapped in meanwhile (utils/refresh.py).
+#   python -m utils.export
+# measures the throughput and memory of every format at GAPMINDER_SCALE.
+import io
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from dash import html
+from dash.dependencies import ClientsideFunction, Output, State
+from flask import Response, abort, request
+
+from utils import catalog
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # CSV only, pip install pyarrow for Arrow and Parquet
+    pa = pq = None
+
+log = logging.getLogger(__name__)
+
+# sorted rows read, filtered and written per block
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 65536))
+URL = '/export/'
+
+_pages = {}
+_lock = threading.Lock()
+# format -> {'exports', 'rows', 'bytes', 'seconds'}
+_stats = {}
+
+
+def register(page, dataset, selections, key_range=None, fixed=None):
+    # page: its name in the URL; selections: control id -> categorical
+    # column it filters; key_range: id of the range control over the
+    # dataset's key column; fixed: column -> values the page always keeps
+    _pages[page] = {'dataset': dataset, 'selections': dict(selections),
+                    'key_range': key_range, 'fixed': dict(fixed or {})}
+
+
+def init_app(app, pages):
+    # pages: the PageRegistry, the pages register their exports when imported
+    if 'export' in app.server.view_functions:
+        return
+    server = app.server
+
+    def export(page, fmt):
+        pages.load_all()
+        return _export(page, fmt)
+
+    server.add_url_rule(URL + '<page>.<fmt>', 'export', export)
+
+
+def formats():
+    return ['csv', 'arrow', 'parquet'] if pa is not None else ['csv']
+
+
+def links(app, page, inputs):
+    # download links of a page, kept in step with its controls (inputs)
+    base = app.get_relative_path(URL)
+    ids = ['%s_export_%s' % (page, fmt) for fmt in formats()]
+    app.clientside_callback(ClientsideFunction(namespace='export', function_name='hrefs'),
+                            [Output(i, 'href') for i in ids], inputs,
+                            [State(i, 'href') for i in ids])
+    return html.Div(['Download the selected rows: '] + [
+        html.A(fmt.upper(), id=i, href='%s%s.%s' % (base, page, fmt), download='',
+               style={'marginRight': '1em'})
+        for fmt, i in zip(formats(), ids)])
+
+
+def _export(page, fmt):
+    spec = _pages.get(page)
+    if spec is None or fmt not in FORMATS:
+        abort(404)
+    if fmt not in formats():
+        abort(501, 'exporting %s needs pyarrow' % fmt)
+    try:
+        key_range, selections = _filters(spec, request.args)
+    except ValueError as e:
+        abort(400, str(e))
+    # the pinned version, still read once the request context is gone
+    engine = catalog.current(spec['dataset'])
+    mimetype, write = FORMATS[fmt]
+    blocks = _counted(fmt, engine.blocks(key_range, EXPORT_CHUNK_ROWS, **selections))
+    response = Response(_sent(fmt, '%s.%s' % (page, fmt), write(engine, blocks)),
+                        mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename="%s.%s"' % (page, fmt)
+    response.cache_control.no_store = True
+    return response
+
+
+def _filters(spec, args):
+    # key range and selections of the query string, ValueError when malformed
+    key_range = None
+    if spec['key_range'] in args:
+        values = args.getlist(spec['key_range'])
+        if len(values) != 2:
+            raise ValueError('%s takes two values' % spec['key_range'])
+        key_range = sorted(float(v) for v in values)
+    selections = dict(spec['fixed'])
+    for control, col in spec['selections'].items():
+        if control in args:
+            selections[col] = [v for v in args.getlist(control) if v != '']
+    return key_range, selections
+
+
+def _counted(fmt, blocks):
+    for pos in blocks:
+        with _lock:
+            _stats.setdefault(fmt, _new())['rows'] += len(pos)
+        yield pos
+
+
+def _sent(fmt, name, chunks):
+    start = time.perf_counter()
+    sent = 0
+    try:
+        for chunk in chunks:
+            if chunk:
+                sent += len(chunk)
+                yield chunk
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            s = _stats.setdefault(fmt, _new())
+            s['exports'] += 1
+            s['bytes'] += sent
+            s['seconds'] += seconds
+        log.info('exported %s: %d bytes in %.2fs', name, sent, seconds)
+
+
+def _new():
+    return {'exports': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0}
+
+
+def _csv(engine, blocks):
+    header = True
+    for pos in blocks:
+        yield engine.take(pos).to_csv(index=False, header=header).encode()
+        header = False
+    if header:
+        yield pd.DataFrame(columns=engine.columns).to_csv(index=False).encode()
+
+
+class _Sink(io.RawIOBase):
+    # file the pyarrow writers write to, handing out what they wrote so far;
+    # tell() counts every byte, the Parquet footer holds offsets
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _schema(engine):
+    # the arrow schema of a dataset and the dictionaries of its string columns
+    fields = []
+    dictionaries = {}
+    for col in engine.columns:
+        if col in engine.codes:
+            dictionaries[col] = pa.array(list(engine.categories[col]))
+            fields.append(pa.field(col, pa.dictionary(pa.int32(), dictionaries[col].type)))
+        else:
+            fields.append(pa.field(col, pa.from_numpy_dtype(engine.data[col].dtype)))
+    return pa.schema(fields), dictionaries
+
+
+def _batch(engine, pos, schema, dictionaries):
+    arrays = []
+    for col in engine.columns:
+        if col in engine.codes:
+            codes = engine.codes[col][pos].astype(np.int32)
+            arrays.append(pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0),
+                                                         dictionaries[col]))
+        else:
+            # NaN as null, as the empty fields of the CSV
+            arrays.append(pa.array(engine.data[col][pos], from_pandas=True))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _arrow(engine, blocks):
+    schema, dictionaries = _schema(engine)
+    sink = _Sink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for pos in blocks:
+            writer.write_batch(_batch(engine, pos, schema, dictionaries))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _parquet(engine, blocks):
+    # one row group per block
+    schema, dictionaries = _schema(engine)
+    sink = _Sink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for pos in blocks:
+            batch = _batch(engine, pos, schema, dictionaries)
+            writer.write_table(pa.Table.from_batches([batch], schema=schema))
+            yield sink.drain()
+    yield sink.drain()
+
+
+FORMATS = {
+    'csv': ('text/csv', _csv),
+    'arrow': ('application/vnd.apache.arrow.stream', _arrow),
+    'parquet': ('application/vnd.apache.parquet', _parquet),
+}
+
+
+def stats():
+    with _lock:
+        return {fmt: dict(s) for fmt, s in _stats.items()}
+
+
+if __name__ == '__main__':
+    # rows per second, bytes and growth of the peak memory of an export of
+    # every row, in every format, against building the whole CSV at once:
+    #   GAPMINDER_SCALE=1000 python -m utils.export
+    def peak():
+        # resident high-water mark in MB, since the last reset (Linux)
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM')) / 1e3
+
+    def reset():
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+
+    def measure(label, chunks):
+        reset()
+        before = peak()
+        start = time.perf_counter()
+        sent = sum(len(c) for c in chunks)
+        seconds = time.perf_counter() - start
+        print('%-9s %10.2f %12.0f %12.1f %14.1f' % (label, seconds, len(engine) / seconds,
+                                                    sent / 1e6, peak() - before))
+
+    engine = catalog.get('gapminder')
+    print('%d rows, %.1f MB in memory' % (len(engine), catalog.memory_usage('gapminder') / 1e6))
+    print('%-9s %10s %12s %12s %14s' % ('format', 'seconds', 'rows/s', 'MB sent', 'peak MB added'))
+    for fmt in formats():
+        measure(fmt, FORMATS[fmt][1](engine, engine.blocks(size=EXPORT_CHUNK_ROWS)))
+    measure('csv, all', (engine.take(engine.positions()).to_csv(index=False).encode()
+                         for _ in range(1)))
@@ -0,0 +1,184 @@
+# figure cache shared by every gunicorn worker on the node
+# callback results are stored as JSON files in one directory (in /dev/shm
+# when available, so the "disk" is shared memory) keyed on the normalized
+# callback inputs plus the version of the dataset they were built from.
+# A changed dataset version gives new keys, so stale figures are never served
+# and simply age out through the byte budget LRU eviction.
+import functools
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+import dash
+import plotly.io as pio
+
+from utils import flights
+
+log = logging.getLogger(__name__)
+
+
+def _default_dir():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'dash_figure_cache')
+
+
+class FigureCache:
+
+    def __init__(self, path=None, max_bytes=None, enabled=None):
+        self.path = path or os.environ.get('FIGURE_CACHE_DIR') or _default_dir()
+        self.max_bytes = int(max_bytes or os.environ.get('FIGURE_CACHE_BYTES', 64 * 1024 * 1024))
+        if enabled is None:
+            enabled = os.environ.get('FIGURE_CACHE', '1') != '0'
+        self.enabled = enabled
+        # counters are per worker process
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def key(self, name, version, args):
+        raw = json.dumps([name, version, normalize(args)], separators=(',', ':'))
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def get(self, key):
+        fname = self._file(key)
+        try:
+            with open(fname, 'rb') as f:
+                payload = f.read()
+            # touching the file marks it as recently used for the LRU
+            os.utime(fname)
+        except OSError:
+            return None
+        return payload
+
+    def set(self, key, payload):
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            # rename is atomic, readers in other workers never see half a file
+            os.replace(tmp, self._file(key))
+        except OSError:
+            log.warning('could not write figure cache entry %s', key, exc_info=True)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        if total <= self.max_bytes:
+            return
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def clear(self):
+        for name in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / calls if calls else 0.0}
+
+    def memoize(self, name, version=None, canonical=None):
+        # version is a string or a callable returning the current dataset version;
+        # canonical(*args) maps inputs giving the same result to the same args
+        # (e.g. slider ends snapped to the data), used for the key and the call
+        def decorator(func):
+            def arguments(args):
+                return tuple(canonical(*args)) if canonical is not None else args
+
+            def cache_key(*args):
+                # where the result for these inputs is stored
+                ver = version() if callable(version) else version
+                return self.key(name, ver, arguments(args))
+
+            @functools.wraps(func)
+            def wrapper(*args):
+                key = cache_key(*args)
+                args = arguments(args)
+                if not self.enabled:
+                    # still computed once for identical concurrent requests
+                    return flights.once(key, lambda: func(*args))
+                payload = self.get(key)
+                if payload is not None:
+                    with self._lock:
+                        self.hits += 1
+                    return json.loads(payload)
+                with self._lock:
+                    self.misses += 1
+
+                def compute():
+                    result = func(*args)
+                    if not _has_no_update(result):
+                        self.set(key, dumps(result).encode())
+                    return result
+
+                def cached():
+                    payload = self.get(key)
+                    return None if payload is None else json.loads(payload)
+
+                return flights.once(key, compute, cached)
+            wrapper.cache_key = cache_key
+            return wrapper
+        return decorator
+
+
+def dumps(obj):
+    # orjson when it is installed, plotly's own encoder otherwise
+    return pio.json.to_json_plotly(obj)
+
+
+def normalize(value):
+    # slider values that are whole numbers compare equal to ints; dropdown
+    # selections keep their order, trace and bar order follow it
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _has_no_update(result):
+    if isinstance(result, (list, tuple)):
+        return any(_has_no_update(r) for r in result)
+    return result is dash.no_update
+
+
+figure_cache = FigureCache()
@@ -0,0 +1,247 @@
+# compact encoding of the figures returned by callbacks
+# numeric arrays are sent as base64 typed arrays (see utils/arrays.py) and
+# every array is stored once in a shared table, so the per-frame copies of
+# locations, hover names etc. in animated figures are only sent once.
+# Animation frames only carry the trace attributes that changed since the
+# previous frame and the plotly template is replaced by its name.
+# The packed figure goes into a dcc.Store next to the graph and a clientside
+# callback (window.dash_clientside.figpack.unpack) turns it back into the
+# figure, because the plotly.js bundled with dash cannot read typed arrays.
+import functools
+import json
+import logging
+import os
+import threading
+
+import dash
+import numpy as np
+import plotly.io as pio
+from dash import dcc
+from dash import html
+from dash.dependencies import Input, Output, ClientsideFunction
+
+from utils import metrics
+from utils.arrays import compact, encode
+
+log = logging.getLogger(__name__)
+
+FIGURE_PACKING = os.environ.get('FIGURE_PACKING', '1') != '0'
+# shorter arrays are cheaper to send as plain JSON than as a table reference
+MIN_LENGTH = 8
+# decimals tried when sending floats as scaled integers
+MAX_DECIMALS = 6
+TEMPLATES_URL = '/_figpack/templates.js'
+# the bytes saved are measured on one call in PACK_STATS_EVERY per callback
+# (every call with debug logging), measuring serializes the figure twice
+PACK_STATS_EVERY = int(os.environ.get('PACK_STATS_EVERY', 50))
+
+_stats = {}
+_lock = threading.Lock()
+
+
+def store_id(graph_id):
+    return graph_id + '_packed'
+
+
+def Graph(id, **kwargs):
+    # dcc.Graph plus the store its packed figure is sent to
+    if not FIGURE_PACKING:
+        return dcc.Graph(id=id, **kwargs)
+    return html.Div([dcc.Graph(id=id, **kwargs), dcc.Store(id=store_id(id))])
+
+
+def output(graph_id):
+    # where a callback should send the figure for graph_id
+    if FIGURE_PACKING:
+        return Output(store_id(graph_id), 'data')
+    return Output(graph_id, 'figure')
+
+
+def register(app, graph_ids):
+    # clientside callbacks unpacking each store into its graph
+    if not FIGURE_PACKING:
+        return
+    init_app(app)
+    for graph_id in graph_ids:
+        app.clientside_callback(
+            ClientsideFunction(namespace='figpack', function_name='unpack'),
+            Output(graph_id, 'figure'),
+            [Input(store_id(graph_id), 'data')])
+
+
+def _template_json(name):
+    return json.loads(_dumps(pio.templates[name].to_plotly_json()))
+
+
+def init_app(app):
+    # the plotly template is the same for every figure, the browser gets it
+    # once as a script instead of inside every callback response; call this
+    # before the first request when pages are imported lazily
+    if TEMPLATES_URL in app.server.view_functions:
+        return
+    name = pio.templates.default
+    body = 'window.figpackTemplates = %s;' % json.dumps({name: _template_json(name)})
+
+    def templates():
+        return app.server.response_class(body, mimetype='application/javascript')
+
+    app.server.add_url_rule(TEMPLATES_URL, TEMPLATES_URL, templates)
+    app.config.external_scripts.append(app.get_relative_path(TEMPLATES_URL))
+
+
+@functools.lru_cache(maxsize=None)
+def _default_template():
+    return _template_json(pio.templates.default)
+
+
+def pack(fig):
+    if hasattr(fig, 'to_plotly_json'):
+        fig = fig.to_plotly_json()
+    table = []
+    index = {}
+    layout = fig.get('layout')
+    if layout and 'template' in layout:
+        template = layout['template']
+        if hasattr(template, 'to_plotly_json'):
+            template = template.to_plotly_json()
+        if json.loads(_dumps(template)) == _default_template():
+            fig = dict(fig, layout=dict(layout, template={'__template': pio.templates.default}))
+
+    def walk(obj):
+        if isinstance(obj, dict):
+            return {k: walk(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple, np.ndarray)):
+            if len(obj) >= MIN_LENGTH and not any(isinstance(v, dict) for v in obj):
+                return _ref(obj, table, index)
+            return [walk(v) for v in obj]
+        return obj
+
+    packed = walk(fig)
+    if packed.get('frames'):
+        packed['frames'] = _frame_deltas(packed.get('data', []), packed['frames'])
+    return {'figure': packed, 'arrays': table}
+
+
+def _frame_deltas(data, frames):
+    # animation frames repeat nearly every trace attribute of the frame
+    # before them, only the attributes that changed are sent
+    prev = data
+    out = []
+    for frame in frames:
+        traces = frame.get('data')
+        if not traces:
+            out.append(frame)
+            continue
+        delta = []
+        for j, trace in enumerate(traces):
+            base = prev[j] if j < len(prev) else None
+            if base is None or set(base) - set(trace):
+                delta.append(trace)
+            else:
+                delta.append({'__delta': {k: v for k, v in trace.items() if base.get(k) != v}})
+        out.append(dict(frame, data=delta))
+        prev = traces
+    return out
+
+
+def _ref(values, table, index):
+    if isinstance(values, np.ndarray):
+        arr = values
+    else:
+        arr = np.empty(len(values), dtype=object)
+        arr[:] = values
+        if all(isinstance(v, (list, tuple)) for v in values) and len(set(map(len, values))) == 1:
+            arr = np.array(values, dtype=object)
+    if arr.ndim == 2 and arr.dtype.kind == 'O':
+        # mixed rows such as customdata=[[continent, pop], ...] are sent one
+        # column at a time so each column gets its own encoding
+        return {'__columns': [_ref(arr[:, i], table, index) for i in range(arr.shape[1])]}
+    if arr.dtype.kind == 'O' and all(_is_number(v) for v in arr):
+        arr = np.array(arr.tolist())
+    if arr.dtype.kind in 'iuf':
+        entry = _numeric(arr)
+        key = (entry['dtype'], entry.get('shape') and tuple(entry['shape']),
+               entry.get('decimals'), entry['bdata'])
+    else:
+        entry = {'values': json.loads(_dumps(arr.tolist()))}
+        key = _dumps(entry['values'])
+    if key not in index:
+        index[key] = len(table)
+        table.append(entry)
+    return {'__ref': index[key]}
+
+
+def _is_number(v):
+    return isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool)
+
+
+def _numeric(arr):
+    entry = None
+    if arr.dtype.kind == 'f' and arr.size and np.isfinite(arr).all():
+        # floats with few decimals go as integers and are divided by 10**k
+        # in the browser, which gives back exactly the same doubles
+        for k in range(MAX_DECIMALS + 1):
+            scale = 10.0 ** k
+            ints = np.round(arr * scale)
+            if np.abs(ints).max() >= 2 ** 31:
+                break
+            if np.array_equal(ints / scale, arr):
+                entry = encode(compact(ints.astype(np.int64)).ravel())
+                entry['decimals'] = k
+                break
+    if entry is None:
+        entry = encode(compact(arr).ravel())
+    if arr.ndim > 1:
+        entry['shape'] = list(arr.shape)
+    return entry
+
+
+def _dumps(obj):
+    # orjson when it is installed, plotly's own encoder otherwise
+    return pio.json.to_json_plotly(obj)
+
+
+def packed(name):
+    # pack every figure a callback returns and record the bytes saved
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            result = func(*args)
+            if not FIGURE_PACKING:
+                return result
+            with metrics.span('pack'):
+                if isinstance(result, (list, tuple)):
+                    return [_pack_one(name, fig) for fig in result]
+                return _pack_one(name, result)
+        return wrapper
+    return decorator
+
+
+def _pack_one(name, fig):
+    if fig is dash.no_update:
+        return fig
+    fig = fig.to_plotly_json() if hasattr(fig, 'to_plotly_json') else fig
+    result = pack(fig)
+    with _lock:
+        s = _stats.setdefault(name, {'calls': 0, 'measured': 0, 'raw_bytes': 0,
+                                     'packed_bytes': 0})
+        s['calls'] += 1
+        measure = (s['calls'] - 1) % max(PACK_STATS_EVERY, 1) == 0
+    if not (measure or log.isEnabledFor(logging.DEBUG)):
+        return result
+    raw = len(_dumps(fig))
+    size = len(_dumps(result))
+    with _lock:
+        s['measured'] += 1
+        s['raw_bytes'] += raw
+        s['packed_bytes'] += size
+    log.debug('%s: figure %d -> %d bytes (%.0f%% saved)', name, raw, size,
+              100.0 * (raw - size) / raw if raw else 0)
+    return result
+
+
+def stats():
+    # bytes of the measured calls only
+    with _lock:
+        return {name: dict(s, saved_bytes=s['raw_bytes'] - s['packed_bytes'])
+                for name, s in _stats.items()}
@@ -0,0 +1,224 @@
+# single-flight for memoized callbacks and dropping of superseded requests
+# Dragging a slider fires a burst of nearly identical callback requests, and
+# many visitors ask for the same figures at once. once(key, compute) lets
+# one request compute a given key while the others wait for it: threads of
+# a worker share the result object, other gunicorn workers wait on a file
+# lock in FLIGHT_DIR and then read the figure cache the first one filled.
+# Every browser tab also sends an id of its own with its callback requests
+# (the X-Dash-Tab header, set by assets/clientside.js), and every request
+# leaves its arrival time under (tab, callback) in FLIGHT_DIR; a request that
+# is still waiting, or has not started computing, when a newer one of the
+# same tab and callback arrives is answered with no update instead. Tabs of
+# one browser do not drop each other's requests.
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from dash.exceptions import PreventUpdate
+from flask import g, request
+
+from utils import metrics
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, workers then only dedupe their own threads
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+
+def _default_dir():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'dash_flights')
+
+
+FLIGHT_DIR = os.environ.get('FLIGHT_DIR') or _default_dir()
+# seconds to wait for another thread or worker computing the same figures
+FLIGHT_TIMEOUT = float(os.environ.get('FLIGHT_TIMEOUT', 30))
+DROP_SUPERSEDED = os.environ.get('DROP_SUPERSEDED', '1') != '0'
+HEADER = 'X-Dash-Tab'
+# seconds a tab's arrival times are kept after its last request
+SESSION_TTL = 3600
+
+_lock = threading.Lock()
+# key -> Flight being computed by a thread of this worker
+_flights = {}
+_stats = {'computed': 0, 'shared': 0, 'waited': 0, 'superseded': 0}
+_requests = 0
+
+
+class Flight:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+def once(key, compute, cached=None):
+    # compute() once for requests wanting the same key at the same time;
+    # cached() returns what another worker stored under key, or None
+    with _lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = Flight()
+    if not leader:
+        deadline = time.monotonic() + FLIGHT_TIMEOUT
+        while not flight.done.wait(0.05):
+            check()
+            if time.monotonic() > deadline:
+                # a hung leader holds up no one else for longer
+                log.warning('%s: gave up waiting for another thread', key)
+                return _compute(compute)
+        if not flight.failed:
+            _count('shared')
+            return flight.result
+        # the leader failed or was superseded, which says nothing about us
+        return once(key, compute, cached)
+    try:
+        flight.result = _across_workers(key, compute, cached)
+    except BaseException:
+        flight.failed = True
+        raise
+    finally:
+        with _lock:
+            del _flights[key]
+        flight.done.set()
+    return flight.result
+
+
+def _across_workers(key, compute, cached):
+    if fcntl is None or cached is None:
+        return _compute(compute)
+    path = os.path.join(FLIGHT_DIR, 'locks', key + '.lock')
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, 'a')
+    except OSError:
+        return _compute(compute)
+    with f:
+        if not _try_lock(f):
+            # another worker computes it: wait, then read what it stored
+            _count('waited')
+            deadline = time.monotonic() + FLIGHT_TIMEOUT
+            while not _try_lock(f):
+                check()
+                if time.monotonic() > deadline:
+                    log.warning('%s: gave up waiting for another worker', key)
+                    return _compute(compute)
+                time.sleep(0.01)
+            result = cached()
+            if result is not None:
+                return result
+        try:
+            return _compute(compute)
+        finally:
+            # unlinked while still locked, later requests find the cache filled
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def _try_lock(f):
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _compute(compute):
+    check()
+    _count('computed')
+    return compute()
+
+
+def init_app(app):
+    if not DROP_SUPERSEDED:
+        return
+    server = app.server
+
+    def arrived():
+        global _requests
+        tab = request.headers.get(HEADER, '')[:64]
+        if not tab or not request.path.endswith('/_dash-update-component'):
+            return
+        path = _session_file(tab, metrics.callback_name(app, request.get_json(silent=True)))
+        ticket = time.time_ns()
+        g.flight_ticket = (path, ticket)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(str(ticket))
+        except OSError:
+            g.flight_ticket = None
+        _requests += 1
+        if _requests % 1000 == 0:
+            _prune_sessions()
+
+    server.before_request(arrived)
+
+
+def _session_file(tab, callback):
+    name = ''.join(c if c.isalnum() or c in '-_' else '_' for c in tab + '-' + callback)
+    return os.path.join(FLIGHT_DIR, 'sessions', name)
+
+
+def superseded():
+    # has a newer request of this tab for the same callback arrived?
+    ticket = g.get('flight_ticket') if _in_request() else None
+    if ticket is None:
+        return False
+    try:
+        with open(ticket[0]) as f:
+            latest = int(f.read() or 0)
+    except (OSError, ValueError):
+        return False
+    return latest > ticket[1]
+
+
+def check():
+    # give up on a superseded request, Dash answers it with no update
+    if superseded():
+        _count('superseded')
+        raise PreventUpdate
+
+
+def _in_request():
+    try:
+        return request.path is not None
+    except RuntimeError:
+        return False
+
+
+def _prune_sessions():
+    folder = os.path.join(FLIGHT_DIR, 'sessions')
+    cutoff = time.time() - SESSION_TTL
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+def _count(outcome):
+    with _lock:
+        _stats[outcome] += 1
+    name = metrics.current()
+    if name is not None:
+        metrics.inc('dash_callback_flights_total', (('callback', name), ('outcome', outcome)))
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
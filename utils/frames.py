@@ -0,0 +1,177 @@
+# streaming of animation frames: a figure is sent with its first frame only
+# The animated figures (one frame per year) carry every frame in the
+# callback response although most visitors look at one or two years. With
+# FRAME_STREAMING=1 the callbacks decorated with @streamed(name) send the
+# packed figure (utils/figpack.py) with the data of its first frame and a
+# name-only stub for every other one, and the arrays only those frames use
+# are left out. The full figure stays in the figure cache, under the key
+# of the memoized callback, and /_frames/<key>/<figure>/<frame> answers one
+# frame of it. assets/clientside.js fetches the frame after the one shown
+# as soon as a figure is drawn, then the one the slider or the play button
+# moves to and the one after it, and adds them to the graph. Figures that
+# are not packed, or not cached, are sent whole as before.
+import collections
+import functools
+import json
+import logging
+import os
+import threading
+
+import dash
+from flask import Response, abort
+
+from utils.figcache import figure_cache
+
+log = logging.getLogger(__name__)
+
+FRAME_STREAMING = os.environ.get('FRAME_STREAMING', '0') == '1'
+# seconds browsers keep a frame, its URL changes with the figure
+FRAME_MAX_AGE = 3600
+URL = '/_frames/'
+
+# parsed figures kept per worker, the frames of one are asked for in a row
+PARSED_SIZE = 8
+
+_prefix = None
+_lock = threading.Lock()
+_parsed = collections.OrderedDict()
+_stats = {'figures': 0, 'frames': 0}
+
+
+def init_app(app):
+    global _prefix
+    if not FRAME_STREAMING or 'frames' in app.server.view_functions:
+        return
+    app.server.add_url_rule(URL + '<key>/<int:figure>/<int:index>', 'frames', _frame)
+    _prefix = app.get_relative_path(URL)
+    log.info('streaming animation frames from %s', _prefix)
+
+
+def streamed(name):
+    # for a function memoized by figure_cache returning packed figures
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            result = func(*args)
+            if _prefix is None or not figure_cache.enabled or result is dash.no_update:
+                return result
+            key = func.cache_key(*args)
+            if isinstance(result, list):
+                return [first_frame(fig, '%s%s/%d/' % (_prefix, key, i))
+                        for i, fig in enumerate(result)]
+            return first_frame(result, '%s%s/0/' % (_prefix, key))
+        return wrapper
+    return decorator
+
+
+def first_frame(packed, url):
+    # the packed figure with the data of its first frame only
+    if not isinstance(packed, dict) or 'arrays' not in packed:
+        return packed
+    fig = packed['figure']
+    frames = fig.get('frames') or []
+    if len(frames) < 2:
+        return packed
+    kept = dict(fig, frames=[frames[0]] + [{'name': f.get('name')} for f in frames[1:]])
+    used = _refs(kept)
+    arrays = [entry if i in used else None for i, entry in enumerate(packed['arrays'])]
+    with _lock:
+        _stats['figures'] += 1
+    return {'figure': kept, 'arrays': arrays, 'stream': {'url': url, 'count': len(frames)}}
+
+
+def frame(packed, index):
+    # frame `index` of a packed figure, its traces made whole again (they
+    # only hold what changed since the previous frame) and the arrays they use
+    fig = packed['figure']
+    frames = fig.get('frames') or []
+    prev = fig.get('data') or []
+    for f in frames[:index + 1]:
+        if f.get('data'):
+            prev = [dict(prev[j], **t['__delta']) if '__delta' in t else t
+                    for j, t in enumerate(f['data'])]
+    out = dict(frames[index], data=prev)
+    return {'frame': out, 'arrays': {i: packed['arrays'][i] for i in sorted(_refs(out))}}
+
+
+def _refs(obj, found=None):
+    # indices of the array table an object refers to
+    found = set() if found is None else found
+    if isinstance(obj, dict):
+        if '__ref' in obj:
+            found.add(obj['__ref'])
+        for v in obj.values():
+            _refs(v, found)
+    elif isinstance(obj, list):
+        for v in obj:
+            if isinstance(v, (dict, list)):
+                _refs(v, found)
+    return found
+
+
+def _figures(key):
+    # the packed figures cached under key, parsed once for all their frames
+    with _lock:
+        figures = _parsed.get(key)
+        if figures is not None:
+            _parsed.move_to_end(key)
+            return figures
+    payload = figure_cache.get(key)
+    if payload is None:
+        return None
+    result = json.loads(payload)
+    figures = result if isinstance(result, list) else [result]
+    with _lock:
+        _parsed[key] = figures
+        while len(_parsed) > PARSED_SIZE:
+            _parsed.popitem(last=False)
+    return figures
+
+
+def _frame(key, figure, index):
+    figures = _figures(key) if all(c in '0123456789abcdef' for c in key) else None
+    if figures is None or figure >= len(figures):
+        abort(404)
+    frames = (figures[figure].get('figure') or {}).get('frames') or []
+    if index >= len(frames):
+        abort(404)
+    with _lock:
+        _stats['frames'] += 1
+    response = Response(json.dumps(frame(figures[figure], index), separators=(',', ':')),
+                        mimetype='application/json')
+    # the key changes with the inputs and the dataset version
+    response.cache_control.public = True
+    response.cache_control.max_age = FRAME_MAX_AGE
+    return response
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
+
+
+if __name__ == '__main__':
+    # bytes sent for the first paint, whole figures against first frames:
+    #   python -m utils.frames
+    from apps import Europe, task123
+
+    gap = task123.gap_engine
+    full = [int(gap.keys[0]), int(gap.keys[-1])]
+    conts = list(task123.cont_names)
+    # streamed() sends whole figures until init_app() gives it a URL, the
+    # Europe callback is taken from below its Dash wrapper
+    cases = [('task123.update_graph', task123.update_graph, (conts, full)),
+             ('task123.update_map', task123.update_map, (conts, full, 'lifeExp')),
+             ('Europe.update_graphs', Europe.update_graphs.__wrapped__,
+              (list(Europe.country_names), full, 'lifeExp'))]
+    print('%-22s %12s %12s %8s %12s' % ('callback', 'whole bytes', 'first frame', 'frames',
+                                        'frame bytes'))
+    for name, func, args in cases:
+        result = func(*args)
+        figures = result if isinstance(result, list) else [result]
+        whole = len(json.dumps(figures))
+        first = [first_frame(fig, '') for fig in figures]
+        count = max(len(fig['figure'].get('frames') or []) for fig in figures)
+        one = sum(len(json.dumps(frame(fig, 1))) for fig in figures
+                  if len(fig['figure'].get('frames') or []) > 1)
+        print('%-22s %12d %12d %8d %12d' % (name, whole, len(json.dumps(first)), count, one))
@@ -0,0 +1,283 @@
+# map geometry for the choropleths, served by the app instead of a CDN
+# plotly.js draws a choropleth on the topojson file named after the map's
+# scope and resolution ("world_110m.json", "europe_50m.json"...) that it
+# fetches from the graph's topojsonURL, https://cdn.plot.ly/ by default.
+#   python -m utils.geometry build [--source URL-or-folder]
+# downloads those files once, simplifies every arc to about a pixel of the
+# view it is drawn in (coarse for the world map, finer for a continent) and
+# writes them to GEO_DIR together with the bounding box of every country.
+# The app serves them under /_geo/<version>/ with a year of browser caching,
+# graph_config() points the graphs there and view() picks the scope and
+# resolution for the selected countries and frames them from the stored
+# bounding boxes, so the browser does not compute fitbounds on every update.
+# Without built files the maps keep using plotly's CDN as before.
+import hashlib
+import json
+import logging
+import os
+import sys
+import urllib.request
+
+import numpy as np
+from flask import abort, send_from_directory
+
+log = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GEO_DIR = os.environ.get('GEO_DIR') or os.path.join(ROOT, 'data', 'geo')
+GEO_SOURCE = os.environ.get('GEO_SOURCE', 'https://cdn.plot.ly/')
+# seconds browsers keep a geometry file, its URL changes with its content
+GEO_MAX_AGE = int(os.environ.get('GEO_MAX_AGE', 31536000))
+
+# plotly scope -> (resolution, tolerance in degrees): about one pixel of a
+# 700px wide map of that scope
+VIEWS = {
+    'world': (110, 0.5),
+    'europe': (50, 0.08),
+    'asia': (50, 0.15),
+    'africa': (50, 0.12),
+    'north america': (50, 0.15),
+    'south america': (50, 0.1),
+}
+# gapminder continent -> plotly scope, Oceania has none of its own
+SCOPES = {'Europe': 'europe', 'Asia': 'asia', 'Africa': 'africa'}
+BOUNDS = 'bounds.json'
+# degrees added around the selected countries
+MARGIN = 2.0
+
+
+def file_name(scope, resolution):
+    # the name plotly.js asks for, see getTopojsonName in plotly.js
+    return '%s_%dm.json' % (scope.replace(' ', '-'), resolution)
+
+
+def _version():
+    # hash of the built files, part of their URL
+    h = hashlib.sha1()
+    try:
+        names = sorted(n for n in os.listdir(GEO_DIR) if n.endswith('.json'))
+    except OSError:
+        return None
+    for name in names:
+        with open(os.path.join(GEO_DIR, name), 'rb') as f:
+            h.update(name.encode())
+            h.update(f.read())
+    return h.hexdigest()[:12] if names else None
+
+
+def _load_bounds():
+    try:
+        with open(os.path.join(GEO_DIR, BOUNDS)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+version = _version()
+bounds = _load_bounds()
+
+
+def available():
+    return version is not None and bool(bounds)
+
+
+def init_app(app):
+    if not available():
+        log.info('no map geometry in %s, maps use the plotly CDN '
+                 '(python -m utils.geometry build)', GEO_DIR)
+        return
+    if 'geometry' in app.server.view_functions:
+        return
+
+    def geometry(tag, name):
+        if tag != version or not name.endswith('.json') or name == BOUNDS:
+            abort(404)
+        response = send_from_directory(GEO_DIR, name, max_age=GEO_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+        return response
+
+    app.server.add_url_rule('/_geo/<tag>/<name>', 'geometry', geometry)
+
+
+def graph_config(app, config=None):
+    # dcc.Graph config loading the maps from this server when it has them
+    config = dict(config or {})
+    if available():
+        init_app(app)
+        config['topojsonURL'] = app.get_relative_path('/_geo/%s/' % version)
+    return config
+
+
+def view(iso_codes, continents=()):
+    # geo layout updates ('dotted.path': value) for a map of these countries:
+    # the scope of their continent when they share one, else the world, and
+    # the longitude / latitude ranges framing them
+    if not available():
+        return {}
+    continents = set(continents)
+    scope = SCOPES.get(continents.pop()) if len(continents) == 1 else None
+    updates = {}
+    if scope is not None:
+        resolution = VIEWS[scope][0]
+        updates.update({'geo.scope': scope, 'geo.resolution': resolution})
+    boxes = [bounds[code] for code in set(iso_codes) if code in bounds]
+    if boxes and scope is not None:
+        boxes = np.array(boxes)
+        lon = [max(float(boxes[:, 0].min()) - MARGIN, -180.0),
+               min(float(boxes[:, 2].max()) + MARGIN, 180.0)]
+        lat = [max(float(boxes[:, 1].min()) - MARGIN, -90.0),
+               min(float(boxes[:, 3].max()) + MARGIN, 90.0)]
+        updates.update({'geo.fitbounds': False, 'geo.lonaxis.range': lon,
+                        'geo.lataxis.range': lat})
+    return updates
+
+
+# -- building the files ------------------------------------------------------
+
+def _arcs(topology):
+    # arcs as arrays of absolute quantized (or plain) coordinates
+    arcs = [np.asarray(arc, dtype=np.float64).reshape(-1, 2) for arc in topology['arcs']]
+    if 'transform' in topology:
+        arcs = [np.cumsum(arc, axis=0) for arc in arcs]
+    return arcs
+
+
+def _degrees(topology, arc):
+    t = topology.get('transform')
+    if t is None:
+        return arc
+    return arc * np.asarray(t['scale']) + np.asarray(t['translate'])
+
+
+def _douglas_peucker(points, tolerance):
+    # indices of the points kept, always the first and the last
+    n = len(points)
+    if n < 3:
+        return list(range(n))
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    if np.array_equal(points[0], points[-1]):
+        # a closed ring: split it at the point farthest from its start
+        far = int(np.argmax(np.hypot(*(points - points[0]).T)))
+        if far in (0, n - 1):
+            return [0, n - 1]
+        keep[far] = True
+        stack = [(0, far), (far, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        a, b = points[first], points[last]
+        seg = points[first + 1:last]
+        d = b - a
+        norm = np.hypot(*d)
+        if norm == 0:
+            dist = np.hypot(*(seg - a).T)
+        else:
+            dist = np.abs(d[0] * (seg[:, 1] - a[1]) - d[1] * (seg[:, 0] - a[0])) / norm
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            keep[first + 1 + i] = True
+            stack.append((first, first + 1 + i))
+            stack.append((first + 1 + i, last))
+    kept = np.flatnonzero(keep)
+    if np.array_equal(points[0], points[-1]) and len(kept) < 4:
+        # a ring needs three distinct corners to stay a ring
+        kept = np.unique(np.concatenate([kept, np.linspace(0, n - 1, 4).astype(int)]))
+    return kept.tolist()
+
+
+def simplify(topology, tolerance):
+    # a copy of the topology with every arc simplified to `tolerance`
+    # degrees and quantized on a grid of a quarter of it; arcs are shared
+    # by neighbouring countries, so their borders still meet
+    arcs = [_degrees(topology, arc) for arc in _arcs(topology)]
+    step = tolerance / 4
+    lo = np.min([arc.min(axis=0) for arc in arcs if len(arc)], axis=0)
+    out = []
+    for arc in arcs:
+        kept = arc[_douglas_peucker(arc, tolerance)]
+        q = np.round((kept - lo) / step).astype(np.int64).reshape(-1, 2)
+        if len(q) < 2:
+            # degenerate arcs (a single point or none) are kept as they are
+            out.append(q.tolist())
+            continue
+        # points falling on the same grid cell are dropped, but an arc keeps
+        # its two ends so the arcs of a ring still join up
+        same = np.all(q[1:] == q[:-1], axis=1)
+        same[-1] = False
+        q = np.concatenate([q[:1], q[1:][~same]])
+        out.append(np.concatenate([q[:1], np.diff(q, axis=0)]).tolist())
+    result = dict(topology, arcs=out,
+                  transform={'scale': [step, step], 'translate': lo.tolist()})
+    result.pop('bbox', None)
+    return result
+
+
+def country_bounds(topology, name='countries'):
+    # id -> [lon0, lat0, lon1, lat1] of every geometry of an object
+    arcs = [_degrees(topology, arc) for arc in _arcs(topology)]
+    out = {}
+
+    def rings(geometry):
+        kind = geometry.get('type')
+        if kind == 'Polygon':
+            return geometry['arcs']
+        if kind == 'MultiPolygon':
+            return [ring for polygon in geometry['arcs'] for ring in polygon]
+        return []
+
+    for geometry in topology['objects'][name].get('geometries', []):
+        code = geometry.get('id')
+        indices = [i if i >= 0 else ~i for ring in rings(geometry) for i in ring]
+        if code is None or not indices:
+            continue
+        points = np.concatenate([arcs[i] for i in indices])
+        lo, hi = points.min(axis=0), points.max(axis=0)
+        out[str(code)] = [round(float(v), 3) for v in (lo[0], lo[1], hi[0], hi[1])]
+    return out
+
+
+def _fetch(source, name):
+    if os.path.isdir(source):
+        with open(os.path.join(source, name), 'rb') as f:
+            return json.load(f)
+    with urllib.request.urlopen(source.rstrip('/') + '/' + name, timeout=60) as response:
+        return json.load(response)
+
+
+def build(source=GEO_SOURCE, folder=GEO_DIR):
+    os.makedirs(folder, exist_ok=True)
+    sizes = []
+    for scope, (resolution, tolerance) in VIEWS.items():
+        name = file_name(scope, resolution)
+        topology = _fetch(source, name)
+        original = len(json.dumps(topology, separators=(',', ':')))
+        small = json.dumps(simplify(topology, tolerance), separators=(',', ':'))
+        with open(os.path.join(folder, name), 'w') as f:
+            f.write(small)
+        sizes.append((name, original, len(small)))
+    # country boxes from the most detailed world map
+    world = _fetch(source, file_name('world', 50))
+    with open(os.path.join(folder, BOUNDS), 'w') as f:
+        json.dump(country_bounds(world), f, separators=(',', ':'), sort_keys=True)
+    return sizes
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='build the simplified map geometry')
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--source', default=GEO_SOURCE,
+                        help='URL or folder with plotly.js topojson files')
+    parser.add_argument('--out', default=GEO_DIR)
+    args = parser.parse_args()
+    try:
+        sizes = build(args.source, args.out)
+    except OSError as e:
+        sys.exit('could not read %s: %s' % (args.source, e))
+    for name, original, small in sizes:
+        print('%-26s %9d -> %8d bytes' % (name, original, small))
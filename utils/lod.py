@@ -0,0 +1,102 @@
+# level of detail for figures with one trace per country
+# Past a few dozen series a line per country is a tangle and a bar per
+# country too thin to read, while every series still costs its share of the
+# response and of the browser's drawing time. Above LOD_LINES series a line
+# view shows, per group (e.g. continent), the median over its series at
+# every x with a band between two percentiles; above LOD_BARS series a bar
+# view keeps the LOD_TOP_N series with the largest values plus one "other"
+# series averaging the rest. Both are computed with grouped pandas
+# operations on the filtered rows. Small selections keep one trace per
+# country. LOD_LINES=0 / LOD_BARS=0 always draw every series.
+#   python -m utils.lod
+# reports the payload and build time of both modes on the pages' views.
+import os
+
+import pandas as pd
+
+LOD_LINES = int(os.environ.get('LOD_LINES', 40))
+LOD_BARS = int(os.environ.get('LOD_BARS', 20))
+LOD_TOP_N = int(os.environ.get('LOD_TOP_N', 15))
+# percentiles bounding the band around the median line
+BAND = (25, 75)
+OTHER = 'Other (mean)'
+
+
+def detailed(df, series, limit):
+    # True when df has few enough series to draw each one
+    return limit <= 0 or df[series].nunique() <= limit
+
+
+def bands(df, x, y, group, band=BAND):
+    # one row per (group, x): the median of y and the band percentiles,
+    # plus the number of series behind them
+    grouped = df.groupby([group, x], sort=True, observed=True)[y]
+    q = grouped.quantile([band[0] / 100, 0.5, band[1] / 100]).unstack()
+    q.columns = ['low', 'median', 'high']
+    q['count'] = grouped.size()
+    return q.reset_index()
+
+
+def top_n(df, series, value, n=LOD_TOP_N, frame=None, other=OTHER):
+    # the rows of the n series with the largest mean value, the others
+    # replaced by one series holding their mean (per frame when given)
+    means = df.groupby(series, sort=False, observed=True)[value].mean()
+    if len(means) <= n:
+        return df
+    keep = df[series].isin(means.nlargest(n).index)
+    rest = df[~keep]
+    numeric = [c for c in df.columns
+               if c != frame and pd.api.types.is_numeric_dtype(df[c])]
+    if frame is None:
+        others = rest[numeric].mean().to_frame().T
+    else:
+        others = rest.groupby(frame, sort=False)[numeric].mean().reset_index()
+        others[frame] = others[frame].astype(df[frame].dtype)
+    for col in df.columns:
+        if col not in others:
+            others[col] = other
+    return pd.concat([df[keep], others[df.columns]], ignore_index=True)
+
+
+def rgba(color, alpha):
+    # '#rrggbb' -> 'rgba(r, g, b, alpha)', for translucent bands
+    color = color.lstrip('#')
+    r, g, b = (int(color[i:i + 2], 16) for i in (0, 2, 4))
+    return 'rgba(%d, %d, %d, %g)' % (r, g, b, alpha)
+
+
+if __name__ == '__main__':
+    # payload and build time of the detailed and aggregated views
+    import json
+    import time
+    import plotly.io as pio
+    from apps import Europe, task123
+    from utils import figpack
+    from utils import lod
+
+    def measure(build, *args):
+        build(*args)
+        t = time.perf_counter()
+        for _ in range(5):
+            fig = build(*args)
+        seconds = (time.perf_counter() - t) / 5
+        fig = fig.to_plotly_json() if hasattr(fig, 'to_plotly_json') else fig
+        traces = sum(len(f['data']) for f in fig.get('frames') or [fig])
+        return seconds, len(pio.json.to_json_plotly(fig)), len(json.dumps(figpack.pack(fig))), traces
+
+    gap = task123.gap_engine
+    full = [int(gap.keys[0]), int(gap.keys[-1])]
+    views = [
+        ('task123 line', task123.line_figure.compute,
+         gap.select(full, continent=list(task123.cont_names)), 'lifeExp'),
+        ('Europe bar', Europe.bar_figure.compute, Europe.eur_data, 'lifeExp', full),
+    ]
+    print('%-14s %-7s %9s %12s %12s %8s' % ('view', 'mode', 'build ms', 'json bytes',
+                                            'packed', 'traces'))
+    for name, build, *args in views:
+        # a limit of 0 draws every series, 1 always aggregates
+        for mode, limit in (('detail', 0), ('lod', 1)):
+            lod.LOD_LINES = lod.LOD_BARS = limit
+            seconds, raw, packed, traces = measure(build, *args)
+            print('%-14s %-7s %9.1f %12d %12d %8d' % (name, mode, seconds * 1e3, raw,
+                                                      packed, traces))
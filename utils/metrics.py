@@ -0,0 +1,335 @@
+# per-callback metrics in the Prometheus text format, served on /metrics
+# Every server callback is dispatched through /_dash-update-component, so
+# the request hooks see each call with the callback it runs (looked up in
+# app.callback_map from the outputs it asks for): calls, errors, latency,
+# request and response bytes and how many run at once. Code inside a
+# callback can time its own phases with `with metrics.span('filter'):`.
+# Each gunicorn worker keeps its own numbers and writes them, at most every
+# METRICS_FLUSH seconds, to a small JSON file in METRICS_DIR (shared memory
+# when available); a scrape answered by any worker adds up every file, so
+# the numbers cover the whole node.
+import bisect
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from flask import Response, g, request
+
+log = logging.getLogger(__name__)
+
+
+def _default_dir():
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'dash_metrics')
+
+
+METRICS = os.environ.get('METRICS', '1') != '0'
+METRICS_DIR = os.environ.get('METRICS_DIR') or _default_dir()
+# seconds between two writes of a worker's numbers to METRICS_DIR
+METRICS_FLUSH = float(os.environ.get('METRICS_FLUSH', 1))
+
+# upper bounds of the histogram buckets, +Inf is added when rendering
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES = (1000, 10000, 100000, 300000, 1000000, 3000000, 10000000)
+
+HELP = {
+    'dash_callback_calls_total': ('counter', 'Callback requests answered'),
+    'dash_callback_errors_total': ('counter', 'Callback requests answered with a server error'),
+    'dash_callback_prevented_total': ('counter', 'Callback requests that did not update anything'),
+    'dash_callback_flights_total': ('counter', 'Memoized callback calls by how they got their result'),
+    'dash_stage_calls_total': ('counter', 'Pipeline stage calls answered from its cache or not'),
+    'dash_callback_in_flight': ('gauge', 'Callback requests being answered right now'),
+    'dash_callback_duration_seconds': ('histogram', 'Time to answer a callback request'),
+    'dash_callback_phase_seconds': ('histogram', 'Time spent in a phase of a callback'),
+    'dash_callback_request_bytes': ('histogram', 'Size of the callback request body'),
+    'dash_callback_response_bytes': ('histogram', 'Size of the callback response before compression'),
+}
+
+_lock = threading.Lock()
+# (metric, labels) -> value, labels a tuple of (name, value) pairs
+_counters = {}
+_gauges = {}
+# (metric, labels) -> [count per bucket..., count above the last, sum]
+_histograms = {}
+_bounds = {}
+_flushed = 0.0
+# name of the callback the current request runs, for span()
+_callback = contextvars.ContextVar('callback', default=None)
+
+
+def inc(metric, labels, value=1):
+    with _lock:
+        _counters[metric, labels] = _counters.get((metric, labels), 0) + value
+
+
+def add(metric, labels, value):
+    with _lock:
+        _gauges[metric, labels] = _gauges.get((metric, labels), 0) + value
+
+
+def observe(metric, labels, value, bounds=SECONDS):
+    with _lock:
+        h = _histograms.get((metric, labels))
+        if h is None:
+            h = _histograms[metric, labels] = [0] * (len(bounds) + 2)
+            _bounds[metric] = bounds
+        h[bisect.bisect_left(bounds, value)] += 1
+        h[-1] += value
+
+
+@contextlib.contextmanager
+def span(phase):
+    # time a phase of the callback answering the current request; outside
+    # a callback request (benchmarks, the figure pool) it does nothing
+    name = _callback.get()
+    if name is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('dash_callback_phase_seconds', (('callback', name), ('phase', phase)),
+                time.perf_counter() - start)
+
+
+def record(phase, seconds):
+    # a phase timed elsewhere (e.g. in the figure pool), same as span()
+    name = _callback.get()
+    if name is not None:
+        observe('dash_callback_phase_seconds', (('callback', name), ('phase', phase)), seconds)
+
+
+def current():
+    # name of the callback the current request runs, None outside one
+    return _callback.get()
+
+
+def callback_name(app, body):
+    # "module.function" of the callback a /_dash-update-component body asks for
+    entry = app.callback_map.get(body.get('output')) if isinstance(body, dict) else None
+    if entry is None:
+        return 'unknown'
+    func = entry['callback']
+    module = func.__module__ or ''
+    if module.startswith('apps.'):
+        module = module[len('apps.'):]
+    elif module == '__main__':
+        module = 'index'
+    return '%s.%s' % (module, func.__name__)
+
+
+def init_app(app):
+    if not METRICS:
+        return
+    server = app.server
+
+    def start():
+        if not request.path.endswith('/_dash-update-component'):
+            return
+        name = callback_name(app, request.get_json(silent=True))
+        g.metrics = (name, time.perf_counter(), _callback.set(name))
+        add('dash_callback_in_flight', (('callback', name),), 1)
+        observe('dash_callback_request_bytes', (('callback', name),),
+                request.content_length or 0, BYTES)
+
+    def finish(response):
+        # registered after serving.init_app, so it runs before compression
+        # and sees the JSON as Dash wrote it
+        if g.get('metrics') is None:
+            return response
+        name, began, _ = g.metrics
+        labels = (('callback', name),)
+        inc('dash_callback_calls_total', labels)
+        if response.status_code >= 500:
+            inc('dash_callback_errors_total', labels)
+        elif response.status_code == 204:
+            inc('dash_callback_prevented_total', labels)
+        observe('dash_callback_response_bytes', labels, response.content_length or 0, BYTES)
+        observe('dash_callback_duration_seconds', labels, time.perf_counter() - began)
+        return response
+
+    def teardown(exc):
+        # runs even when the request failed before finish()
+        state = g.pop('metrics', None)
+        if state is not None:
+            add('dash_callback_in_flight', (('callback', state[0]),), -1)
+            _callback.reset(state[2])
+        if time.monotonic() - _flushed > METRICS_FLUSH:
+            flush()
+
+    server.before_request(start)
+    server.after_request(finish)
+    server.teardown_request(teardown)
+    server.add_url_rule('/metrics', 'metrics', _serve)
+    prune()
+
+
+def snapshot():
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'counters': [[m, list(l), v] for (m, l), v in _counters.items()],
+            'gauges': [[m, list(l), v] for (m, l), v in _gauges.items()],
+            'histograms': [[m, list(l), list(h)] for (m, l), h in _histograms.items()],
+            'bounds': {m: list(b) for m, b in _bounds.items()},
+        }
+
+
+def flush():
+    # write this worker's numbers for the others to read
+    global _flushed
+    _flushed = time.monotonic()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, '%d.json' % os.getpid())
+        tmp = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(snapshot(), f)
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning('could not write metrics to %s: %s', METRICS_DIR, e)
+
+
+def prune():
+    # drop the files of processes that have exited, left by earlier runs;
+    # called once when the app is set up, before gunicorn forks its workers
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        return
+    for name in names:
+        pid = name.split('.')[0]
+        if pid.isdigit() and (int(pid) == os.getpid() or _alive(int(pid))):
+            continue
+        try:
+            os.unlink(os.path.join(METRICS_DIR, name))
+        except OSError:
+            pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect():
+    # every worker's snapshot added up; counters and histograms of workers
+    # that have exited are kept so they never go down, their gauges are not
+    flush()
+    snapshots = []
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        names = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    counters, gauges, histograms, bounds = {}, {}, {}, {}
+    for snap in snapshots:
+        live = _alive(snap['pid'])
+        for metric, labels, value in snap['counters']:
+            key = metric, tuple(map(tuple, labels))
+            counters[key] = counters.get(key, 0) + value
+        for metric, labels, value in snap['gauges'] if live else ():
+            key = metric, tuple(map(tuple, labels))
+            gauges[key] = gauges.get(key, 0) + value
+        for metric, labels, values in snap['histograms']:
+            key = metric, tuple(map(tuple, labels))
+            old = histograms.get(key)
+            histograms[key] = values if old is None else [a + b for a, b in zip(old, values)]
+        bounds.update(snap['bounds'])
+    return counters, gauges, histograms, bounds
+
+
+def render():
+    counters, gauges, histograms, bounds = collect()
+    lines = []
+    for metric, (kind, text) in HELP.items():
+        series = counters if kind == 'counter' else gauges if kind == 'gauge' else histograms
+        keys = sorted(key for key in series if key[0] == metric)
+        if not keys:
+            continue
+        lines.append('# HELP %s %s' % (metric, text))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        for key in keys:
+            labels = key[1]
+            if kind != 'histogram':
+                lines.append('%s%s %s' % (metric, _labels(labels), _number(series[key])))
+                continue
+            values = series[key]
+            total = 0
+            for bound, count in zip(list(bounds[metric]) + ['+Inf'], values[:-1]):
+                total += count
+                lines.append('%s_bucket%s %d' % (metric, _labels(labels + (('le', bound),)), total))
+            lines.append('%s_sum%s %s' % (metric, _labels(labels), _number(values[-1])))
+            lines.append('%s_count%s %d' % (metric, _labels(labels), total))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _escape(value):
+    if isinstance(value, float):
+        return _number(value)
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _serve():
+    response = Response(render(), mimetype='text/plain; version=0.0.4')
+    response.cache_control.no_store = True
+    return response
+
+
+if __name__ == '__main__':
+    # cost of the hooks on one callback request, and what a scrape returns:
+    #   python -m utils.metrics
+    import index
+    from utils import metrics
+
+    client = index.server.test_client()
+    body = json.dumps({'output': 'page-content.children',
+                       'outputs': {'id': 'page-content', 'property': 'children'},
+                       'inputs': [{'id': 'url', 'property': 'pathname', 'value': '/home'}],
+                       'changedPropIds': ['url.pathname']})
+    client.get('/_dash-dependencies')
+    for _ in range(50):
+        client.post('/_dash-update-component', data=body, content_type='application/json')
+    print(client.get('/metrics').get_data(as_text=True))
+    n = 2000
+    start = time.perf_counter()
+    for _ in range(n):
+        with metrics.span('bench'):
+            pass
+    outside = (time.perf_counter() - start) / n
+    token = metrics._callback.set('bench')
+    start = time.perf_counter()
+    for _ in range(n):
+        with metrics.span('bench'):
+            pass
+    inside = (time.perf_counter() - start) / n
+    metrics._callback.reset(token)
+    print('span outside a callback %.2f us, inside %.2f us' % (outside * 1e6, inside * 1e6))
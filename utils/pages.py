@@ -0,0 +1,89 @@
+# lazy registry of the pages routed by index.py
+# page modules pull in pandas/plotly, load their data and register their
+# callbacks when imported, so they are only imported when first needed
+# instead of when the worker boots. The browser asks for every callback once
+# (_dash-dependencies) before firing any of them, so all routed pages are
+# imported before the first _dash-* request is answered.
+import importlib
+import logging
+import threading
+import time
+
+from flask import request
+
+from utils import prerender
+from utils import refresh
+
+log = logging.getLogger(__name__)
+
+
+class PageRegistry:
+
+    def __init__(self, app, default=None):
+        self.app = app
+        self.default = default
+        self.routes = {}
+        self.layouts = {}
+        # seconds spent importing / building the layout of each page
+        self.timings = {}
+        self._lock = threading.RLock()
+        self._all_loaded = False
+        app.server.before_request(self._before_request)
+        # prerendered figures are of the dataset version they were built from
+        refresh.on_swap(self._datasets_swapped)
+
+    def add(self, path, module):
+        self.routes[path] = module
+
+    def module(self, name):
+        with self._lock:
+            start = time.perf_counter()
+            mod = importlib.import_module(name)
+            if name not in self.timings:
+                self.timings[name] = {'import': time.perf_counter() - start}
+                log.info('imported page %s in %.3fs', name, self.timings[name]['import'])
+            return mod
+
+    def layout(self, pathname):
+        name = self.routes.get(pathname, self.routes.get(self.default))
+        if name is None:
+            return None
+        layout = self.layouts.get(name)
+        if layout is not None:
+            return layout
+        with self._lock:
+            if name not in self.layouts:
+                mod = self.module(name)
+                start = time.perf_counter()
+                layout = mod.layout() if callable(mod.layout) else mod.layout
+                self.timings[name]['layout'] = time.perf_counter() - start
+                # default figures sent with the layout, see utils/prerender.py
+                start = time.perf_counter()
+                layout = prerender.embed(layout)
+                self.timings[name]['prerender'] = time.perf_counter() - start
+                self.layouts[name] = layout
+            return self.layouts[name]
+
+    def _datasets_swapped(self, names):
+        # layouts are built again, with default figures of the new versions
+        with self._lock:
+            self.layouts.clear()
+
+    def load_all(self):
+        if self._all_loaded:
+            return
+        with self._lock:
+            if not self._all_loaded:
+                for name in dict.fromkeys(self.routes.values()):
+                    self.module(name)
+                self._all_loaded = True
+
+    def preload(self):
+        # import every page in the background so the first visitor does not wait
+        thread = threading.Thread(target=self.load_all, name='page-preload', daemon=True)
+        thread.start()
+        return thread
+
+    def _before_request(self):
+        if not self._all_loaded and '/_dash-' in request.path:
+            self.load_all()
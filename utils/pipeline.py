@@ -0,0 +1,169 @@
+# staged callbacks: a filter stage feeding figure stages, each memoized
+# A page splits its callbacks into stages made with @stage(name): usually
+# one filter stage selecting the rows (shared by every callback of the page
+# filtering on the same controls) and figure stages taking that frame plus
+# their own parameters. Each stage keeps its last STAGE_CACHE_SIZE results
+# (and at most STAGE_CACHE_BYTES of frames) in the worker, keyed on its
+# arguments; a DataFrame argument counts by the key of the stage that made
+# it, so a figure stage is keyed on the filter inputs rather than the rows.
+# When only a figure parameter (e.g. the y variable) changes, the filter
+# result is reused. Results are shared between requests and must not be
+# modified. Hits and misses per stage are counted (stats(), and
+# dash_stage_calls_total on /metrics).
+import collections
+import functools
+import hashlib
+import importlib
+import json
+import os
+import threading
+import weakref
+
+import pandas as pd
+
+from utils import flights
+from utils import metrics
+
+STAGE_CACHE_SIZE = int(os.environ.get('STAGE_CACHE_SIZE', 16))
+# bytes of DataFrames one stage may keep, the newest result is always kept
+STAGE_CACHE_BYTES = int(os.environ.get('STAGE_CACHE_BYTES', 256 * 2 ** 20))
+
+MISSING = object()
+
+_lock = threading.Lock()
+# id(frame) -> (weak reference, key of the stage result it is)
+_frames = {}
+_stages = {}
+
+
+class Stage:
+
+    def __init__(self, func, name, version=None, size=STAGE_CACHE_SIZE):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.name = name
+        self.version = version
+        self.size = size
+        self.results = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        _stages[name] = self
+
+    def __call__(self, *args):
+        key, value = self.lookup(*args)
+        if value is not MISSING:
+            return value
+        if key is None:
+            return self.func(*args)
+        value = flights.once('stage:' + key, lambda: self.func(*args))
+        self.store(key, value)
+        return value
+
+    def __reduce__(self):
+        # sent to the figure pool by name, its results stay in this worker
+        return _load, (self.__module__, self.__qualname__)
+
+    def key(self, *args):
+        parts = []
+        for arg in args:
+            if isinstance(arg, pd.DataFrame):
+                parts.append(frame_key(arg))
+                if parts[-1] is None:
+                    # rows that did not come out of a stage are not hashed
+                    return None
+            else:
+                parts.append(arg)
+        version = self.version() if callable(self.version) else self.version
+        raw = json.dumps([self.name, version, parts], separators=(',', ':'), default=str)
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def lookup(self, *args):
+        # (key, cached result or MISSING); the key is None when uncacheable
+        key = self.key(*args)
+        value = MISSING
+        if key is not None:
+            with self._lock:
+                value = self.results.get(key, MISSING)
+                if value is not MISSING:
+                    self.results.move_to_end(key)
+                self._count(value is not MISSING)
+        return key, value
+
+    def compute(self, *args):
+        # the stage function alone, for the figure pool
+        return self.func(*args)
+
+    def store(self, key, value):
+        if key is None:
+            return
+        if isinstance(value, pd.DataFrame):
+            _remember(value, key)
+        with self._lock:
+            if key in self.results:
+                return
+            self.results[key] = value
+            self.bytes += _size(value)
+            while len(self.results) > 1 and (len(self.results) > self.size
+                                             or self.bytes > STAGE_CACHE_BYTES):
+                _, old = self.results.popitem(last=False)
+                self.bytes -= _size(old)
+
+    def clear(self):
+        with self._lock:
+            self.results.clear()
+            self.bytes = 0
+
+    def _count(self, hit):
+        # called holding self._lock
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.inc('dash_stage_calls_total',
+                    (('stage', self.name), ('result', 'hit' if hit else 'miss')))
+
+
+def stage(name, version=None, size=STAGE_CACHE_SIZE):
+    # version is a string or a callable returning the current dataset version
+    def decorator(func):
+        return Stage(func, name, version, size)
+    return decorator
+
+
+def frame_key(frame):
+    entry = _frames.get(id(frame))
+    if entry is None or entry[0]() is not frame:
+        return None
+    return entry[1]
+
+
+def _remember(frame, key):
+    with _lock:
+        _frames[id(frame)] = (weakref.ref(frame, lambda _, i=id(frame): _frames.pop(i, None)), key)
+
+
+def _size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True).sum())
+    return 0
+
+
+def _load(module, qualname):
+    return getattr(importlib.import_module(module), qualname)
+
+
+def stats():
+    out = {}
+    for name, s in sorted(_stages.items()):
+        calls = s.hits + s.misses
+        out[name] = {'hits': s.hits, 'misses': s.misses, 'cached': len(s.results),
+                     'bytes': s.bytes,
+                     'hit_rate': s.hits / calls if calls else 0.0}
+    return out
+
+
+def clear():
+    for s in _stages.values():
+        s.clear()
@@ -0,0 +1,218 @@
+# figures of a page's default state sent inside its layout, and a cache warmer
+# A callback registered with prerender.callback() is not fired by the
+# browser when its page loads: the layout returned by display_page already
+# carries its outputs, computed on the server from the input values written
+# in the layout (embed(), called by PageRegistry when it builds a layout),
+# so the first paint needs no callback round trip. Memoized callbacks go
+# through the shared figure cache, the default figures are built once per
+# node. warm() lists other common selections (each continent on its own,
+# every y variable...) that start() computes in a background thread when
+# a worker boots, so the first visitors asking for them find them in the
+# figure cache too. They are computed once per node: the worker taking the
+# lock in the figure cache directory computes them and leaves a mark there
+# for the versions of the datasets it warmed, the other workers and later
+# restarts on the same data skip warming. They are computed on the figure
+# pool (FIGURE_EXECUTOR, utils/executor.py: threads, or processes started
+# from a forkserver, never forked from the worker), one after the other in
+# the warmer thread with FIGURE_EXECUTOR=serial.
+import json
+import logging
+import os
+import threading
+import time
+
+import dash
+
+from utils import catalog
+from utils import executor
+from utils.figcache import figure_cache
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, every worker then warms the cache
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+PRERENDER = os.environ.get('PRERENDER', '1') != '0'
+WARM_CACHE = os.environ.get('WARM_CACHE', '1') != '0'
+
+# (func, outputs, inputs) of the prerendered callbacks
+_callbacks = []
+# (func, list of argument tuples) to compute in the background
+_warm = []
+_stats = {'embedded': 0, 'failed': 0, 'warmed': 0}
+
+
+def callback(app, outputs, inputs, **kwargs):
+    # app.callback whose outputs come with the layout for its default inputs
+    def decorator(func):
+        if PRERENDER:
+            kwargs.setdefault('prevent_initial_call', True)
+            _callbacks.append((func, outputs, inputs))
+        app.callback(outputs, inputs, **kwargs)(func)
+        return func
+    return decorator
+
+
+def warm(func, combos):
+    # func(*args) for every args in combos is computed by start()
+    _warm.append((func, list(combos)))
+
+
+def embed(layout):
+    # sets the outputs of the prerendered callbacks found in layout
+    if not _callbacks:
+        return layout
+    components = _components(layout)
+    for func, outputs, inputs in _callbacks:
+        outputs = outputs if isinstance(outputs, list) else [outputs]
+        if not all(d.component_id in components for d in outputs + inputs):
+            continue
+        args = [getattr(components[i.component_id], i.component_property, None) for i in inputs]
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            # the graphs stay empty until the user changes a control
+            log.exception('could not prerender %s', func.__qualname__)
+            _stats['failed'] += 1
+            continue
+        results = result if len(outputs) > 1 else [result]
+        for output, value in zip(outputs, results):
+            if value is not dash.no_update:
+                setattr(components[output.component_id], output.component_property, value)
+        _stats['embedded'] += 1
+        log.info('prerendered %s.%s in %.3fs', func.__module__, func.__qualname__,
+                 time.perf_counter() - start)
+    return layout
+
+
+def _components(layout):
+    # id -> component of a layout tree
+    out = {}
+    stack = [layout]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (list, tuple)):
+            stack.extend(node)
+            continue
+        if not hasattr(node, 'to_plotly_json'):
+            continue
+        component_id = getattr(node, 'id', None)
+        if isinstance(component_id, str):
+            out[component_id] = node
+        stack.append(getattr(node, 'children', None))
+    return out
+
+
+def start(pages):
+    # builds the page layouts, then warms the figure cache, in the background
+    thread = threading.Thread(target=_run, args=(pages,), name='cache-warmer', daemon=True)
+    thread.start()
+    return thread
+
+
+def _run(pages):
+    pages.load_all()
+    for path in pages.routes:
+        pages.layout(path)
+    if not WARM_CACHE or not _warm or not figure_cache.enabled:
+        return
+    lock = _lock_file()
+    if lock is False:
+        log.info('another worker is warming the figure cache')
+        return
+    try:
+        mark = os.path.join(figure_cache.path, 'warm.done')
+        versions = json.dumps(catalog.versions(), sort_keys=True)
+        if _read(mark) == versions:
+            log.info('the figure cache was warmed for these datasets already')
+            return
+        warm_all()
+        with open(mark, 'w') as f:
+            f.write(versions)
+    except Exception:
+        log.exception('warming the figure cache failed')
+    finally:
+        if lock is not None:
+            lock.close()
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _lock_file():
+    # an open file locked for this worker, None without flock, False when
+    # another worker holds it
+    if fcntl is None:
+        return None
+    path = os.path.join(figure_cache.path, 'warm.lock')
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, 'a')
+    except OSError:
+        return None
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return False
+    return f
+
+
+def warm_all():
+    jobs = [(func, tuple(args)) for func, combos in _warm for args in combos]
+    began = time.perf_counter()
+    pool = executor.pool()
+    if pool is None:
+        done = sum(_call(func, args) for func, args in jobs)
+    else:
+        done = _pooled(pool, jobs)
+    _stats['warmed'] += done
+    log.info('warmed %d of %d figure sets in %.1fs', done, len(jobs),
+             time.perf_counter() - began)
+    return done
+
+
+def _pooled(pool, jobs):
+    # every selection at once on the pool, the ones it could not take
+    # (a broken pool, a callback that does not pickle) in this thread
+    try:
+        futures = [pool.submit(_call, func, args) for func, args in jobs]
+    except RuntimeError:
+        log.warning('figure pool unavailable, warming serially', exc_info=True)
+        return sum(_call(func, args) for func, args in jobs)
+    done = 0
+    for (func, args), future in zip(jobs, futures):
+        try:
+            done += future.result()
+        except Exception:
+            log.warning('could not warm %s%r on the pool', func.__qualname__, args,
+                        exc_info=True)
+            done += _call(func, args)
+    return done
+
+
+def _call(func, args):
+    # the figures of one selection are built in the thread computing it, a
+    # pool thread waiting on the pool it runs in could run out of threads
+    executor.serial(True)
+    try:
+        func(*args)
+        return 1
+    except Exception:
+        log.warning('could not warm %s%r', func.__qualname__, args, exc_info=True)
+        return 0
+    finally:
+        executor.serial(False)
+
+
+def stats():
+    return dict(_stats, callbacks=len(_callbacks),
+                combos=sum(len(combos) for _, combos in _warm))
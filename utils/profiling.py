@@ -0,0 +1,275 @@
+# on-demand sampling profiler for single callback requests
+# With PROFILING=1 and a PROFILE_TOKEN a /_dash-update-component request is
+# profiled when it carries an "X-Profile" header equal to the token, while
+# profiling is switched on through /_profiling, or at random for a
+# PROFILE_RATE fraction of requests; without a token profiling stays off.
+# A background thread then samples the stack of the thread answering the
+# request every PROFILE_INTERVAL seconds and the samples are written to
+# PROFILE_DIR as collapsed stacks, one
+# "root;caller;callee count" line per distinct stack, which flamegraph.pl,
+# speedscope and inferno read as they are. The root frame is the callback
+# (e.g. Europe.update_graphs); a .json file next to it holds the inputs.
+# Only the newest PROFILE_KEEP profiles are kept. With PROFILING unset no
+# hook is installed at all. Only that thread is sampled, so the figures of
+# a profiled request are built in it (executor.serial, utils/executor.py)
+# rather than in pool threads or processes missing from the profile; other
+# requests use FIGURE_EXECUTOR as usual.
+import collections
+import datetime
+import hmac
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import Response, abort, g, request
+
+from utils import executor
+from utils import metrics
+
+log = logging.getLogger(__name__)
+
+PROFILING = os.environ.get('PROFILING', '0') == '1'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# fraction of callback requests profiled without being asked to
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', 0))
+# seconds between two samples of the stack
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 100))
+# value of the X-Profile header and of /_profiling's, profiling is off without it
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the switch set through /_profiling, in PROFILE_DIR so every worker sees it
+SWITCH = '.switch.json'
+
+_lock = threading.Lock()
+_switch = {'checked': 0.0, 'rate': 0.0, 'until': 0.0}
+
+
+class Sampler(threading.Thread):
+    # samples the stack of one thread until stopped
+
+    def __init__(self, ident, interval=PROFILE_INTERVAL):
+        super().__init__(name='profiler', daemon=True)
+        self.target = ident
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                break
+            self.stacks[_stack(frame)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (_short(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+def _short(path):
+    # paths relative to the repo, or to site-packages for libraries
+    if path.startswith(ROOT + os.sep):
+        return path[len(ROOT) + 1:]
+    marker = os.sep + 'site-packages' + os.sep
+    if marker in path:
+        return path.split(marker, 1)[1]
+    return os.path.basename(path)
+
+
+def init_app(app):
+    if not PROFILING:
+        return
+    if not PROFILE_TOKEN:
+        log.warning('PROFILING=1 needs a PROFILE_TOKEN, profiling stays off')
+        return
+    server = app.server
+
+    def start():
+        if not request.path.endswith('/_dash-update-component') or not _wanted():
+            return
+        sampler = Sampler(threading.get_ident())
+        g.profile = (sampler, time.perf_counter())
+        executor.serial(True)
+        sampler.start()
+
+    def finish(response):
+        state = g.pop('profile', None)
+        if state is None:
+            return response
+        sampler, began = state
+        sampler.stop()
+        executor.serial(False)
+        try:
+            name = write(app, sampler, time.perf_counter() - began, response.status_code)
+            response.headers['X-Profile-Id'] = name
+        except OSError as e:
+            log.warning('could not write profile to %s: %s', PROFILE_DIR, e)
+        return response
+
+    server.before_request(start)
+    server.after_request(finish)
+    # also when the request failed before finish
+    server.teardown_request(lambda exc: executor.serial(False))
+    server.add_url_rule('/_profiling', 'profiling', _toggle, methods=['GET', 'POST'])
+    log.info('profiling callback requests on demand, sample rate %g', PROFILE_RATE)
+
+
+def _wanted():
+    asked = request.headers.get('X-Profile')
+    if asked is not None:
+        return _is_token(asked)
+    rate = max(PROFILE_RATE, _switched_rate())
+    return rate > 0 and random.random() < rate
+
+
+def _switched_rate():
+    # the /_profiling switch, read again at most once a second
+    now = time.time()
+    if now - _switch['checked'] > 1:
+        try:
+            with open(os.path.join(PROFILE_DIR, SWITCH)) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+        _switch.update(checked=now, rate=float(saved.get('rate', 0)),
+                       until=float(saved.get('until', 0)))
+    return _switch['rate'] if now < _switch['until'] else 0.0
+
+
+def _is_token(value):
+    # compared in constant time, not to give the token away by timing
+    return hmac.compare_digest(value.encode(), PROFILE_TOKEN.encode())
+
+
+def _toggle():
+    # GET shows the switch, POST rate=<0..1>&seconds=<n> turns it on for a while
+    if not _is_token(request.headers.get('X-Profile-Token', '')):
+        abort(403)
+    if request.method == 'POST':
+        try:
+            rate = min(max(float(request.values.get('rate', 1)), 0.0), 1.0)
+            seconds = float(request.values.get('seconds', 300))
+        except ValueError:
+            abort(400, 'rate and seconds are numbers')
+        if not (math.isfinite(rate) and math.isfinite(seconds)):
+            abort(400, 'rate and seconds are finite numbers')
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, SWITCH)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'rate': rate, 'until': time.time() + seconds}, f)
+        os.replace(path + '.tmp', path)
+        _switch['checked'] = 0.0
+        log.info('profiling %g of callback requests for %gs', rate, seconds)
+    rate = _switched_rate()
+    body = {'rate': rate, 'seconds_left': max(_switch['until'] - time.time(), 0) if rate else 0,
+            'default_rate': PROFILE_RATE, 'profiles': profiles()[-20:]}
+    return Response(json.dumps(body, indent=1), mimetype='application/json')
+
+
+def write(app, sampler, seconds, status):
+    # writes <time>-<callback>.folded and .json, returns the base name
+    body = request.get_json(silent=True) or {}
+    callback = metrics.callback_name(app, body)
+    stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    name = '%s-%d-%s' % (stamp, os.getpid(), callback)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name)
+    with open(path + '.folded', 'w') as f:
+        for stack, count in sampler.stacks.most_common():
+            f.write('%s;%s %d\n' % (callback, ';'.join(stack), count))
+    inputs = {'%s.%s' % (_id(i.get('id')), i.get('property')): i.get('value')
+              for i in _flat(body.get('inputs', [])) + _flat(body.get('state', []))}
+    with open(path + '.json', 'w') as f:
+        json.dump({'callback': callback, 'inputs': inputs, 'seconds': seconds,
+                   'samples': sampler.samples, 'interval': sampler.interval,
+                   'status': status, 'pid': os.getpid()}, f, indent=1, default=str)
+    _rotate()
+    log.info('profiled %s in %.3fs (%d samples): %s.folded', callback, seconds,
+             sampler.samples, path)
+    return name
+
+
+def _flat(items):
+    # pattern-matching callbacks send lists of inputs for one argument
+    out = []
+    for item in items:
+        out.extend(item if isinstance(item, list) else [item])
+    return out
+
+
+def _id(component_id):
+    if isinstance(component_id, dict):
+        return json.dumps(component_id, sort_keys=True, separators=(',', ':'))
+    return component_id
+
+
+def profiles():
+    try:
+        names = os.listdir(PROFILE_DIR)
+    except OSError:
+        return []
+    return sorted(n[:-len('.folded')] for n in names if n.endswith('.folded'))
+
+
+def _rotate():
+    with _lock:
+        for name in profiles()[:-PROFILE_KEEP or None]:
+            for ext in ('.folded', '.json'):
+                try:
+                    os.unlink(os.path.join(PROFILE_DIR, name + ext))
+                except OSError:
+                    pass
+
+
+if __name__ == '__main__':
+    # profile one Europe page request and print its hottest frames:
+    #   PROFILING=1 PROFILE_TOKEN=secret python -m utils.profiling
+    import importlib
+    import index
+    importlib.import_module('apps.Europe')  # not routed, registers its callback
+    from utils import figpack, profiling
+
+    client = index.server.test_client()
+    client.get('/_dash-dependencies')
+    outputs = [{'id': figpack.store_id(graph), 'property': 'data'}
+               for graph in ('barchart', 'geochart', 'trendline')]
+    body = {'output': '..%s..' % '...'.join('%(id)s.%(property)s' % o for o in outputs),
+            'outputs': outputs,
+            'inputs': [{'id': 'country_dropdown', 'property': 'value',
+                        'value': ['Ireland', 'France']},
+                       {'id': 'eur_pop_range', 'property': 'value', 'value': [100000, 90000000]},
+                       {'id': 'eur_y_dropdown', 'property': 'value', 'value': 'lifeExp'}],
+            'changedPropIds': []}
+    r = client.post('/_dash-update-component', data=json.dumps(body),
+                    content_type='application/json',
+                    headers={'X-Profile': profiling.PROFILE_TOKEN})
+    name = r.headers.get('X-Profile-Id')
+    if name is None:
+        print('not profiled, run with PROFILING=1 and a PROFILE_TOKEN')
+    else:
+        own = collections.Counter()
+        with open(os.path.join(profiling.PROFILE_DIR, name + '.folded')) as f:
+            for line in f:
+                stack, count = line.rsplit(' ', 1)
+                own[stack.split(';')[-1]] += int(count)
+        print('%s.folded, hottest frames (samples):' % name)
+        for frame, count in own.most_common(15):
+            print('%6d  %s' % (count, frame))
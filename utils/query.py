@@ -0,0 +1,188 @@
+# small in-memory query engine used by the page callbacks
+# rows are kept sorted on one numeric key column (e.g. 'pop') so a range
+# filter is two binary searches, and string columns such as 'continent' or
+# 'country' are stored as integer codes so a set filter is a lookup into a
+# boolean mask indexed by code
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+class QueryEngine:
+
+    def __init__(self, frame, key, categorical=()):
+        columns = {}
+        categories = {}
+        for col in frame.columns:
+            if col in categorical:
+                cat = pd.Categorical(frame[col])
+                categories[col] = cat.categories
+                columns[col] = np.asarray(cat.codes)
+            else:
+                columns[col] = frame[col].to_numpy()
+        self._build(columns, key, categories)
+
+    @classmethod
+    def from_arrays(cls, columns, key, categories=None, version=None, rows=None):
+        # build from plain (or memory-mapped) arrays, string columns given as
+        # integer codes into categories[col]; arrays already sorted on key
+        # are used as they are, without a copy, and `rows` then gives the
+        # position each row had before it was sorted
+        engine = cls.__new__(cls)
+        engine._build(dict(columns), key, categories or {}, version, rows)
+        return engine
+
+    def _build(self, columns, key, categories, version=None, rows=None):
+        self.key = key
+        self.columns = list(columns)
+        keys = columns[key]
+        # skip the sort (and the copy) when the rows are already ordered on key
+        if len(keys) < 2 or bool(np.all(keys[1:] >= keys[:-1])):
+            order = None
+            self.rows = np.arange(len(keys)) if rows is None else np.asarray(rows)
+        else:
+            order = np.argsort(keys, kind='stable')
+            self.rows = order
+        # self.rows holds the original position of every sorted row and is
+        # used to give results back in the order of the source frame
+        self.data = {}
+        self.codes = {}
+        self.categories = {}
+        for col, values in columns.items():
+            values = _sorted(values, order)
+            if col in categories:
+                self.categories[col] = np.asarray(categories[col], dtype=object)
+                self.codes[col] = values
+            else:
+                self.data[col] = values
+        self.keys = self.data[key]
+        for arr in list(self.data.values()) + list(self.codes.values()) + [self.rows]:
+            arr.flags.writeable = False
+        self.version = version or self._fingerprint()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _fingerprint(self):
+        h = hashlib.sha1()
+        for col in self.columns:
+            arr = self.data.get(col, self.codes.get(col))
+            h.update(col.encode())
+            h.update(np.ascontiguousarray(arr).tobytes())
+            if col in self.categories:
+                h.update('\0'.join(map(str, self.categories[col])).encode())
+        return h.hexdigest()[:16]
+
+    def unique(self, col):
+        # distinct values of a categorical column in order of first appearance
+        codes = self.codes[col][np.argsort(self.rows, kind='stable')]
+        codes = codes[codes >= 0]
+        _, first = np.unique(codes, return_index=True)
+        return self.categories[col][codes[np.sort(first)]]
+
+    def positions(self, key_range=None, **selections):
+        # sorted-order positions of the rows matching the range and every
+        # set selection; rows come back grouped in the order the values of
+        # the (single) selection were given, then in original row order
+        lo, hi = self._bounds(key_range)
+        if hi <= lo:
+            return np.empty(0, dtype=np.intp)
+        mask = self._mask(lo, hi, selections)
+        if mask is None:
+            pos = np.arange(lo, hi)
+        else:
+            pos = np.flatnonzero(mask) + lo
+        rank_col = next((col for col, wanted in selections.items() if wanted is not None), None)
+        if rank_col is None:
+            return pos[np.argsort(self.rows[pos], kind='stable')]
+        cats = self.categories[rank_col]
+        lookup, found = self._lookup(rank_col, selections[rank_col])
+        rank = np.full(len(cats) + 1, len(cats), dtype=np.intp)
+        # first occurrence wins for duplicated selections
+        rank[lookup[found][::-1]] = np.nonzero(found)[0][::-1]
+        return pos[np.lexsort((self.rows[pos], rank[self.codes[rank_col][pos]]))]
+
+    def blocks(self, key_range=None, size=65536, **selections):
+        # positions of the matching rows in key order, looking at `size`
+        # sorted rows at a time, to read a large selection piece by piece
+        lo, hi = self._bounds(key_range)
+        for start in range(lo, hi, size):
+            stop = min(start + size, hi)
+            mask = self._mask(start, stop, selections)
+            pos = np.arange(start, stop) if mask is None else np.flatnonzero(mask) + start
+            if len(pos):
+                yield pos
+
+    def _bounds(self, key_range):
+        # [lo, hi) sorted positions of the rows inside the key range
+        if key_range is None:
+            return 0, len(self.keys)
+        return (int(np.searchsorted(self.keys, key_range[0], side='left')),
+                int(np.searchsorted(self.keys, key_range[1], side='right')))
+
+    def _lookup(self, col, wanted):
+        if isinstance(wanted, str):
+            wanted = [wanted]
+        lookup = pd.Index(self.categories[col]).get_indexer(list(wanted))
+        return lookup, lookup >= 0
+
+    def _mask(self, lo, hi, selections):
+        # rows lo:hi matching every set selection, None when there is none
+        mask = None
+        for col, wanted in selections.items():
+            if wanted is None:
+                continue
+            lookup, found = self._lookup(col, wanted)
+            # one extra slot so missing values (code -1) never match
+            bits = np.zeros(len(self.categories[col]) + 1, dtype=bool)
+            bits[lookup[found]] = True
+            m = bits[self.codes[col][lo:hi]]
+            mask = m if mask is None else mask & m
+        return mask
+
+    def snap(self, key_range):
+        # the narrowest range selecting the same rows: both ends moved in to
+        # the nearest key values inside it, so slider positions between two
+        # data values give the same range (and the same cache key)
+        if key_range is None:
+            return None
+        lo = int(np.searchsorted(self.keys, key_range[0], side='left'))
+        hi = int(np.searchsorted(self.keys, key_range[1], side='right'))
+        if hi <= lo:
+            return list(key_range)
+        return [self.keys[lo].item(), self.keys[hi - 1].item()]
+
+    def select(self, key_range=None, columns=None, **selections):
+        # filtered rows as a DataFrame with the original column dtypes
+        pos = self.positions(key_range, **selections)
+        return self.take(pos, columns)
+
+    def take(self, pos, columns=None):
+        out = {}
+        for col in columns or self.columns:
+            if col in self.codes:
+                labels = np.append(self.categories[col], None)
+                out[col] = labels.take(self.codes[col][pos])
+            elif self.data[col].dtype == np.float32:
+                out[col] = _widen(self.data[col][pos])
+            elif self.data[col].dtype.kind in 'iu':
+                # plotly express takes unsigned ints for discrete values
+                out[col] = self.data[col][pos].astype(np.int64)
+            else:
+                out[col] = self.data[col][pos]
+        return pd.DataFrame(out, copy=False)
+
+
+def _widen(values):
+    # float32 -> float64 keeping the 7 significant digits float32 holds, so
+    # figures show 28.801 rather than 28.80099868774414
+    out = values.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        digits = np.floor(np.log10(np.abs(out)))
+    scale = 10.0 ** (6 - np.where(np.isfinite(digits), digits, 0))
+    return np.round(out * scale) / scale
+
+
+def _sorted(arr, order):
+    return arr if order is None else arr[order]
@@ -0,0 +1,96 @@
+# hot reload of the datasets when their source files change
+# A thread in every worker looks at the source files of the loaded datasets
+# every REFRESH_INTERVAL seconds (catalog.changed()) and reloads the changed
+# ones: lines appended to the shots CSV are parsed and merged on their own
+# (utils/shots.py, one worker does it under a file lock, the others map the
+# result) and the shot cube only counts those rows (utils/cube.py). The new
+# version is swapped in at once by catalog.reload(). Every request pins the
+# datasets it started with (init_app), so callbacks running during a reload
+# finish on the old version while the next requests get the new one.
+# Caches follow the dataset version: the figure cache and pipeline stage
+# keys hold it, so figures of the old version are never served again and
+# age out, and the on_swap() listeners (the prerendered page layouts) are
+# told which datasets changed.
+import logging
+import os
+import threading
+import time
+
+from flask import g
+
+from utils import catalog
+
+log = logging.getLogger(__name__)
+
+# seconds between two looks at the source files, 0 turns reloading off
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL', 5))
+
+_listeners = []
+_stats = {'checks': 0, 'reloads': 0, 'failed': 0, 'seconds': 0.0}
+
+
+def on_swap(func):
+    # func(names) is called after new versions of those datasets are swapped in
+    _listeners.append(func)
+    return func
+
+
+def init_app(app):
+    server = app.server
+
+    def pin():
+        g.datasets = catalog.pin()
+
+    def unpin(exc=None):
+        token = g.pop('datasets', None)
+        if token is not None:
+            catalog.unpin(token)
+
+    server.before_request(pin)
+    server.teardown_request(unpin)
+
+
+def check():
+    # reloads the datasets whose source changed, returns their names
+    _stats['checks'] += 1
+    names = catalog.changed()
+    if not names:
+        return []
+    start = time.perf_counter()
+    reloaded = []
+    for name in names:
+        try:
+            reloaded += catalog.reload(name)
+        except Exception:
+            # the previous version keeps being served
+            _stats['failed'] += 1
+            log.exception('could not reload dataset %s', name)
+    if reloaded:
+        _stats['reloads'] += 1
+        _stats['seconds'] += time.perf_counter() - start
+        for func in _listeners:
+            func(reloaded)
+    return reloaded
+
+
+def start(interval=None):
+    interval = REFRESH_INTERVAL if interval is None else interval
+    if interval <= 0:
+        return None
+    thread = threading.Thread(target=_watch, args=(interval,), name='dataset-refresh',
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def _watch(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            check()
+        except Exception:
+            log.exception('dataset refresh failed')
+
+
+def stats():
+    return dict(_stats)
@@ -0,0 +1,229 @@
+# HTTP layer of the Dash server: compression, ETags and cache headers
+# Responses are compressed with brotli or gzip, whichever the browser
+# prefers (Flask-Compress), and the compressed bodies are kept in a small
+# LRU keyed by content hash, so a callback answering the same selection
+# again or a static file asked for by every visitor is compressed only once.
+# GET responses get a strong ETag and are answered with 304 Not Modified
+# when the browser already has them. Assets linked with asset_url() carry
+# their mtime in the URL and are cached by the browser for a year.
+import collections
+import hashlib
+import logging
+import os
+import threading
+
+from flask import Response, g, request
+from flask_compress import Compress
+
+log = logging.getLogger(__name__)
+
+# comma separated encodings in order of preference, empty to turn it off
+HTTP_COMPRESSION = os.environ.get('HTTP_COMPRESSION', 'br,gzip')
+# bytes of compressed bodies kept for reuse
+HTTP_COMPRESS_CACHE_BYTES = int(os.environ.get('HTTP_COMPRESS_CACHE_BYTES', 32 * 2 ** 20))
+# seconds the browser may keep a fingerprinted asset
+ASSET_MAX_AGE = int(os.environ.get('ASSET_MAX_AGE', 31536000))
+
+_lock = threading.Lock()
+# kind of request -> {'requests', 'raw', 'sent', 'not_modified'}
+_stats = {}
+
+
+class CachedCompress(Compress):
+    # Flask-Compress, reusing the compressed body of content seen before
+
+    def __init__(self, app=None, max_bytes=HTTP_COMPRESS_CACHE_BYTES):
+        self.bodies = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._body_lock = threading.Lock()
+        super().__init__(app)
+
+    def compress(self, app, response, algorithm):
+        data = response.get_data()
+        key = (algorithm, hashlib.sha1(data).digest())
+        with self._body_lock:
+            body = self.bodies.get(key)
+            if body is not None:
+                self.bodies.move_to_end(key)
+                self.hits += 1
+                return body
+        body = super().compress(app, response, algorithm)
+        with self._body_lock:
+            self.misses += 1
+            if len(body) <= self.max_bytes and key not in self.bodies:
+                self.bodies[key] = body
+                self.size += len(body)
+                while self.size > self.max_bytes:
+                    _, old = self.bodies.popitem(last=False)
+                    self.size -= len(old)
+        return body
+
+
+compress = None
+
+
+def init_app(app):
+    global compress
+    server = app.server
+    # after_request hooks run last registered first: ETags are computed on
+    # the raw body, then it is compressed, then the bytes sent are counted
+    server.after_request(_count)
+    algorithms = [a.strip() for a in HTTP_COMPRESSION.split(',') if a.strip() not in ('', '0')]
+    if algorithms:
+        server.config['COMPRESS_ALGORITHM'] = algorithms
+        server.config.setdefault('COMPRESS_BR_LEVEL', 4)
+        server.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'text/plain', 'text/xml',
+                                               'text/javascript', 'application/json',
+                                               'application/javascript', 'image/svg+xml']
+        compress = CachedCompress(server)
+        log.info('compressing responses with %s', ', '.join(algorithms))
+    server.before_request(_start)
+    server.after_request(_conditional)
+
+
+def asset_url(app, path):
+    # URL of a file in assets/ that changes when the file does
+    full = os.path.join(app.config.assets_folder, path)
+    try:
+        version = int(os.path.getmtime(full))
+    except OSError:
+        return app.get_asset_url(path)
+    return '%s?m=%d' % (app.get_asset_url(path), version)
+
+
+def _kind(path):
+    if '/_dash-update-component' in path:
+        return 'callbacks'
+    if '/_dash-component-suites/' in path:
+        return 'component suites'
+    if '/assets/' in path:
+        return 'assets'
+    if '/_dash-' in path:
+        return 'layout'
+    return 'pages'
+
+
+def _start():
+    g.raw_bytes = None
+
+
+def _conditional(response):
+    g.raw_bytes = response.content_length
+    if request.method != 'GET' or response.status_code != 200:
+        return response
+    if '/assets/' in request.path:
+        _asset_headers(response)
+    if response.get_etag()[0] is None:
+        if response.direct_passthrough:
+            # a file being streamed, known by its path, size and mtime
+            key = '%s %s %s' % (request.path, response.content_length, response.last_modified)
+            response.set_etag(hashlib.sha1(key.encode()).hexdigest())
+        elif response.is_streamed:
+            # written while it is sent (utils/export.py), nothing to hash
+            return response
+        else:
+            response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    tag = response.get_etag()[0]
+    # the compressed response went out as "tag:br", any encoding will do
+    sent = request.headers.get('If-None-Match', '')
+    for candidate in sent.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"').split(':')[0] == tag:
+            not_modified = Response(status=304)
+            not_modified.headers['ETag'] = candidate
+            for header in ('Cache-Control', 'Vary', 'Expires'):
+                if header in response.headers:
+                    not_modified.headers[header] = response.headers[header]
+            response.close()
+            return not_modified
+    return response
+
+
+def _asset_headers(response):
+    if request.args.get('m'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+
+
+def _count(response):
+    raw = g.get('raw_bytes')
+    sent = response.content_length
+    kind = _kind(request.path)
+    with _lock:
+        s = _stats.setdefault(kind, {'requests': 0, 'raw': 0, 'sent': 0, 'not_modified': 0})
+        s['requests'] += 1
+        if response.status_code == 304:
+            s['not_modified'] += 1
+        s['raw'] += raw or sent or 0
+        s['sent'] += sent or 0
+    return response
+
+
+def stats():
+    with _lock:
+        out = {kind: dict(s) for kind, s in _stats.items()}
+    if compress is not None:
+        out['compressed bodies'] = {'hits': compress.hits, 'misses': compress.misses,
+                                    'bytes': compress.size}
+    return out
+
+
+if __name__ == '__main__':
+    # bytes on the wire for a visit of the Global page, with and without
+    # compression and for a second visit revalidating what it has:
+    #   python -m utils.serving
+    import json
+    import index
+    from utils import serving
+
+    client = index.server.test_client()
+
+    def visit(headers, etags=None):
+        sizes = collections.Counter()
+        etags = {} if etags is None else etags
+        urls = ['/', '/_dash-layout', '/_dash-dependencies',
+                index.app.get_asset_url('clientside.js'),
+                asset_url(index.app, 'dkit_logo.png'), asset_url(index.app, 'hansRoslin.jpeg')]
+        for url in urls:
+            h = dict(headers)
+            if url in etags:
+                h['If-None-Match'] = etags[url]
+            r = client.get(url, headers=h)
+            if r.headers.get('ETag'):
+                etags[url] = r.headers['ETag']
+            sizes[_kind(url)] += len(r.data)
+        body = {'output': '..LifeExp_packed.data...LifeExpOverTime_packed.data..',
+                'outputs': [{'id': 'LifeExp_packed', 'property': 'data'},
+                            {'id': 'LifeExpOverTime_packed', 'property': 'data'}],
+                'inputs': [{'id': 'cont_dropdown', 'property': 'value',
+                            'value': ['Asia', 'Europe', 'Africa', 'Americas', 'Oceania']},
+                           {'id': 'pop_range', 'property': 'value', 'value': [60011, 1318683096]},
+                           {'id': 'y_dropdown', 'property': 'value', 'value': 'lifeExp'}],
+                'changedPropIds': []}
+        r = client.post('/_dash-update-component', data=json.dumps(body),
+                        content_type='application/json', headers=headers)
+        sizes['callbacks'] += len(r.data)
+        return sizes, etags
+
+    client.get('/_dash-dependencies')
+    identity, _ = visit({'Accept-Encoding': 'identity'})
+    gz, _ = visit({'Accept-Encoding': 'gzip'})
+    br, etags = visit({'Accept-Encoding': 'gzip, deflate, br'})
+    again, _ = visit({'Accept-Encoding': 'gzip, deflate, br'}, etags)
+    print('%-18s %10s %10s %10s %14s' % ('', 'identity', 'gzip', 'br', 'br revisit'))
+    for kind in sorted(identity):
+        print('%-18s %10d %10d %10d %14d' % (kind, identity[kind], gz[kind], br[kind], again[kind]))
+    print('%-18s %10d %10d %10d %14d' % ('total', sum(identity.values()), sum(gz.values()),
+                                         sum(br.values()), sum(again.values())))
+    if 'compressed bodies' in serving.stats():
+        print('compressed bodies reused: %(hits)d, compressed: %(misses)d'
+              % serving.stats()['compressed bodies'])
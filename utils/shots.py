@@ -0,0 +1,370 @@
+# loading of the gaelic match shot data used by apps/dashboard.py
+# the CSV is converted once into one .npy file per column (county stored as
+# integer codes plus a list of names) next to a meta.json, and every process
+# then memory-maps those files, so all gunicorn workers share the same pages
+# instead of each one parsing the CSV into object columns.
+# The conversion is redone whenever the CSV changes size or modification time,
+# except when rows were only appended to it: then only the new lines are
+# parsed and merged into the sorted columns (append()), and the positions
+# they took are kept so aggregates over the shots can be updated with just
+# those rows. Only complete lines are read, a line being written is picked
+# up by the next load. Each conversion or append is written to a directory
+# of its own and the cache path, a symlink, is flipped to it at once.
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from utils.arrays import compact
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, workers may then convert the CSV at the same time
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHOTS_CSV = os.environ.get('SHOTS_CSV', os.path.join(ROOT, 'data', 'cleaned_data.csv'))
+SHOTS_CACHE = os.environ.get('SHOTS_CACHE')
+
+# columns the dashboard needs and the kind of values they must hold
+SCHEMA = {
+    'county': 'category',
+    'build_up_passes': 'numeric',
+    'distance_from_goal': 'numeric',
+    'angle': 'numeric',
+}
+# rows are stored sorted on this column so range queries need no sort
+SORT_KEY = 'build_up_passes'
+# bytes before the end of the converted part of the CSV that must be
+# unchanged for the CSV to count as appended to
+TAIL = 4096
+
+
+class ShotTable:
+
+    def __init__(self, columns, categories, version, base=None, added=None):
+        self.columns = columns
+        self.categories = categories
+        self.version = version
+        # the version these columns were appended to, and the (sorted)
+        # positions the appended rows took
+        self.base = base
+        self.added = added
+
+    def __len__(self):
+        return len(self.columns[SORT_KEY])
+
+    def to_frame(self):
+        out = {}
+        for col, values in self.columns.items():
+            if col in self.categories:
+                out[col] = pd.Categorical.from_codes(values, self.categories[col])
+            else:
+                out[col] = values
+        return pd.DataFrame(out)
+
+
+def cache_dir(csv_path):
+    return SHOTS_CACHE or os.path.splitext(csv_path)[0] + '_columns'
+
+
+def load(csv_path=None):
+    csv_path = csv_path or SHOTS_CSV
+    if not os.path.exists(csv_path):
+        log.warning('shot data %s not found, the dashboard will be empty', csv_path)
+        return empty()
+    start = time.perf_counter()
+    target = cache_dir(csv_path)
+    source = _source_stamp(csv_path)
+    # the version target points to now, meta and columns are read from it
+    directory = os.path.realpath(target)
+    meta = _read_meta(directory)
+    if meta is None or meta['source'] != source:
+        # one process at a time, an append must see the columns it extends
+        with _locked(target):
+            directory = os.path.realpath(target)
+            meta = _read_meta(directory)
+            if meta is None or meta['source'] != _source_stamp(csv_path):
+                try:
+                    appended = meta is not None and append(csv_path, directory, target, meta)
+                except ValueError:
+                    # the new lines do not fit the columns, convert() says why
+                    appended = False
+                if not appended:
+                    convert(csv_path, target)
+                directory = os.path.realpath(target)
+                meta = _read_meta(directory)
+    columns = {col: np.load(os.path.join(directory, col + '.npy'), mmap_mode='r')
+               for col in meta['columns']}
+    added = None
+    if meta.get('base') is not None:
+        added = np.load(os.path.join(directory, 'added.npy'), mmap_mode='r')
+    log.info('loaded %d shots from %s in %.3fs', meta['rows'], directory,
+             time.perf_counter() - start)
+    return ShotTable(columns, meta['categories'], meta['version'], meta.get('base'), added)
+
+
+def empty():
+    columns = {col: np.empty(0, dtype=np.int8 if kind == 'category' else np.float64)
+               for col, kind in SCHEMA.items()}
+    return ShotTable(columns, {col: [] for col, kind in SCHEMA.items() if kind == 'category'},
+                     'empty')
+
+
+def check_schema(df):
+    missing = [col for col in SCHEMA if col not in df.columns]
+    if missing:
+        raise ValueError('shot data is missing columns: %s' % ', '.join(missing))
+    for col, kind in SCHEMA.items():
+        if kind == 'numeric' and not pd.api.types.is_numeric_dtype(df[col]):
+            raise ValueError('shot data column %r should be numeric, got %s' % (col, df[col].dtype))
+
+
+def convert(csv_path, target):
+    start = time.perf_counter()
+    source = _source_stamp(csv_path)
+    with open(csv_path, 'rb') as f:
+        end = _complete(f, source['size']) or source['size']
+        f.seek(0)
+        df = pd.read_csv(io.BufferedReader(_Slice(f, end)))
+        tail = _digest(f, end)
+    check_schema(df)
+    header = list(df.columns)
+    df = df.sort_values(SORT_KEY, kind='stable')
+    categories = {}
+    arrays = {}
+    for col in df.columns:
+        values = df[col]
+        if SCHEMA.get(col) == 'category' or not pd.api.types.is_numeric_dtype(values):
+            codes, cats = values.factorize(sort=True)
+            arrays[col] = compact(codes)
+            categories[col] = [str(c) for c in cats]
+        else:
+            arrays[col] = compact(values.to_numpy())
+    meta = {'source': source, 'rows': len(df), 'columns': list(arrays), 'categories': categories,
+            'version': _version(source, tail), 'header': header, 'offset': end, 'tail': tail}
+    _write(target, arrays, meta)
+    log.info('converted %s to %s in %.3fs', csv_path, target, time.perf_counter() - start)
+
+
+def append(csv_path, directory, target, meta):
+    # merges the lines appended to the CSV since meta was written into the
+    # columns read from directory and writes them to target; False when
+    # the CSV was changed in another way
+    start = time.perf_counter()
+    source = _source_stamp(csv_path)
+    offset = meta.get('offset')
+    if offset is None or source['size'] <= offset:
+        return False
+    with open(csv_path, 'rb') as f:
+        if _digest(f, offset) != meta['tail']:
+            return False
+        end = _complete(f, source['size'])
+        if end <= offset:
+            return False
+        f.seek(offset)
+        new = pd.read_csv(io.BufferedReader(_Slice(f, end - offset)), header=None,
+                          names=meta['header'])
+        tail = _digest(f, end)
+    check_schema(new)
+    new = new.sort_values(SORT_KEY, kind='stable')
+    old = {col: np.load(os.path.join(directory, col + '.npy'), mmap_mode='r')
+           for col in meta['columns']}
+    # after the rows with the same key, as a full conversion would put them
+    at = np.searchsorted(old[SORT_KEY], new[SORT_KEY].to_numpy(), side='right')
+    categories = {col: list(cats) for col, cats in meta['categories'].items()}
+    arrays = {}
+    for col in meta['columns']:
+        if col in categories:
+            values = _codes(new[col], categories[col])
+        else:
+            values = new[col].to_numpy()
+            if values.dtype.kind not in 'biuf':
+                raise ValueError('appended shot data column %r is not numeric' % col)
+        dtype = np.result_type(old[col].dtype, values.dtype)
+        arrays[col] = compact(np.insert(old[col].astype(dtype), at, values))
+    meta = {'source': source, 'rows': meta['rows'] + len(new), 'columns': list(arrays),
+            'categories': categories, 'version': _version(source, tail), 'header': meta['header'],
+            'offset': end, 'tail': tail, 'base': meta['version']}
+    # np.insert puts the i-th new row at at[i] + i
+    _write(target, arrays, meta, {'added': at + np.arange(len(new))})
+    log.info('appended %d shots from %s to %s in %.3fs', len(new), csv_path, target,
+             time.perf_counter() - start)
+    return True
+
+
+def _write(target, arrays, meta, extra=None):
+    # every version goes to a directory of its own and target, a symlink,
+    # is flipped to it in one step: a reader resolves target once and reads
+    # meta.json and the columns of the same version from there
+    target = os.path.abspath(target)
+    parent = os.path.dirname(target)
+    name = os.path.basename(target)
+    tmp = tempfile.mkdtemp(dir=parent, prefix=name + '.')
+    try:
+        for key, arr in list(arrays.items()) + list((extra or {}).items()):
+            np.save(os.path.join(tmp, key + '.npy'), arr)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        link = tmp + '.link'
+        try:
+            os.symlink(os.path.basename(tmp), link)
+        except (OSError, NotImplementedError):
+            # no symlinks (Windows without the privilege)
+            _swap(target, tmp)
+            return
+        previous = os.path.realpath(target) if os.path.islink(target) else None
+        legacy = None
+        if os.path.isdir(target) and not os.path.islink(target):
+            # columns written before versioned directories, made an old version
+            legacy = tempfile.mkdtemp(dir=parent, prefix=name + '.')
+            os.rename(target, legacy)
+        try:
+            os.replace(link, target)
+        except OSError:
+            if legacy is not None and not os.path.lexists(target):
+                os.rename(legacy, target)
+            os.remove(link)
+            raise
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    # the previous version is kept for the readers that just resolved it
+    _prune(parent, name, keep={tmp, previous})
+
+
+def _swap(target, tmp):
+    # directory swap, the old columns are put back if the new ones cannot
+    # take their place; another worker may have swapped its own in first
+    old = None
+    if os.path.exists(target):
+        old = tempfile.mkdtemp(dir=os.path.dirname(target), prefix='.shots-old-')
+        os.rename(target, os.path.join(old, 'columns'))
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(target):
+            if old is None:
+                raise
+            os.rename(os.path.join(old, 'columns'), target)
+    if old:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def _prune(parent, name, keep):
+    # versions of the columns older than the ones in keep
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if (entry.startswith(name + '.') and path not in keep and os.path.isdir(path)
+                and not os.path.islink(path)):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def _locked(target):
+    if fcntl is None:
+        yield
+        return
+    path = os.path.abspath(target) + '.lock'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def _codes(values, cats):
+    # codes of values in cats, names not seen before are added to cats
+    names = values.astype(str).where(values.notna())
+    seen = set(cats)
+    cats.extend(n for n in pd.unique(names.dropna()) if n not in seen)
+    return pd.Index(cats).get_indexer(names)
+
+
+class _Slice(io.RawIOBase):
+    # the next `size` bytes of a file, for pd.read_csv
+
+    def __init__(self, f, size):
+        self.f = f
+        self.left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.f.read(min(len(buffer), self.left))
+        buffer[:len(data)] = data
+        self.left -= len(data)
+        return len(data)
+
+
+def _complete(f, size):
+    # length of the part of the file ending with its last complete line
+    pos = size
+    while pos > 0:
+        step = min(65536, pos)
+        f.seek(pos - step)
+        i = f.read(step).rfind(b'\n')
+        if i >= 0:
+            return pos - step + i + 1
+        pos -= step
+    return 0
+
+
+def _digest(f, end):
+    # hash of the TAIL bytes before end
+    f.seek(max(end - TAIL, 0))
+    return hashlib.sha1(f.read(min(end, TAIL))).hexdigest()
+
+
+def _version(source, tail):
+    # changes with every rewrite of the CSV, even one of the same size within
+    # the same second, so figure cache and stage keys change with it
+    return '%x-%x-%s' % (source['size'], source['mtime_ns'], tail[:12])
+
+
+def _source_stamp(csv_path):
+    st = os.stat(csv_path)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _read_meta(target):
+    try:
+        with open(os.path.join(target, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _rss():
+    # resident memory of this process in bytes
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+if __name__ == '__main__':
+    # compare startup cost of the memory-mapped columns with pd.read_csv:
+    #   python -m utils.shots [path/to/cleaned_data.csv]
+    import sys
+    path = sys.argv[1] if len(sys.argv) > 1 else SHOTS_CSV
+    load(path)
+    base = _rss()
+    t = time.perf_counter()
+    table = load(path)
+    print('memory-mapped columns: %.4fs, %+.1f MB RSS'
+          % (time.perf_counter() - t, (_rss() - base) / 1e6))
+    base = _rss()
+    t = time.perf_counter()
+    df = pd.read_csv(path)
+    print('pd.read_csv:           %.4fs, %+.1f MB RSS'
+          % (time.perf_counter() - t, (_rss() - base) / 1e6))
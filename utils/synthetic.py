@@ -0,0 +1,47 @@
+# synthetic versions of the datasets, for benchmarks and load tests
+# gapminder(scale) repeats the real gapminder table `scale` times, each copy
+# a set of new countries ("France 2", "France 3"...) in the same continents
+# with their own noise on life expectancy, population and GDP, so filters
+# and figures see `scale` times the rows and traces. shots(n) draws n shots
+# spread over the GAA counties like the real match data.
+import numpy as np
+import pandas as pd
+
+COUNTIES = ['Antrim', 'Armagh', 'Carlow', 'Cavan', 'Clare', 'Cork', 'Derry', 'Donegal', 'Down',
+            'Dublin', 'Fermanagh', 'Galway', 'Kerry', 'Kildare', 'Kilkenny', 'Laois', 'Leitrim',
+            'Limerick', 'Longford', 'Louth', 'Mayo', 'Meath', 'Monaghan', 'Offaly', 'Roscommon',
+            'Sligo', 'Tipperary', 'Tyrone', 'Waterford', 'Westmeath', 'Wexford', 'Wicklow']
+
+
+def gapminder(scale=1, seed=0):
+    import plotly.express as px
+    df = px.data.gapminder()
+    if scale <= 1:
+        return df
+    rng = np.random.default_rng(seed)
+    n = len(df)
+    copy = np.repeat(np.arange(scale), n)
+    out = {col: np.tile(df[col].to_numpy(), scale) for col in df.columns}
+    suffix = np.array([''] + [' %d' % (i + 1) for i in range(1, scale)], dtype=object)
+    out['country'] = out['country'] + suffix[copy]
+    # one factor per copy of a country, so its trend over the years stays
+    codes = pd.factorize(df['country'])[0]
+    entity = copy * (codes.max() + 1) + np.tile(codes, scale)
+    for col, spread in (('lifeExp', 0.05), ('pop', 0.1), ('gdpPercap', 0.1)):
+        factor = 1 + rng.uniform(-spread, spread, entity.max() + 1)
+        factor[:codes.max() + 1] = 1
+        values = out[col] * factor[entity]
+        out[col] = values.round().astype(df[col].dtype) if col == 'pop' else values
+    return pd.DataFrame(out)
+
+
+def shots(n, seed=0, counties=COUNTIES):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'shot_id': np.arange(n),
+        'county': rng.choice(counties, n),
+        'build_up_passes': rng.integers(0, 30, n),
+        'distance_from_goal': rng.uniform(5, 60, n).round(2),
+        'angle': rng.uniform(0, 90, n).round(2),
+        'result': rng.choice(['goal', 'point', 'wide'], n),
+    })
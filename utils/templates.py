@@ -0,0 +1,358 @@
+# figure templates: plotly express runs once per (page, figure, y variable)
+# and later calls only swap in the new data arrays
+# A template is made from the px builder of a figure and a small prototype
+# frame holding a few rows of every trace / animation frame of the full data.
+# It records, for every trace, the plotly-validated attributes px produced and
+# which dataframe column feeds each of its data arrays (x, y, hovertext,
+# customdata columns...). render(df) then groups df the way px would and
+# copies those attributes, without going through px or plotly's validation.
+# The template checks itself against px on the prototype and falls back to
+# the px builder when that check fails or df holds a trace it has not seen.
+import copy
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import plotly.io as pio
+
+log = logging.getLogger(__name__)
+
+# FIGURE_TEMPLATES=0 builds every figure with plotly express
+FIGURE_TEMPLATES = os.environ.get('FIGURE_TEMPLATES', '1') == '1'
+# rows of each trace / frame kept in the prototype frame
+PROTOTYPE_ROWS = 8
+
+_templates = {}
+_lock = threading.RLock()
+
+
+class FigureTemplate:
+
+    def __init__(self, build, full, groups=(), frame=None, size_max=None):
+        # build(df) is the plotly express path for the figure, full the whole
+        # dataset, groups the columns px makes one trace per value of
+        # (color, line_group...), frame the animation_frame column
+        self.build = build
+        self.groups = list(groups)
+        self.frame = frame
+        self.size_max = size_max
+        self.fallbacks = 0
+        self.traces = {}
+        self.fields = None
+        self.ok = False
+        if full is None or not len(full):
+            return
+        keys = ([frame] if frame else []) + self.groups
+        proto = full.groupby(keys, sort=False).head(PROTOTYPE_ROWS) if keys else full.head(PROTOTYPE_ROWS)
+        proto = proto.reset_index(drop=True)
+        fig = build(proto).to_plotly_json()
+        self.layout = fig['layout']
+        try:
+            self._learn(proto, fig)
+        except Exception:
+            log.warning('figure template could not be learnt, using plotly express',
+                        exc_info=True)
+            return
+        self.ok = self._check(proto, fig)
+        if not self.ok:
+            log.warning('figure template does not match plotly express, using plotly express')
+
+    def _split(self, df):
+        # ((frame value, group values), row positions) in the order px makes
+        # traces: frames by first appearance, groups by the first appearance
+        # of each group column's values
+        cols = ([self.frame] if self.frame else []) + self.groups
+        if not cols:
+            return [((), np.arange(len(df)))]
+        codes = []
+        uniques = []
+        for col in cols:
+            c, u = pd.factorize(df[col], sort=False)
+            codes.append(c)
+            uniques.append(u)
+        order = np.lexsort(codes[::-1])
+        stacked = np.stack([c[order] for c in codes], axis=1)
+        starts = np.flatnonzero(np.r_[True, (stacked[1:] != stacked[:-1]).any(axis=1)])
+        ends = np.r_[starts[1:], len(order)]
+        out = []
+        for s, e in zip(starts, ends):
+            key = tuple(_plain(u[c]) for u, c in zip(uniques, stacked[s]))
+            out.append((key, order[s:e]))
+        return out
+
+    def _proto_traces(self, fig):
+        if self.frame:
+            return [(frame['name'], frame['data']) for frame in fig.get('frames', [])]
+        return [(None, fig['data'])]
+
+    def _learn(self, proto, fig):
+        groups = self._split(proto)
+        frames = self._proto_traces(fig)
+        traces = [t for _, data in frames for t in data]
+        if len(traces) != len(groups):
+            raise ValueError('expected %d traces, px made %d' % (len(groups), len(traces)))
+        self.fields = _match_columns(traces, [proto.iloc[rows] for _, rows in groups])
+        for (key, _), trace in zip(groups, traces):
+            self.traces[key] = _strip(trace, self.fields)
+        # updates made after px (update_traces) only reach fig.data, not the
+        # frames, keep them apart to apply to the first frame
+        self.data_updates = {}
+        if self.frame:
+            for shown, trace in zip(fig['data'], frames[0][1]):
+                self.data_updates.update({k: v for k, v in shown.items()
+                                          if k not in self.fields and _plotly(trace.get(k)) != _plotly(v)})
+
+    def _check(self, proto, fig):
+        # the prototype, and the prototype without its first group, must come
+        # out as px makes them; the second catches styles px hands out in
+        # order of appearance, like colors without a color_discrete_map
+        subsets = [(proto, fig)]
+        if self.groups:
+            first = proto[self.groups[0]].iloc[0]
+            rest = proto[proto[self.groups[0]] != first].reset_index(drop=True)
+            if len(rest):
+                subsets.append((rest, self.build(rest).to_plotly_json()))
+        for df, expected in subsets:
+            mine = self.render(df, check=False)
+            if any(_plotly(mine.get(k) or []) != _plotly(expected.get(k) or [])
+                   for k in ('data', 'frames')):
+                return False
+            if any(_plotly(mine['layout'].get(k)) != _plotly(expected['layout'].get(k))
+                   for k in ('sliders', 'xaxis', 'yaxis')):
+                return False
+        return True
+
+    def render(self, df, layout=None, check=True):
+        # figure dict for df; layout holds extra 'dotted.path': value updates
+        if check and (not self.ok or not len(df)):
+            return self._fallback(df, layout)
+        groups = self._split(df)
+        if any(key not in self.traces for key, _ in groups):
+            return self._fallback(df, layout)
+        columns = {col: df[col].to_numpy() for col in set(_columns(self.fields))}
+        sizeref = None
+        if self.size_max and 'marker.size' in self.fields:
+            sizeref = float(np.max(columns[self.fields['marker.size']])) / self.size_max ** 2
+        frames = []
+        for key, rows in groups:
+            trace = _fill(self.traces[key], self.fields, columns, rows)
+            if sizeref is not None:
+                trace['marker'] = dict(trace['marker'], sizeref=sizeref)
+            name = key[0] if self.frame else None
+            if not frames or frames[-1][0] != name:
+                frames.append((name, []))
+            frames[-1][1].append(trace)
+        for _, traces in frames:
+            seen = set()
+            for trace in traces:
+                if 'showlegend' in trace:
+                    trace['showlegend'] = trace.get('legendgroup') not in seen
+                    seen.add(trace.get('legendgroup'))
+        fig_layout = dict(self.layout)
+        if self.frame:
+            fig = {'data': [dict(t, **self.data_updates) for t in frames[0][1]] if frames else [],
+                   'frames': [{'data': traces, 'name': str(name)} for name, traces in frames]}
+            fig_layout['sliders'] = _sliders(self.layout['sliders'], [str(n) for n, _ in frames])
+        else:
+            fig = {'data': frames[0][1] if frames else []}
+        for axis in ('xaxis', 'yaxis'):
+            # categorical axes of animated figures list the values shown
+            if 'categoryarray' in self.layout.get(axis, {}) and axis[0] in self.fields:
+                values = pd.unique(columns[self.fields[axis[0]]]).tolist()
+                fig_layout[axis] = dict(self.layout[axis], categoryarray=values)
+        for path, value in (layout or {}).items():
+            fig_layout = _set(fig_layout, path.split('.'), value)
+        fig['layout'] = fig_layout
+        return fig
+
+    def _fallback(self, df, layout):
+        self.fallbacks += 1
+        fig = self.build(df)
+        if layout:
+            fig.update_layout(**{path.replace('.', '_'): value for path, value in layout.items()})
+        return fig.to_plotly_json()
+
+
+def template(key, build, full, **spec):
+    # the template for key, made on first use; full is only called then
+    t = _templates.get(key)
+    if t is None:
+        with _lock:
+            t = _templates.get(key)
+            if t is None:
+                t = FigureTemplate(build, full() if FIGURE_TEMPLATES else None, **spec)
+                _templates[key] = t
+    return t
+
+
+def clear():
+    with _lock:
+        _templates.clear()
+
+
+def _plain(value):
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _plotly(obj):
+    # obj as the browser gets it
+    return json.loads(pio.json.to_json_plotly(obj))
+
+
+def _paths(obj, prefix=()):
+    # (path, array) for every array attribute of a trace dict
+    for k, v in obj.items():
+        if isinstance(v, dict):
+            yield from _paths(v, prefix + (k,))
+        elif isinstance(v, (list, tuple, np.ndarray)):
+            yield prefix + (k,), v
+
+
+def _same(a, b):
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if a.dtype.kind in 'biuf' and b.dtype.kind in 'biuf':
+        return np.array_equal(a.astype(np.float64), b.astype(np.float64), equal_nan=True)
+    return _plotly(a.tolist()) == _plotly(b.tolist())
+
+
+def _match_columns(traces, rows):
+    # {'x': 'gdpPercap', 'customdata': ['continent', 'pop'], ...} for the
+    # arrays that have one entry per row in every trace, matched over all of
+    # the traces at once as a trace may only hold a row or two
+    fields = {}
+    sizes = [len(r) for r in rows]
+    rows = pd.concat(rows)
+    for path, _ in _paths(traces[0]):
+        arrays = [_get(trace, path) for trace in traces]
+        if any(a is None or len(a) != n for a, n in zip(arrays, sizes)):
+            continue
+        arr = np.concatenate([np.asarray(a, dtype=object).reshape(n, -1)
+                              for a, n in zip(arrays, sizes)])
+        if np.ndim(arrays[0][0]) == 1:
+            cols = [_find(arr[:, j], rows) for j in range(arr.shape[1])]
+        else:
+            cols = _find(arr[:, 0], rows)
+        if cols is None or (isinstance(cols, list) and None in cols):
+            raise ValueError('no column for %s' % '.'.join(path))
+        fields['.'.join(path)] = cols
+    return fields
+
+
+def _get(trace, path):
+    for p in path:
+        trace = trace.get(p) if isinstance(trace, dict) else None
+    return trace
+
+
+def _find(values, rows):
+    for col in rows.columns:
+        if _same(values, rows[col].to_numpy()):
+            return col
+    return None
+
+
+def _columns(fields):
+    for col in fields.values():
+        if isinstance(col, list):
+            yield from col
+        else:
+            yield col
+
+
+def _strip(trace, fields):
+    # the trace without its data arrays, those come from the dataframe
+    out = copy.deepcopy(trace)
+    for path in fields:
+        parts = path.split('.')
+        node = out
+        for p in parts[:-1]:
+            node = node[p]
+        node.pop(parts[-1], None)
+    return out
+
+
+def _fill(proto, fields, columns, rows):
+    trace = dict(proto)
+    for path, col in fields.items():
+        if isinstance(col, list):
+            value = np.empty((len(rows), len(col)), dtype=object)
+            for j, c in enumerate(col):
+                value[:, j] = columns[c][rows]
+        else:
+            value = columns[col][rows]
+        trace = _set(trace, path.split('.'), value)
+    return trace
+
+
+def _set(node, parts, value):
+    # copy of node with node[parts[0]][parts[1]]... = value
+    node = dict(node)
+    if len(parts) == 1:
+        node[parts[0]] = value
+    else:
+        node[parts[0]] = _set(node.get(parts[0]) or {}, parts[1:], value)
+    return node
+
+
+def _sliders(sliders, names):
+    slider = dict(sliders[0])
+    pattern = slider['steps'][0]
+    steps = []
+    for name in names:
+        step = copy.deepcopy(pattern)
+        step['args'][0] = [name]
+        step['label'] = name
+        steps.append(step)
+    slider['steps'] = steps
+    slider['active'] = 0
+    return [slider] + list(sliders[1:])
+
+
+
+if __name__ == '__main__':
+    # compare the plotly express path of each figure with its template,
+    # building the figure and serializing it as a callback response would:
+    #   python -m utils.templates [repeats]
+    import importlib
+    import sys
+    import time
+
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    task123 = importlib.import_module('apps.task123')
+    europe = importlib.import_module('apps.Europe')
+    gap = task123.gap_engine
+    df = gap.select([60011, 300000000], continent=['Asia', 'Europe', 'Americas'])
+    eur = gap.select([147962, 82400996], country=list(europe.country_names[:12]))
+    figures = [
+        ('task123 scatter', lambda: task123.px_scatter_figure(df),
+         lambda: task123.scatter_figure(df)),
+        ('task123 map', lambda: task123.px_map_figure(df, 'lifeExp'),
+         lambda: task123.map_figure(df, 'lifeExp')),
+        ('task123 line', lambda: task123.px_line_figure(df, 'lifeExp'),
+         lambda: task123.line_figure(df, 'lifeExp')),
+        ('Europe bar', lambda: europe.px_bar_figure(eur, 'pop'),
+         lambda: europe.bar_figure(eur, 'pop', [147962, 82400996])),
+        ('Europe map', lambda: europe.px_map_figure(eur, 'pop'),
+         lambda: europe.map_figure(eur, 'pop')),
+        ('Europe line', lambda: europe.px_line_figure(eur, 'pop'),
+         lambda: europe.line_figure(eur, 'pop')),
+    ]
+    try:
+        import orjson
+        print('serializing with orjson %s' % orjson.__version__)
+    except ImportError:
+        print('serializing with json, pip install orjson for faster responses')
+    print('%-16s %12s %12s %8s' % ('figure', 'px (ms)', 'template (ms)', 'speedup'))
+    for label, px_path, template_path in figures:
+        template_path()
+        times = []
+        for build in (px_path, template_path):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                pio.json.to_json_plotly(build())
+            times.append((time.perf_counter() - start) / repeats * 1e3)
+        print('%-16s %12.2f %12.2f %7.1fx' % (label, times[0], times[1], times[0] / times[1]))